@@ -10,17 +10,32 @@ Real trading code can be directly used to backtest.
 from __future__ import division
 
 from datetime import datetime, timedelta
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right, insort
+from time import time as _time     # 避免通过from ctaBacktesting import *覆盖脚本中导入的time模块
 from itertools import product
+from random import Random
 import multiprocessing
+import os
+import json
+import hashlib
+import inspect
 import pymongo
+import numpy as np
 
 from ctaBase import *
 from ctaSetting import *
+from ctaDataSource import (loadColumnData, loadCachedColumnData, getCacheKey,
+                           loadColumnCache, saveColumnCache, removeColumnCache,
+                           loadJournalColumnData, DOCUMENT_PROJECTION, CursorData)
 
 from vtConstant import *
 from vtGateway import VtOrderData, VtTradeData
-from vtFunction import loadMongoSetting
+from vtFunction import loadMongoSetting, loadVtSetting
+from vtJournal import JournalStorage, STORAGE_MONGO, STORAGE_JOURNAL, JOURNAL_PATH
+
+ANNUAL_DAYS = 240       # 每年的交易日数量，用于计算年化的夏普比率
+INFINITY = float('inf')
 
 
 ########################################################################
@@ -53,6 +68,10 @@ class BacktestingEngine(object):
         self.stopOrderDict = {}             # 停止单撤销后不会从本字典中删除
         self.workingStopOrderDict = {}      # 停止单撤销后会从本字典中删除
         
+        # 活动停止单的价格索引，key为方向，撮合时只查找价格会触发的停止单
+        self.stopOrderIndex = {DIRECTION_LONG: OrderPriceIndex(),
+                               DIRECTION_SHORT: OrderPriceIndex()}
+        
         # 引擎类型为回测
         # set engine type as "backtest"
         self.engineType = ENGINETYPE_BACKTESTING
@@ -73,9 +92,17 @@ class BacktestingEngine(object):
         self.dbClient = None        # Database Client
         self.dbCursor = None        # Databse cursor
         
-        #self.historyData = []       # 历史数据的列表，回测用
+        self.historyData = None     # 历史数据（包括初始化数据），ColumnData对象
         self.initData = []          # The data used to initialise strategy
-        #self.backtestingData = []   # 回测用的数据
+        self.backtestingData = None # 回测用的数据，ColumnData对象
+        self.cacheActive = True     # 是否使用本地缓存的历史数据
+        self.sharedDataKey = ''     # 并行优化时父进程共享的历史数据的缓存键
+        self.slotDataActive = False # 是否使用__slots__版本的数据类（CtaBarDataSlot、CtaTickDataSlot）
+        
+        # 历史数据的存储后端（mongo或journal），默认使用VT_setting.json中的配置
+        setting = loadVtSetting()
+        self.storageBackend = setting.get('storageBackend', STORAGE_MONGO)
+        self.journalPath = setting.get('journalPath') or JOURNAL_PATH
         
         self.dbName = ''            # 回测数据库名
         self.symbol = ''            # 回测集合名
@@ -89,6 +116,10 @@ class BacktestingEngine(object):
         self.workingLimitOrderDict = OrderedDict()  # 活动限价单字典，用于进行撮合用
         self.limitOrderCount = 0                    # 限价单编号
         
+        # 活动限价单的价格索引，key为方向，撮合时只查找价格会成交的限价单
+        self.limitOrderIndex = {DIRECTION_LONG: OrderPriceIndex(),
+                                DIRECTION_SHORT: OrderPriceIndex()}
+        
         self.tradeCount = 0             # 成交编号
         self.tradeDict = OrderedDict()  # 成交字典
         
@@ -99,6 +130,14 @@ class BacktestingEngine(object):
         self.bar = None
         self.dt = None      # 最新的时间
         
+        # tick模式下的排队撮合模型（估算委托在买一卖一队列中的位置，支持部分成交和委托延时）
+        self.queueFillActive = False        # 是否使用排队撮合模型
+        self.latency = timedelta(0)         # 发单和撤单到达交易所的延时
+        self.queueDict = {}                 # 委托前面排队的数量，key为orderID，无法估计时为无穷大
+        self.pendingOrderQueue = deque()    # 尚未到达的委托，元素为(到达时间, 委托)
+        self.pendingCancelQueue = deque()   # 尚未到达的撤单，元素为(到达时间, orderID)
+        self.lastTickVolume = 0             # 上一个tick的累计成交量
+        
     #----------------------------------------------------------------------
     def setStartDate(self, startDate='20100416', initDays=10):
         """设置回测的启动日期"""
@@ -133,6 +172,57 @@ class BacktestingEngine(object):
         # "Bar" or "Tick"
         self.mode = mode
     
+    #----------------------------------------------------------------------
+    def setCacheActive(self, active):
+        """设置是否使用本地缓存的历史数据"""
+        """use local data cache or not"""
+
+        self.cacheActive = active
+    
+    #----------------------------------------------------------------------
+    def setSlotDataActive(self, active):
+        """设置是否使用__slots__版本的数据类，减少回测数据对象的内存占用和创建时间"""
+        """use data classes with __slots__ or not"""
+
+        self.slotDataActive = active
+    
+    #----------------------------------------------------------------------
+    def setQueueFillActive(self, active, latency=0):
+        """
+        设置tick模式下是否使用排队撮合模型，latency为发单和撤单到达交易所的延时（毫秒）
+        
+        排队撮合模型中，委托到达时如果可以立即成交，则以对手价成交不超过对手盘口挂单量的部分，
+        剩余部分挂单排队；挂单时排在同价位已有挂单的后面，之后根据成交量的变化和盘口挂单量的减少
+        估算前面排队的数量，排到之后按照成交量部分成交；价格被穿越或者对手价达到委托价时以委托价成交，
+        成交量不超过对手盘口挂单量或者穿越的成交量，剩余部分继续挂单。
+        停止单触发后以对手价发出限价单，同样经过延时和排队撮合
+        """
+        """use queue position fill model in tick mode or not"""
+        
+        self.queueFillActive = active
+        self.latency = timedelta(milliseconds=latency)
+    
+    #----------------------------------------------------------------------
+    def getLatency(self):
+        """获取排队撮合模型的委托延时（毫秒）"""
+        return self.latency.total_seconds() * 1000
+    
+    #----------------------------------------------------------------------
+    def setStorageBackend(self, backend, journalPath=''):
+        """设置历史数据的存储后端，使用journal时可以指定存储目录"""
+        """set storage backend of historical data (mongo or journal)"""
+        
+        self.storageBackend = backend
+        if journalPath:
+            self.journalPath = journalPath
+    
+    #----------------------------------------------------------------------
+    def setSharedData(self, key):
+        """设置使用父进程共享的历史数据（缓存键），用于并行优化的子进程"""
+        """use historical data shared by parent process"""
+
+        self.sharedDataKey = key
+    
     #----------------------------------------------------------------------
     def setDatabase(self, dbName, symbol):
         """设置历史数据所用的数据库"""
@@ -142,74 +232,158 @@ class BacktestingEngine(object):
         self.symbol      = symbol
     
     #----------------------------------------------------------------------
-    def loadHistoryData(self):
-        """载入历史数据"""
-        """load historical data"""
-
-        host, port = loadMongoSetting()
+    def loadHistoryData(self, once=False):
+        """
+        载入历史数据
         
-        self.dbClient = pymongo.MongoClient(host, port)
-        collection = self.dbClient[self.dbName][self.symbol]
+        once为True时（单次回测）没有可用的缓存则不生成列式数据，初始化数据直接读取为对象，
+        回测数据在回测时从查询指针逐条生成（和原有方式的耗时相同），此时historyData为None
+        """
+        """load historical data"""
 
         self.output("Start loading historical data")
       
         # 首先根据回测模式，确认要使用的数据类
         # Choose data type based on backtest mode
         if self.mode == self.BAR_MODE:
-            dataClass = CtaBarData
+            dataClass = CtaBarDataSlot if self.slotDataActive else CtaBarData
         else:
-            dataClass = CtaTickData
+            dataClass = CtaTickDataSlot if self.slotDataActive else CtaTickData
+        
+        # 使用父进程共享的数据时直接以只读内存映射的方式打开，无需连接数据库
+        # Attach to the data shared by parent process, no database connection needed
+        if self.sharedDataKey:
+            start = _time()
+            columnData, meta = loadColumnCache(self.sharedDataKey, dataClass)
+            self.output("Attached shared data: %s" %self.sharedDataKey)
+            self.setHistoryData(columnData)
+            self.output("Data loading complete, data volumn: %s, time cost: %.2fs" %(len(columnData), _time()-start))
+            return
+
+        # Journal存储的数据本身就是内存映射的定长记录，直接生成列式数据，不使用缓存
+        # Journal records are memory-mapped fixed-size records, no cache needed
+        if self.storageBackend == STORAGE_JOURNAL:
+            start = _time()
+            journal = JournalStorage(self.journalPath)
+            columnData = loadJournalColumnData(journal, self.dbName, self.symbol, dataClass,
+                                               self.dataStartDate, self.dataEndDate)
+            self.setHistoryData(columnData)
+            self.output("Data loaded from journal, data volumn: %s, time cost: %.2fs" %(len(columnData), _time()-start))
+            return
+
+        host, port = loadMongoSetting()
+        
+        self.dbClient = pymongo.MongoClient(host, port)
+        collection = self.dbClient[self.dbName][self.symbol]
 
-        # 载入初始化需要用的数据
-        # Load initialised data
+        # 初始化数据和回测数据一次查询载入为列式数据，再按照策略启动日期切分
+        # Load initialised data and backtest data into columns with one query
 
         # $gte means "greater and equal to"
-        # $lt means "less than"
-        flt = {'datetime':{'$gte':self.dataStartDate,
-                           '$lt':self.strategyStartDate}}        
-        initCursor = collection.find(flt)
-        
-        # 将数据从查询指针中读取出，并生成列表
-        # Read data from cursor, generate a list
-        self.initData = []                                      # Empty "initData" list
-        for d in initCursor:
-            data = dataClass()
-            data.__dict__ = d
-            self.initData.append(data)
-        
-        # 载入回测数据
-        # Load backtest data (exclude initialised data)
+        # $lte means "less and equal to"
         if not self.dataEndDate:
-
             # If "End Date" is not set, retreat data up to today
+            flt = {'datetime':{'$gte':self.dataStartDate}}
+        else:
+            flt = {'datetime':{'$gte':self.dataStartDate,
+                               '$lte':self.dataEndDate}}
+        
+        start = _time()
+        if self.cacheActive:
+            key = getCacheKey(self.dbName, self.symbol, self.mode, self.startDate, self.endDate)
+            columnData, hit = loadCachedColumnData(collection, flt, dataClass, key, once)
+            if hit:
+                self.output("Data cache hit: %s" %key)
+            elif columnData is None:
+                self.output("Data cache miss, cache will be built on the next run: %s" %key)
+            else:
+                self.output("Data cache miss, loaded from database: %s" %key)
+        elif once:
+            columnData = None
+        else:
+            columnData = loadColumnData(collection.find(flt, DOCUMENT_PROJECTION), dataClass)
+        
+        # 单次回测直接使用查询指针
+        # Single backtest reads data objects from cursor directly
+        if columnData is None:
+            self.setCursorData(collection, dataClass)
+            self.output("Data cursor opened, initialising data volumn: %s, time cost: %.2fs" %(len(self.initData), 
+                                                                                             _time()-start))
+            return
+        
+        self.setHistoryData(columnData)
+        
+        self.output("Data loading complete, data volumn: %s, time cost: %.2fs" %(len(columnData), _time()-start))
+    
+    #----------------------------------------------------------------------
+    def setCursorData(self, collection, dataClass):
+        """和原有方式一样分别查询初始化数据和回测数据，回测数据保留为查询指针"""
+        flt = {'datetime':{'$gte':self.dataStartDate,
+                           '$lt':self.strategyStartDate}}
+        self.initData = CursorData(dataClass, collection.find(flt, DOCUMENT_PROJECTION)).toList()
+        
+        if not self.dataEndDate:
             flt = {'datetime':{'$gte':self.strategyStartDate}}
         else:
             flt = {'datetime':{'$gte':self.strategyStartDate,
-                               '$lte':self.dataEndDate}}  
-        self.dbCursor = collection.find(flt)
-        
-        self.output("Data loading complete, data volumn: %s" %(initCursor.count() + self.dbCursor.count()))
+                               '$lte':self.dataEndDate}}
+        self.historyData = None
+        self.backtestingData = CursorData(dataClass, collection.find(flt, DOCUMENT_PROJECTION))
+    
+    #----------------------------------------------------------------------
+    def setHistoryData(self, columnData):
+        """设置历史数据，并按照策略启动日期切分为初始化数据和回测数据"""
+        """set historical data, split into initialised data and backtest data"""
+        
+        # 共享或者外部设置的数据可能超出回测的日期范围（如优化时使用较短的日期范围），按日期范围切片，
+        # 和数据库查询一样包含结束时间
+        dataEndDate = self.dataEndDate
+        if dataEndDate:
+            dataEndDate += timedelta(microseconds=1)
+        columnData = columnData.sliceByDatetime(self.dataStartDate, dataEndDate)
+        self.historyData = columnData
+        
+        # 初始化数据转换为列表，用于策略的loadBar/loadTick
+        # Generate a list for initialised data
+        self.initData = columnData.sliceByDatetime(end=self.strategyStartDate).toList()
+        
+        # 回测数据保留为列式数据，回测时按顺序生成数据对象
+        # Backtest data (exclude initialised data)
+        self.backtestingData = columnData.sliceByDatetime(start=self.strategyStartDate)
         
     #----------------------------------------------------------------------
-    def runBacktesting(self):
-        """运行回测"""
+    def runBacktesting(self, loadData=True):
+        """运行回测，loadData为False时使用之前载入或设置的历史数据"""
         """Run backtesting"""
 
         # 载入历史数据
         # Load historical data
-        self.loadHistoryData()
+        if loadData:
+            self.loadHistoryData(once=True)
         
-        # 首先根据回测模式，确认要使用的数据类
-        # First, choose data class and data update function (Bar or Tick) based on backtest mode
+        # 首先根据回测模式，确认要使用的数据更新函数
+        # First, choose data update function (Bar or Tick) based on backtest mode
         if self.mode == self.BAR_MODE:
-            dataClass = CtaBarData
             func = self.newBar
         else:
-            dataClass = CtaTickData
             func = self.newTick
 
         self.output("Start backtesing!")
         
+        self.startStrategy()
+        
+        self.output("Processing historical data...")
+
+        for data in self.backtestingData.iterData():
+            func(data)     
+            
+        self.output("No more historical data")
+    
+    #----------------------------------------------------------------------
+    def startStrategy(self):
+        """初始化并启动策略"""
+        """Initialise and start strategy"""
+        
         self.strategy.inited = True
         self.strategy.onInit()
         self.output("Strategy initialsing complete")
@@ -217,15 +391,162 @@ class BacktestingEngine(object):
         self.strategy.trading = True
         self.strategy.onStart()
         self.output("Strategy started")
+    
+    #----------------------------------------------------------------------
+    def runVectorizedBacktesting(self, loadData=True):
+        """
+        运行向量化回测（仅支持K线模式）
         
-        self.output("Processing historical data...")
-
-        for d in self.dbCursor:
-            data = dataClass()
-            data.__dict__ = d
-            func(data)     
+        策略需要实现calculateTargetPos(data, startIndex)，基于整个历史数据的数组
+        （data为字段名到数组的字典，startIndex为回测数据开始的位置，之前为初始化数据）
+        计算每根K线结束时的目标仓位数组，也可以同时返回委托价格数组（targetPos, price）。
+        
+        目标仓位变化时在下一根K线成交：没有委托价格时以开盘价成交，有委托价格时和
+        crossLimitOrder一致，买入价格为委托价和开盘价中的较低者（卖出为较高者）。
+        委托价格在下一根K线无法成交（买入低于最低价，卖出高于最高价）时仓位保持不变，
+        之后每根K线以该K线的委托价格重新委托，直到成交或者目标仓位再次变化
+        （委托价格保持不变的策略可以返回从信号K线向后填充的价格数组）。
+        生成的成交记录保存在tradeDict中，可以直接使用calculateBacktestingResult计算结果。
+        
+        Run vectorized backtesting (bar mode only), trades are generated with array 
+        operations from the target position array calculated by strategy
+        """
+        
+        if self.mode != self.BAR_MODE:
+            self.output("Vectorized backtesting only supports bar mode")
+            return
+        
+        # 载入历史数据
+        # Load historical data
+        if loadData:
+            self.loadHistoryData()
+        
+        self.output("Start vectorized backtesing!")
+        
+        data = self.historyData.columnDict
+        count = len(self.historyData)
+        startIndex = count - len(self.backtestingData)
+        
+        # 计算目标仓位，初始化数据部分不交易
+        # Calculate target position array, no trading during initialising
+        result = self.strategy.calculateTargetPos(data, startIndex)
+        if isinstance(result, tuple):
+            targetPos, orderPrice = result
+        else:
+            targetPos, orderPrice = result, None
+        
+        targetPos = np.array(targetPos)
+        targetPos[:startIndex] = 0
+        
+        # 目标仓位变化的K线发出委托，最后一根K线的委托无法成交
+        # Orders are sent when target position changes, and filled on the next bar
+        lastPos = np.append(0, targetPos[:-1])
+        changeIndex = np.flatnonzero(targetPos != lastPos)
+        changeIndex = changeIndex[changeIndex < count-1]
+        endIndex = np.append(changeIndex[1:], count-1)
+        
+        # 每根K线的委托在下一根K线能否成交，只保存能成交的K线位置用于查找
+        if orderPrice is not None:
+            orderPrice = np.asarray(orderPrice)
+            buyCrossIndex = np.flatnonzero(orderPrice[:-1] >= data['low'][1:])
+            sellCrossIndex = np.flatnonzero(orderPrice[:-1] <= data['high'][1:])
+        
+        # 目标仓位变化后，找到第一根委托能够在下一根K线成交的K线，在目标仓位
+        # 再次变化之前都无法成交时仓位保持不变
+        orderIndexList = []
+        volumeList = []
+        pos = 0
+        delayed = 0
+        targetList = targetPos.tolist()
+        for i, end in zip(changeIndex.tolist(), endIndex.tolist()):
+            volume = targetList[i] - pos
+            if not volume:
+                continue
             
-        self.output("No more historical data")
+            if orderPrice is None:
+                n = i
+            else:
+                crossIndex = buyCrossIndex if volume > 0 else sellCrossIndex
+                k = np.searchsorted(crossIndex, i)
+                if k == len(crossIndex) or crossIndex[k] >= end:
+                    delayed += 1
+                    continue
+                n = crossIndex[k]
+                if n != i:
+                    delayed += 1
+            
+            orderIndexList.append(n)
+            volumeList.append(volume)
+            pos = targetList[i]
+        
+        if delayed:
+            self.output("%s orders were not filled on the next bar, position kept until filled" %delayed)
+        
+        orderIndex = np.array(orderIndexList, dtype=int)
+        fillIndex = orderIndex + 1
+        volume = np.array(volumeList, dtype=targetPos.dtype)
+        fillOpen = data['open'][fillIndex]
+        
+        if orderPrice is None:
+            price = fillOpen
+        else:
+            orderPrice = orderPrice[orderIndex]
+            price = np.where(volume>0, np.minimum(orderPrice, fillOpen), np.maximum(orderPrice, fillOpen))
+        
+        # 生成成交记录
+        # Generate trade data
+        dtList = data['datetime'][fillIndex].tolist()
+        for v, p, dt in zip(volume.tolist(), price.tolist(), dtList):
+            self.tradeCount += 1
+            tradeID = str(self.tradeCount)
+            trade = VtTradeData()
+            trade.vtSymbol = self.strategy.vtSymbol
+            trade.tradeID = tradeID
+            trade.vtTradeID = tradeID
+            if v > 0:
+                trade.direction = DIRECTION_LONG
+            else:
+                trade.direction = DIRECTION_SHORT
+            trade.price = p
+            trade.volume = abs(v)
+            trade.tradeTime = str(dt)
+            trade.dt = dt
+            self.tradeDict[tradeID] = trade
+        
+        self.strategy.pos = pos
+        if count:
+            self.dt = data['datetime'][-1].tolist()
+        
+        self.output("Vectorized backtesting complete, trade count: %s" %len(fillIndex))
+    
+    #----------------------------------------------------------------------
+    def crossCheckVectorized(self, strategyClass, setting=None):
+        """
+        使用同一参数分别运行事件驱动回测和向量化回测，输出两者回测结果的差异
+        
+        Run both event-driven and vectorized backtesting with the same setting, compare the results
+        """
+        
+        self.clearBacktestingResult()
+        self.initStrategy(strategyClass, setting)
+        self.runBacktesting()
+        eventResult = self.calculateBacktestingResult()
+        
+        self.clearBacktestingResult()
+        self.initStrategy(strategyClass, setting)
+        self.runVectorizedBacktesting()
+        vectorResult = self.calculateBacktestingResult()
+        
+        self.output('-' * 30)
+        self.output("Cross check result (event-driven / vectorized / difference):")
+        for key in ['capital', 'maxCapital', 'drawdown', 'totalResult', 'totalTurnover',
+                    'totalCommission', 'totalSlippage', 'winningRate', 'averageWinning',
+                    'averageLosing', 'profitLossRatio']:
+            eventValue = eventResult.get(key, 0)
+            vectorValue = vectorResult.get(key, 0)
+            self.output("%s: %s / %s / %s" %(key, eventValue, vectorValue, vectorValue-eventValue))
+        
+        return eventResult, vectorResult
         
     #----------------------------------------------------------------------
     def updatePosition(self):
@@ -249,8 +570,11 @@ class BacktestingEngine(object):
         """new Tick"""
         self.tick = tick
         self.dt = tick.datetime
-        self.crossLimitOrder()
-        self.crossStopOrder()
+        if self.queueFillActive:
+            self.crossQueueOrder()
+        else:
+            self.crossLimitOrder()
+            self.crossStopOrder()
         self.strategy.onTick(tick)
         
     #----------------------------------------------------------------------
@@ -300,6 +624,12 @@ class BacktestingEngine(object):
         self.workingLimitOrderDict[orderID] = order
         self.limitOrderDict[orderID] = order
         
+        # 排队撮合模型中委托经过延时到达后才开始撮合
+        if self.queueFillActive:
+            self.pendingOrderQueue.append((self.dt + self.latency, order))
+        elif order.direction in self.limitOrderIndex:
+            self.limitOrderIndex[order.direction].add(price, self.limitOrderCount, orderID)
+        
         return orderID
     
     #----------------------------------------------------------------------
@@ -307,11 +637,25 @@ class BacktestingEngine(object):
         """撤单"""
         """cancel order"""
 
-        if vtOrderID in self.workingLimitOrderDict:
-            order = self.workingLimitOrderDict[vtOrderID]
+        # 排队撮合模型中撤单经过延时到达后才生效，在此之前委托仍然可能成交，
+        # 撤单生效时在下一个tick中推送委托数据（和实盘一样异步推送，没有延时也不在撤单调用中推送）
+        if self.queueFillActive:
+            if vtOrderID in self.workingLimitOrderDict:
+                self.pendingCancelQueue.append((self.dt + self.latency, vtOrderID))
+            return
+        
+        self.removeCancelledOrder(vtOrderID)
+    
+    #----------------------------------------------------------------------
+    def removeCancelledOrder(self, vtOrderID):
+        """撤单生效：从活动委托中删除，返回撤销的委托数据，委托已经不在活动委托中时返回None"""
+        order = self.workingLimitOrderDict.pop(vtOrderID, None)
+        if order:
             order.status = STATUS_CANCELLED
             order.cancelTime = str(self.dt)
-            del self.workingLimitOrderDict[vtOrderID]
+            self.removeLimitOrderIndex(order)
+            self.queueDict.pop(vtOrderID, None)
+        return order
         
     #----------------------------------------------------------------------
     def sendStopOrder(self, vtSymbol, orderType, price, volume, strategy):
@@ -347,6 +691,9 @@ class BacktestingEngine(object):
         self.stopOrderDict[stopOrderID] = so
         self.workingStopOrderDict[stopOrderID] = so
         
+        if so.direction in self.stopOrderIndex:
+            self.stopOrderIndex[so.direction].add(price, self.stopOrderCount, stopOrderID)
+        
         return stopOrderID
     
     #----------------------------------------------------------------------
@@ -360,6 +707,20 @@ class BacktestingEngine(object):
             so = self.workingStopOrderDict[stopOrderID]
             so.status = STOPORDER_CANCELLED
             del self.workingStopOrderDict[stopOrderID]
+            self.removeStopOrderIndex(so)
+    
+    #----------------------------------------------------------------------
+    def removeLimitOrderIndex(self, order):
+        """从价格索引中删除限价单"""
+        if order.direction in self.limitOrderIndex:
+            self.limitOrderIndex[order.direction].remove(order.price, int(order.orderID), order.orderID)
+    
+    #----------------------------------------------------------------------
+    def removeStopOrderIndex(self, so):
+        """从价格索引中删除停止单"""
+        if so.direction in self.stopOrderIndex:
+            seq = int(so.stopOrderID[len(STOPORDERPREFIX):])
+            self.stopOrderIndex[so.direction].remove(so.price, seq, so.stopOrderID)
             
     #----------------------------------------------------------------------
     def crossLimitOrder(self):
@@ -378,57 +739,75 @@ class BacktestingEngine(object):
             buyBestCrossPrice = self.tick.askPrice1
             sellBestCrossPrice = self.tick.bidPrice1
         
-        # 遍历限价单字典中的所有限价单
-        for orderID, order in self.workingLimitOrderDict.items():
-            # 判断是否会成交
-            buyCross = order.direction==DIRECTION_LONG and order.price>=buyCrossPrice
-            sellCross = order.direction==DIRECTION_SHORT and order.price<=sellCrossPrice
-            
-            # 如果发生了成交
-            # If transaction happens
-            if buyCross or sellCross:
-                # 推送成交数据
-                # Update trade data
-                self.tradeCount += 1            # TradeID increase by 1
-                tradeID = str(self.tradeCount)
-                trade = VtTradeData()
-                trade.vtSymbol = order.vtSymbol
-                trade.tradeID = tradeID
-                trade.vtTradeID = tradeID
-                trade.orderID = order.orderID
-                trade.vtOrderID = order.orderID
-                trade.direction = order.direction
-                trade.offset = order.offset
-                
-                # Buy as example:
-                # 1. Suppose the OHLC of current Bar are 100, 125, 90, 110 (Open = 100)
-                # 2. Suppose at the end of last Bar(not the start of current Bar), the price of limit order is 105,
-                #    (Last Close = 105)
-                # 3. In real trading, the trade price will be 100 instead of 105, because the best market price is 100
-                if buyCross:
-                    trade.price = min(order.price, buyBestCrossPrice)
-                    self.strategy.pos += order.totalVolume
-                else:
-                    trade.price = max(order.price, sellBestCrossPrice)
-                    self.strategy.pos -= order.totalVolume
-                
-                trade.volume = order.totalVolume
-                trade.tradeTime = str(self.dt)
-                trade.dt = self.dt
-                self.strategy.onTrade(trade)
-                
-                self.tradeDict[tradeID] = trade
-                
-                # 推送委托数据
-                # Upadte order data
-                order.tradedVolume = order.totalVolume
-                order.status = STATUS_ALLTRADED
-                self.strategy.onOrder(order)
-                
-                # 从字典中删除该限价单
-                # Remove this order from "working limit order dictionary"
-                del self.workingLimitOrderDict[orderID]
-                
+        # 通过价格索引只取出会成交的限价单（买单价格>=buyCrossPrice，卖单价格<=sellCrossPrice），
+        # 再按照委托编号排序，保证成交顺序和按发单顺序遍历所有限价单时一致
+        crossList = (self.limitOrderIndex[DIRECTION_LONG].getAbove(buyCrossPrice) + 
+                     self.limitOrderIndex[DIRECTION_SHORT].getBelow(sellCrossPrice))
+        crossList.sort()
+        
+        for seq, orderID in crossList:
+            # 策略在之前成交的回调函数中可能已经撤销了该委托
+            order = self.workingLimitOrderDict.get(orderID)
+            if order is None:
+                continue
+            
+            # Buy as example:
+            # 1. Suppose the OHLC of current Bar are 100, 125, 90, 110 (Open = 100)
+            # 2. Suppose at the end of last Bar(not the start of current Bar), the price of limit order is 105,
+            #    (Last Close = 105)
+            # 3. In real trading, the trade price will be 100 instead of 105, because the best market price is 100
+            if order.direction == DIRECTION_LONG:
+                price = min(order.price, buyBestCrossPrice)
+            else:
+                price = max(order.price, sellBestCrossPrice)
+            
+            self.fillLimitOrder(order, price, order.totalVolume)
+    
+    #----------------------------------------------------------------------
+    def fillLimitOrder(self, order, price, volume):
+        """限价单以price成交volume，推送成交和委托数据，全部成交后从活动委托中删除"""
+        # 推送成交数据
+        # Update trade data
+        self.tradeCount += 1            # TradeID increase by 1
+        tradeID = str(self.tradeCount)
+        trade = VtTradeData()
+        trade.vtSymbol = order.vtSymbol
+        trade.tradeID = tradeID
+        trade.vtTradeID = tradeID
+        trade.orderID = order.orderID
+        trade.vtOrderID = order.orderID
+        trade.direction = order.direction
+        trade.offset = order.offset
+        trade.price = price
+        
+        if order.direction == DIRECTION_LONG:
+            self.strategy.pos += volume
+        else:
+            self.strategy.pos -= volume
+        
+        trade.volume = volume
+        trade.tradeTime = str(self.dt)
+        trade.dt = self.dt
+        self.strategy.onTrade(trade)
+        
+        self.tradeDict[tradeID] = trade
+        
+        # 推送委托数据
+        # Upadte order data
+        order.tradedVolume += volume
+        if order.tradedVolume >= order.totalVolume:
+            order.status = STATUS_ALLTRADED
+        else:
+            order.status = STATUS_PARTTRADED
+        self.strategy.onOrder(order)
+        
+        # 全部成交后从字典中删除该限价单（策略可能已经在回调函数中撤单）
+        # Remove this order from "working limit order dictionary"
+        if order.status == STATUS_ALLTRADED and order.orderID in self.workingLimitOrderDict:
+            del self.workingLimitOrderDict[order.orderID]
+            self.removeLimitOrderIndex(order)
+            self.queueDict.pop(order.orderID, None)
+            
     #----------------------------------------------------------------------
     def crossStopOrder(self):
         """基于最新数据撮合停止单"""
@@ -442,65 +821,213 @@ class BacktestingEngine(object):
             sellCrossPrice = self.tick.lastPrice
             bestCrossPrice = self.tick.lastPrice
         
-        # 遍历停止单字典中的所有停止单
-        for stopOrderID, so in self.workingStopOrderDict.items():
-            # 判断是否会成交
-            buyCross = so.direction==DIRECTION_LONG and so.price<=buyCrossPrice
-            sellCross = so.direction==DIRECTION_SHORT and so.price>=sellCrossPrice
-            
-            # 如果发生了成交
-            if buyCross or sellCross:
-                # 推送成交数据
-                self.tradeCount += 1            # 成交编号自增1
-                tradeID = str(self.tradeCount)
-                trade = VtTradeData()
-                trade.vtSymbol = so.vtSymbol
-                trade.tradeID = tradeID
-                trade.vtTradeID = tradeID
-                
-                if buyCross:
-                    self.strategy.pos += so.volume
-                    trade.price = max(bestCrossPrice, so.price)
-                else:
-                    self.strategy.pos -= so.volume
-                    trade.price = min(bestCrossPrice, so.price)                
-                
-                self.limitOrderCount += 1
-                orderID = str(self.limitOrderCount)
-                trade.orderID = orderID
-                trade.vtOrderID = orderID
-                
-                trade.direction = so.direction
-                trade.offset = so.offset
-                trade.volume = so.volume
-                trade.tradeTime = str(self.dt)
-                trade.dt = self.dt
-                self.strategy.onTrade(trade)
-                
-                self.tradeDict[tradeID] = trade
-                
-                # 推送委托数据
-                so.status = STOPORDER_TRIGGERED
-                
-                order = VtOrderData()
-                order.vtSymbol = so.vtSymbol
-                order.symbol = so.vtSymbol
-                order.orderID = orderID
-                order.vtOrderID = orderID
-                order.direction = so.direction
-                order.offset = so.offset
-                order.price = so.price
-                order.totalVolume = so.volume
-                order.tradedVolume = so.volume
-                order.status = STATUS_ALLTRADED
-                order.orderTime = trade.tradeTime
-                self.strategy.onOrder(order)
-                
-                self.limitOrderDict[orderID] = order
-                
-                # 从字典中删除该限价单
-                del self.workingStopOrderDict[stopOrderID]        
+        # 通过价格索引只取出会触发的停止单（买单价格<=buyCrossPrice，卖单价格>=sellCrossPrice），
+        # 再按照停止单编号排序，保证成交顺序和按发单顺序遍历所有停止单时一致
+        crossList = (self.stopOrderIndex[DIRECTION_LONG].getBelow(buyCrossPrice) + 
+                     self.stopOrderIndex[DIRECTION_SHORT].getAbove(sellCrossPrice))
+        crossList.sort()
+        
+        for seq, stopOrderID in crossList:
+            # 策略在之前成交的回调函数中可能已经撤销了该停止单
+            so = self.workingStopOrderDict.get(stopOrderID)
+            if so is None:
+                continue
+            
+            buyCross = so.direction==DIRECTION_LONG
+            
+            # 推送成交数据
+            self.tradeCount += 1            # 成交编号自增1
+            tradeID = str(self.tradeCount)
+            trade = VtTradeData()
+            trade.vtSymbol = so.vtSymbol
+            trade.tradeID = tradeID
+            trade.vtTradeID = tradeID
+            
+            if buyCross:
+                self.strategy.pos += so.volume
+                trade.price = max(bestCrossPrice, so.price)
+            else:
+                self.strategy.pos -= so.volume
+                trade.price = min(bestCrossPrice, so.price)                
+            
+            self.limitOrderCount += 1
+            orderID = str(self.limitOrderCount)
+            trade.orderID = orderID
+            trade.vtOrderID = orderID
+            
+            trade.direction = so.direction
+            trade.offset = so.offset
+            trade.volume = so.volume
+            trade.tradeTime = str(self.dt)
+            trade.dt = self.dt
+            self.strategy.onTrade(trade)
+            
+            self.tradeDict[tradeID] = trade
+            
+            # 推送委托数据
+            so.status = STOPORDER_TRIGGERED
+            
+            order = VtOrderData()
+            order.vtSymbol = so.vtSymbol
+            order.symbol = so.vtSymbol
+            order.orderID = orderID
+            order.vtOrderID = orderID
+            order.direction = so.direction
+            order.offset = so.offset
+            order.price = so.price
+            order.totalVolume = so.volume
+            order.tradedVolume = so.volume
+            order.status = STATUS_ALLTRADED
+            order.orderTime = trade.tradeTime
+            self.strategy.onOrder(order)
+            
+            self.limitOrderDict[orderID] = order
+            
+            # 从字典中删除该停止单
+            del self.workingStopOrderDict[stopOrderID]
+            self.removeStopOrderIndex(so)
 
+    #----------------------------------------------------------------------
+    def crossQueueOrder(self):
+        """
+        基于最新的tick使用排队撮合模型撮合委托，依次处理：
+        1. 已经到达的撤单
+        2. 之前已经挂单的委托：价格被穿越或者对手价达到委托价时以委托价成交，成交量不超过
+           对手盘口挂单量或者成交量的变化（同一方向的委托按顺序分配），剩余部分排在最前；
+           在委托价上有成交时按照成交量减少前面排队的数量，排到之后部分成交
+        3. 触发的停止单，以对手价发出限价单
+        4. 已经到达的委托：可以立即成交的部分以对手价成交，剩余部分挂单排队
+        """
+        tick = self.tick
+        dt = self.dt
+        
+        # 成交量为当日累计值，换日时重新开始，累计值减少时这个tick的成交量即为新的累计值
+        if tick.volume >= self.lastTickVolume:
+            volumeChange = tick.volume - self.lastTickVolume
+        else:
+            volumeChange = tick.volume
+        self.lastTickVolume = tick.volume
+        
+        # 撤单
+        while self.pendingCancelQueue and self.pendingCancelQueue[0][0] <= dt:
+            order = self.removeCancelledOrder(self.pendingCancelQueue.popleft()[1])
+            if order:
+                self.strategy.onOrder(order)
+        
+        # 之前已经挂单的委托，只需要检查买一价、卖一价和最新价附近及以内的委托
+        askPrice = tick.askPrice1
+        bidPrice = tick.bidPrice1
+        lastPrice = tick.lastPrice
+        
+        buyList = self.limitOrderIndex[DIRECTION_LONG].getAbove(min(askPrice, bidPrice, lastPrice))
+        sellList = self.limitOrderIndex[DIRECTION_SHORT].getBelow(max(askPrice, bidPrice, lastPrice))
+        crossList = buyList + sellList
+        crossList.sort()
+        
+        # 本tick中各方向已经成交的对手盘口挂单量或者穿越成交量
+        crossedVolumeDict = {DIRECTION_LONG: 0, DIRECTION_SHORT: 0}
+        
+        for seq, orderID in crossList:
+            order = self.workingLimitOrderDict.get(orderID)
+            if order is None:
+                continue
+            
+            price = order.price
+            if order.direction == DIRECTION_LONG:
+                touchVolume = tick.askVolume1 if price >= askPrice else 0
+                throughVolume = volumeChange if price > lastPrice else 0
+                bestPrice, bestVolume = bidPrice, tick.bidVolume1
+                better = price > bestPrice
+            else:
+                touchVolume = tick.bidVolume1 if price <= bidPrice else 0
+                throughVolume = volumeChange if price < lastPrice else 0
+                bestPrice, bestVolume = askPrice, tick.askVolume1
+                better = price < bestPrice
+            
+            # 价格被穿越或者对手价达到委托价，以委托价成交可用的数量，剩余部分排在最前
+            if touchVolume or throughVolume:
+                crossVolume = max(touchVolume, throughVolume) - crossedVolumeDict[order.direction]
+                if crossVolume > 0:
+                    fillVolume = min(crossVolume, order.totalVolume - order.tradedVolume)
+                    crossedVolumeDict[order.direction] += fillVolume
+                    self.queueDict[orderID] = 0
+                    self.fillLimitOrder(order, price, fillVolume)
+                continue
+            
+            # 委托价上有成交，减少前面排队的数量，超出的部分成交
+            queueVolume = self.queueDict.get(orderID, INFINITY)
+            fillVolume = 0
+            if volumeChange and price == lastPrice:
+                queueVolume -= volumeChange
+                if queueVolume < 0:
+                    fillVolume = min(-queueVolume, order.totalVolume - order.tradedVolume)
+                    queueVolume = 0
+            
+            # 委托价优于最优价时排在最前，等于最优价时前面排队的数量不超过盘口挂单量
+            if better or not bestVolume:
+                queueVolume = 0
+            elif price == bestPrice:
+                queueVolume = min(queueVolume, bestVolume)
+            self.queueDict[orderID] = queueVolume
+            
+            if fillVolume:
+                self.fillLimitOrder(order, price, fillVolume)
+        
+        # 触发的停止单
+        crossList = (self.stopOrderIndex[DIRECTION_LONG].getBelow(lastPrice) + 
+                     self.stopOrderIndex[DIRECTION_SHORT].getAbove(lastPrice))
+        crossList.sort()
+        
+        for seq, stopOrderID in crossList:
+            so = self.workingStopOrderDict.get(stopOrderID)
+            if so is None:
+                continue
+            
+            so.status = STOPORDER_TRIGGERED
+            del self.workingStopOrderDict[stopOrderID]
+            self.removeStopOrderIndex(so)
+            
+            if so.direction == DIRECTION_LONG:
+                price = askPrice
+            else:
+                price = bidPrice
+            self.sendOrder(so.vtSymbol, getOrderType(so.direction, so.offset), price, so.volume, so.strategy)
+        
+        # 到达的委托
+        while self.pendingOrderQueue and self.pendingOrderQueue[0][0] <= dt:
+            order = self.pendingOrderQueue.popleft()[1]
+            if order.orderID not in self.workingLimitOrderDict:
+                continue
+            
+            if order.direction == DIRECTION_LONG:
+                marketable = tick.askVolume1 and order.price >= askPrice
+                bestPrice, bestVolume, counterPrice, counterVolume = (bidPrice, tick.bidVolume1, 
+                                                                      askPrice, tick.askVolume1)
+                better = order.price > bestPrice
+            elif order.direction == DIRECTION_SHORT:
+                marketable = tick.bidVolume1 and order.price <= bidPrice
+                bestPrice, bestVolume, counterPrice, counterVolume = (askPrice, tick.askVolume1,
+                                                                      bidPrice, tick.bidVolume1)
+                better = order.price < bestPrice
+            else:
+                continue
+            
+            # 挂单排队，可以立即成交时剩余部分排在最前
+            if marketable or better or not bestVolume:
+                self.queueDict[order.orderID] = 0
+            elif order.price == bestPrice:
+                self.queueDict[order.orderID] = bestVolume
+            else:
+                self.queueDict[order.orderID] = INFINITY
+            self.limitOrderIndex[order.direction].add(order.price, int(order.orderID), order.orderID)
+            
+            # 立即成交的数量不超过对手盘口挂单量（扣除本tick已经成交的部分）
+            counterVolume -= crossedVolumeDict[order.direction]
+            if marketable and counterVolume > 0:
+                fillVolume = min(order.totalVolume, counterVolume)
+                crossedVolumeDict[order.direction] += fillVolume
+                self.fillLimitOrder(order, counterPrice, fillVolume)
+    
     #----------------------------------------------------------------------
     def insertData(self, dbName, collectionName, data):
         """考虑到回测中不允许向数据库插入数据，防止实盘交易中的一些代码出错"""
@@ -537,177 +1064,67 @@ class BacktestingEngine(object):
 
         self.output("Calculating backtesting result")
         
-        # 首先基于回测后的成交记录，计算每笔交易的盈亏
-        # First, based on trade lists, calculate profit/loss for each trade
-
-        resultList = []             # 交易结果列表
+        # 首先基于回测后的成交记录，按照先开先平的顺序配对开平仓，得到每笔交易的开平仓价格和数量
+        # First, based on trade lists, match entry and exit trades (FIFO)
+        
+        longTrade = deque()         # 未平仓的多头交易，元素为[价格, 时间, 未平仓数量]
+        shortTrade = deque()        # 未平仓的空头交易
+        
+        entryPriceList = []         # 开仓价格
+        exitPriceList = []          # 平仓价格
+        volumeList = []             # 交易数量（+/-代表方向）
+        timeList = []               # 交易的时间戳使用平仓时间
         
-        longTrade = []              # 未平仓的多头交易
-        shortTrade = []             # 未平仓的空头交易
-
         for trade in self.tradeDict.values():
-            # Long Trades
+            # 多头交易先平空头仓位，空头交易先平多头仓位
             if trade.direction == DIRECTION_LONG:
-                # 如果尚无空头交易
-                if not shortTrade:
-                    longTrade.append(trade)
-                # 当前多头交易为平空
-                else:
-                    while True:
-                        entryTrade = shortTrade[0]
-                        exitTrade = trade
-                        
-                        # 清算开平仓交易
-                        closedVolume = min(exitTrade.volume, entryTrade.volume)
-                        result = TradingResult(entryTrade.price, entryTrade.dt, 
-                                               exitTrade.price, exitTrade.dt,
-                                               -closedVolume, self.rate, self.slippage, self.size)
-                        resultList.append(result)
-                        
-                        # 计算未清算部分
-                        entryTrade.volume -= closedVolume
-                        exitTrade.volume -= closedVolume
-                        
-                        # 如果开仓交易已经全部清算，则从列表中移除
-                        if not entryTrade.volume:
-                            shortTrade.pop(0)
-                        
-                        # 如果平仓交易已经全部清算，则退出循环
-                        if not exitTrade.volume:
-                            break
-                        
-                        # 如果平仓交易未全部清算，
-                        if exitTrade.volume:
-                            # 且开仓交易已经全部清算完，则平仓交易剩余的部分
-                            # 等于新的反向开仓交易，添加到队列中
-                            if not shortTrade:
-                                longTrade.append(exitTrade)
-                                break
-                            # 如果开仓交易还有剩余，则进入下一轮循环
-                            else:
-                                pass
-                        
-            # 空头交易        
+                entryQueue = shortTrade
+                openQueue = longTrade
+                sign = -1
             else:
-                # 如果尚无多头交易
-                if not longTrade:
-                    shortTrade.append(trade)
-                # 当前空头交易为平多
-                else:                    
-                    while True:
-                        entryTrade = longTrade[0]
-                        exitTrade = trade
-                        
-                        # 清算开平仓交易
-                        closedVolume = min(exitTrade.volume, entryTrade.volume)
-                        result = TradingResult(entryTrade.price, entryTrade.dt, 
-                                               exitTrade.price, exitTrade.dt,
-                                               closedVolume, self.rate, self.slippage, self.size)
-                        resultList.append(result)
-                        
-                        # 计算未清算部分
-                        entryTrade.volume -= closedVolume
-                        exitTrade.volume -= closedVolume
-                        
-                        # 如果开仓交易已经全部清算，则从列表中移除
-                        if not entryTrade.volume:
-                            longTrade.pop(0)
-                        
-                        # 如果平仓交易已经全部清算，则退出循环
-                        if not exitTrade.volume:
-                            break
-                        
-                        # 如果平仓交易未全部清算，
-                        if exitTrade.volume:
-                            # 且开仓交易已经全部清算完，则平仓交易剩余的部分
-                            # 等于新的反向开仓交易，添加到队列中
-                            if not longTrade:
-                                shortTrade.append(exitTrade)
-                                break
-                            # 如果开仓交易还有剩余，则进入下一轮循环
-                            else:
-                                pass                    
+                entryQueue = longTrade
+                openQueue = shortTrade
+                sign = 1
+            
+            volume = trade.volume
+            
+            # 清算开平仓交易，开仓交易全部清算后从队列中移除
+            while volume and entryQueue:
+                entry = entryQueue[0]
+                closedVolume = min(volume, entry[2])
+                
+                entryPriceList.append(entry[0])
+                exitPriceList.append(trade.price)
+                volumeList.append(sign * closedVolume)
+                timeList.append(trade.dt)
+                
+                entry[2] -= closedVolume
+                volume -= closedVolume
+                
+                if not entry[2]:
+                    entryQueue.popleft()
+            
+            # 未清算的部分等于新的开仓交易，添加到队列中
+            if volume:
+                openQueue.append([trade.price, trade.dt, volume])
                     
         # 检查是否有交易
-        if not resultList:
+        if not timeList:
             self.output("No trade has been recorded")
             return {}
         
-        # 然后基于每笔交易的结果，我们可以计算具体的盈亏曲线和最大回撤等        
-        capital = 0             # 资金
-        maxCapital = 0          # 资金最高净值
-        drawdown = 0            # 回撤
-        
-        totalResult = 0         # 总成交数量
-        totalTurnover = 0       # 总成交金额（合约面值）
-        totalCommission = 0     # 总手续费
-        totalSlippage = 0       # 总滑点
-        
-        timeList = []           # 时间序列
-        pnlList = []            # 每笔盈亏序列
-        capitalList = []        # 盈亏汇总的时间序列
-        drawdownList = []       # 回撤的时间序列
-        
-        winningResult = 0       # 盈利次数
-        losingResult = 0        # 亏损次数		
-        totalWinning = 0        # 总盈利金额		
-        totalLosing = 0         # 总亏损金额        
-        
-        for result in resultList:
-            capital += result.pnl
-            maxCapital = max(capital, maxCapital)
-            drawdown = capital - maxCapital
-            
-            pnlList.append(result.pnl)
-            timeList.append(result.exitDt)      # 交易的时间戳使用平仓时间
-            capitalList.append(capital)
-            drawdownList.append(drawdown)
-            
-            totalResult += 1
-            totalTurnover += result.turnover
-            totalCommission += result.commission
-            totalSlippage += result.slippage
-            
-            if result.pnl >= 0:
-                winningResult += 1
-                totalWinning += result.pnl
-            else:
-                losingResult += 1
-                totalLosing += result.pnl
-                
-        # 计算盈亏相关数据
-        winningRate = winningResult/totalResult*100         # 胜率
-        
-        averageWinning = 0                                  # 这里把数据都初始化为0
-        averageLosing = 0
-        profitLossRatio = 0
-        
-        if winningResult:
-            averageWinning = totalWinning/winningResult     # 平均每笔盈利
-        if losingResult:
-            averageLosing = totalLosing/losingResult        # 平均每笔亏损
-        if averageLosing:
-            profitLossRatio = -averageWinning/averageLosing # 盈亏比
-
-        # 返回回测结果
-        d = {}
-        d['capital'] = capital
-        d['maxCapital'] = maxCapital
-        d['drawdown'] = drawdown
-        d['totalResult'] = totalResult
-        d['totalTurnover'] = totalTurnover
-        d['totalCommission'] = totalCommission
-        d['totalSlippage'] = totalSlippage
-        d['timeList'] = timeList
-        d['pnlList'] = pnlList
-        d['capitalList'] = capitalList
-        d['drawdownList'] = drawdownList
-        d['winningRate'] = winningRate
-        d['averageWinning'] = averageWinning
-        d['averageLosing'] = averageLosing
-        d['profitLossRatio'] = profitLossRatio
-        
-        return d
+        # 然后基于每笔交易的开平仓价格和数量，用数组一次计算成交金额、手续费、滑点和盈亏
+        entryPrice = np.array(entryPriceList, dtype=np.float64)
+        exitPrice = np.array(exitPriceList, dtype=np.float64)
+        volume = np.array(volumeList, dtype=np.float64)
+        absVolume = np.abs(volume)
+        
+        turnover = (entryPrice + exitPrice) * self.size * absVolume     # 成交金额
+        commission = turnover * self.rate                               # 手续费成本
+        slippage = self.slippage * 2 * self.size * absVolume            # 滑点成本
+        pnl = (exitPrice - entryPrice) * volume * self.size - commission - slippage     # 净盈亏
+        
+        return calculateTradeStatistics(timeList, pnl, turnover.sum(), commission.sum(), slippage.sum())
         
     #----------------------------------------------------------------------
     def showBacktestingResult(self):
@@ -731,6 +1148,8 @@ class BacktestingEngine(object):
         self.output('Ave Win\t%s' %formatNumber(d['averageWinning']))
         self.output('Ave Loss\t%s' %formatNumber(d['averageLosing']))
         self.output('Profit Factor：\t%s' %formatNumber(d['profitLossRatio']))
+        self.output('Sharpe Ratio：\t%s' %formatNumber(d['sharpeRatio']))
+        self.output('Max Drawdown Duration：\t%s' %d['maxDrawdownDuration'])
     
         # Use Bokeh to plot
         from bokeh.charts import Area, Line, Histogram
@@ -785,39 +1204,177 @@ class BacktestingEngine(object):
         self.rate = rate
 
     #----------------------------------------------------------------------
-    def runOptimization(self, strategyClass, optimizationSetting):
-        """优化参数"""
-        # 获取优化设置        
-        settingList = optimizationSetting.generateSetting()
+    def runOptimization(self, strategyClass, optimizationSetting, vectorized=False):
+        """优化参数，vectorized为True时使用向量化回测"""
+        targetName = optimizationSetting.optimizeTarget
+        startDate, endDate = self.startDate, self.endDate
+        
+        # 历史数据只载入一次，每个回测任务按照各自的日期范围切片使用
+        self.loadHistoryData()
+        historyData = self.historyData
+        evaluate = self.getSerialEvaluate(strategyClass, targetName, historyData, vectorized)
+        
+        try:
+            resultList = self.runSearch(strategyClass, optimizationSetting, evaluate, vectorized)
+        finally:
+            # 恢复原来的回测日期范围
+            self.setStartDate(startDate, self.initDays)
+            self.setEndDate(endDate)
+            self.setHistoryData(historyData)
+        
+        self.showOptimizationResult(resultList)
+        return resultList
+    
+    #----------------------------------------------------------------------
+    def getSerialEvaluate(self, strategyClass, targetName, historyData, vectorized=False):
+        """生成在当前进程中使用已经载入的历史数据依次回测的评估函数"""
+        def evaluate(taskList):
+            """在当前进程中依次回测，逐个返回(任务序号, 目标值)"""
+            for n, (setting, startDate, endDate) in enumerate(taskList):
+                d = self.runTask(strategyClass, setting, startDate, endDate, historyData, vectorized)
+                yield n, d.get(targetName, 0)
+        
+        return evaluate
+    
+    #----------------------------------------------------------------------
+    def runTask(self, strategyClass, setting, startDate, endDate, historyData, vectorized=False):
+        """使用已经载入的历史数据，在指定的日期范围上回测一组参数，返回回测结果"""
+        self.clearBacktestingResult()
+        self.output('-' * 30)
+        self.output('setting: %s, %s - %s' %(str(setting), startDate, endDate))
+        self.setStartDate(startDate, self.initDays)
+        self.setEndDate(endDate)
+        self.setHistoryData(historyData)
+        self.initStrategy(strategyClass, setting)
+        if vectorized:
+            self.runVectorizedBacktesting(loadData=False)
+        else:
+            self.runBacktesting(loadData=False)
+        return self.calculateBacktestingResult()
+    
+    #----------------------------------------------------------------------
+    def runSearch(self, strategyClass, optimizationSetting, evaluate, vectorized=False):
+        """
+        按照优化设置的搜索方法逐批生成回测任务并评估，返回[(参数, 目标值)]，按目标值从大到小排列
+        
+        evaluate为评估函数（vectorized表示其是否使用向量化回测），输入回测任务(参数, 开始日期, 结束日期)的列表，按完成的顺序
+        逐个返回(任务序号, 目标值)；每个结果立即追加保存到优化结果文件中，结果文件中已有的
+        任务不再评估；完整日期范围上的结果进入前N名时输出排行榜；超出优化设置的评估次数
+        或时间预算时提前停止
+        """
+        search = optimizationSetting.search
         targetName = optimizationSetting.optimizeTarget
         
         # 检查参数设置问题
-        if not settingList or not targetName:
+        if not optimizationSetting.paramDict or not targetName:
             self.output(u'优化设置有问题，请检查')
-        
-        # 遍历优化
-        resultList = []
-        for setting in settingList:
-            self.clearBacktestingResult()
-            self.output('-' * 30)
-            self.output('setting: %s' %str(setting))
-            self.initStrategy(strategyClass, setting)
-            self.runBacktesting()
-            d = self.calculateBacktestingResult()
-            try:
-                targetValue = d[targetName]
-            except KeyError:
-                targetValue = 0
-            resultList.append(([str(setting)], targetValue))
-        
-        # 显示结果
-        resultList.sort(reverse=True, key=lambda result:result[1])
+            return []
+        
+        maxEvaluation = optimizationSetting.maxEvaluation
+        maxTime = optimizationSetting.maxTime
+        leaderboard = Leaderboard(optimizationSetting.leaderboardSize)
+        
+        store = None
+        if optimizationSetting.resultFileName:
+            store = OptimizationResultStore(optimizationSetting.resultFileName)
+        
+        strategyKey = getStrategyKey(strategyClass)
+        engineKey = getEngineKey(self.__class__)
+        
+        search.clear()
+        startTime = _time()
+        count = 0           # 评估次数
+        skipCount = 0       # 从结果文件中读取的次数
+        stopped = False
+        
+        def addResult(task, targetValue):
+            """添加结果到搜索方法和排行榜，返回排行榜是否发生了变化"""
+            search.addResult(task, targetValue)
+            if task[1] == search.startDate and task[2] == search.endDate:
+                return leaderboard.add(task[0], targetValue)
+            return False
+        
+        def showLeaderboard():
+            """输出排行榜"""
+            self.output(u'排行榜（评估%s次，跳过%s次）：' %(count, skipCount))
+            for n, (setting, value) in enumerate(leaderboard.getResultList()):
+                self.output(u'%s. %s: %s' %(n+1, str(setting), value))
+        
+        try:
+            # 搜索方法是生成器，评估完一批任务并添加结果后才会生成下一批
+            for taskList in search.iterTask(optimizationSetting, self.startDate, self.endDate):
+                # 跳过之前已经评估过的任务
+                keyList = []
+                pendingList = []
+                changed = False
+                for task in taskList:
+                    key = self.getTaskKey(strategyKey, engineKey, task, targetName, vectorized)
+                    if store and key in store:
+                        if not skipCount:
+                            self.output(u'使用结果文件%s中已经保存的结果，跳过已经评估过的任务' 
+                                        %optimizationSetting.resultFileName)
+                        skipCount += 1
+                        changed = addResult(task, store.get(key)) or changed
+                    else:
+                        keyList.append(key)
+                        pendingList.append(task)
+                
+                if changed:
+                    showLeaderboard()
+                
+                if maxEvaluation:
+                    pendingList = pendingList[:maxEvaluation-count]
+                
+                for n, targetValue in evaluate(pendingList):
+                    count += 1
+                    task = pendingList[n]
+                    if store:
+                        store.add(keyList[n], task, targetValue)
+                    if addResult(task, targetValue):
+                        showLeaderboard()
+                    
+                    if maxTime and _time() - startTime >= maxTime:
+                        self.output(u'达到优化时间上限%s秒，停止优化' %maxTime)
+                        stopped = True
+                        break
+                
+                if maxEvaluation and count >= maxEvaluation:
+                    self.output(u'达到评估次数上限%s，停止优化' %maxEvaluation)
+                    stopped = True
+                
+                if stopped:
+                    break
+        finally:
+            if store:
+                store.close()
+        
+        self.output(u'优化完成，评估次数：%s，跳过已评估：%s，耗时：%.2f秒' %(count, skipCount, 
+                                                                   _time()-startTime))
+        return search.getResultList()
+    
+    #----------------------------------------------------------------------
+    def getTaskKey(self, strategyKey, engineKey, task, targetName, vectorized=False):
+        """
+        回测任务的键：策略类、回测引擎、参数、日期范围和其他回测设置的哈希值
+        没有设置结束日期时使用当天的日期，保证数据更新后重新评估
+        """
+        setting, startDate, endDate = task
+        
+        l = [strategyKey, engineKey, sorted(setting.items()), startDate, 
+             endDate or datetime.now().strftime('%Y%m%d'),
+             self.initDays, self.mode, self.dbName, self.symbol, 
+             self.size, self.rate, self.slippage, self.storageBackend, targetName,
+             vectorized, self.queueFillActive, self.getLatency(), self.slotDataActive]
+        return hashlib.md5(json.dumps(l)).hexdigest()
+    
+    #----------------------------------------------------------------------
+    def showOptimizationResult(self, resultList):
+        """显示优化结果"""
         self.output('-' * 30)
         self.output(u'优化结果：')
-        for result in resultList:
-            self.output(u'%s: %s' %(result[0], result[1]))
-        return result
-            
+        for setting, targetValue in resultList:
+            self.output(u'%s: %s' %(str(setting), targetValue))
+    
     #----------------------------------------------------------------------
     def clearBacktestingResult(self):
         """清空之前回测的结果"""
@@ -825,69 +1382,338 @@ class BacktestingEngine(object):
         self.limitOrderCount = 0
         self.limitOrderDict.clear()
         self.workingLimitOrderDict.clear()        
+        for index in self.limitOrderIndex.values():
+            index.clear()
         
         # 清空停止单相关
         self.stopOrderCount = 0
         self.stopOrderDict.clear()
         self.workingStopOrderDict.clear()
+        for index in self.stopOrderIndex.values():
+            index.clear()
         
         # 清空成交相关
         self.tradeCount = 0
         self.tradeDict.clear()
         
+        # 清空排队撮合相关
+        self.queueDict.clear()
+        self.pendingOrderQueue.clear()
+        self.pendingCancelQueue.clear()
+        self.lastTickVolume = 0
+        
     #----------------------------------------------------------------------
-    def runParallelOptimization(self, strategyClass, optimizationSetting):
-        """并行优化参数"""
-        # 获取优化设置        
-        settingList = optimizationSetting.generateSetting()
+    def runParallelOptimization(self, strategyClass, optimizationSetting, shareData=True):
+        """
+        并行优化参数
+        
+        shareData为True时，父进程只载入一次历史数据并保存为本地缓存，子进程以只读
+        内存映射的方式打开同一份文件（操作系统的页缓存在进程间共享），不再各自连接
+        数据库读取；为False时每个子进程各自从数据库载入
+        """
         targetName = optimizationSetting.optimizeTarget
         
-        # 检查参数设置问题
-        if not settingList or not targetName:
-            self.output(u'优化设置有问题，请检查')
+        sharedDataKey = ''
+        tempKey = ''
+        if shareData:
+            sharedDataKey, tempKey = self.shareHistoryData()
         
         # 多进程优化，启动一个对应CPU核心数量的进程池
         pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        l = []
-        for setting in settingList:
-            l.append(pool.apply_async(optimize, (strategyClass, setting,
-                                                 targetName, self.mode, 
-                                                 self.startDate, self.initDays, self.endDate,
-                                                 self.slippage, self.rate, self.size,
-                                                 self.dbName, self.symbol)))
-        pool.close()
-        pool.join()
-        
-        # 显示结果
-        resultList = [res.get() for res in l]
-        resultList.sort(reverse=True, key=lambda result:result[1])
+        evaluate = self.getParallelEvaluate(pool, strategyClass, targetName, sharedDataKey)
+        
+        try:
+            resultList = self.runSearch(strategyClass, optimizationSetting, evaluate)
+        finally:
+            # 提前停止时还有未完成的任务，直接结束子进程
+            pool.terminate()
+            pool.join()
+            
+            if tempKey:
+                removeColumnCache(tempKey)
+        
+        self.showOptimizationResult(resultList)
+        return resultList
+    
+    #----------------------------------------------------------------------
+    def shareHistoryData(self):
+        """
+        父进程载入历史数据用于子进程共享，返回(共享数据的缓存键, 临时缓存键)
+        不使用缓存或者使用Journal存储时保存到临时的缓存中，用完后需要删除
+        """
+        self.loadHistoryData()
+        
+        if self.cacheActive and self.storageBackend != STORAGE_JOURNAL:
+            sharedDataKey = getCacheKey(self.dbName, self.symbol, self.mode, self.startDate, self.endDate)
+            return sharedDataKey, ''
+        
+        tempKey = 'temp_%s' %os.getpid()
+        saveColumnCache(tempKey, self.historyData, len(self.historyData), '')
+        return tempKey, tempKey
+    
+    #----------------------------------------------------------------------
+    def getParallelEvaluate(self, pool, strategyClass, targetName, sharedDataKey):
+        """生成在进程池中并行回测的评估函数"""
+        def evaluate(taskList):
+            """在进程池中并行回测一批任务，按完成的顺序逐个返回(任务序号, 目标值)"""
+            argsList = []
+            for n, (setting, startDate, endDate) in enumerate(taskList):
+                argsList.append((n, (strategyClass, setting,
+                                     targetName, self.mode, 
+                                     startDate, self.initDays, endDate,
+                                     self.slippage, self.rate, self.size,
+                                     self.dbName, self.symbol, sharedDataKey,
+                                     self.queueFillActive, self.getLatency(), self.slotDataActive,
+                                     self.storageBackend, self.journalPath)))
+            return pool.imap_unordered(optimizeTask, argsList)
+        
+        return evaluate
+    
+    #----------------------------------------------------------------------
+    def runWalkForward(self, strategyClass, optimizationSetting, inSampleDays, outSampleDays, 
+                       parallel=True):
+        """
+        滚动窗口（walk-forward）优化
+        
+        历史数据只载入一次，按照样本内inSampleDays天、样本外outSampleDays天切分为滚动的窗口，
+        每次向后滚动outSampleDays天；在每个窗口的样本内优化参数（parallel为True时使用进程池，
+        子进程共享同一份历史数据），再用目标值最高的参数在紧接着的样本外回测（样本外开始之前的
+        initDays天用于初始化）。返回的字典中包括所有样本外交易合并计算的回测结果，
+        以及windowList：每个窗口的日期范围、选中的参数、样本内和样本外的目标值
+        """
+        targetName = optimizationSetting.optimizeTarget
+        startDate, endDate = self.startDate, self.endDate
+        
+        sharedDataKey = ''
+        tempKey = ''
+        pool = None
+        if parallel:
+            sharedDataKey, tempKey = self.shareHistoryData()
+            pool = multiprocessing.Pool(multiprocessing.cpu_count())
+            evaluate = self.getParallelEvaluate(pool, strategyClass, targetName, sharedDataKey)
+        else:
+            self.loadHistoryData()
+            evaluate = self.getSerialEvaluate(strategyClass, targetName, self.historyData)
+        
+        historyData = self.historyData
+        
+        # 根据历史数据的实际范围生成窗口
+        windowList = []
+        if len(historyData):
+            dataStart = self.dataStartDate
+            dataEnd = historyData.getColumn('datetime')[-1].item()
+            
+            windowStart = dataStart
+            while windowStart + timedelta(inSampleDays) < dataEnd:
+                outSampleStart = windowStart + timedelta(inSampleDays)
+                outSampleEnd = outSampleStart + timedelta(outSampleDays)
+                windowList.append({'inSampleStart': windowStart.strftime('%Y%m%d'),
+                                   'inSampleEnd': outSampleStart.strftime('%Y%m%d'),
+                                   'outSampleStart': outSampleStart.strftime('%Y%m%d'),
+                                   'outSampleEnd': outSampleEnd.strftime('%Y%m%d')})
+                windowStart += timedelta(outSampleDays)
+        
+        timeList = []
+        pnlList = []
+        totalTurnover = 0
+        totalCommission = 0
+        totalSlippage = 0
+        
+        try:
+            for window in windowList:
+                self.output('=' * 30)
+                self.output(u'样本内：%s - %s，样本外：%s - %s' %(window['inSampleStart'], window['inSampleEnd'],
+                                                         window['outSampleStart'], window['outSampleEnd']))
+                
+                # 样本内优化
+                self.setStartDate(window['inSampleStart'], self.initDays)
+                self.setEndDate(window['inSampleEnd'])
+                resultList = self.runSearch(strategyClass, optimizationSetting, evaluate)
+                if not resultList:
+                    continue
+                
+                setting, inSampleValue = resultList[0]
+                
+                # 样本外回测，开始日期向前推initDays天用于初始化
+                testStart = datetime.strptime(window['outSampleStart'], '%Y%m%d') - timedelta(self.initDays)
+                d = self.runTask(strategyClass, setting, testStart.strftime('%Y%m%d'), 
+                                 window['outSampleEnd'], historyData)
+                
+                window['setting'] = setting
+                window['inSampleValue'] = inSampleValue
+                window['outSampleValue'] = d.get(targetName, 0)
+                window['outSampleCapital'] = d.get('capital', 0)
+                window['outSampleTrades'] = d.get('totalResult', 0)
+                
+                if d:
+                    timeList.extend(d['timeList'])
+                    pnlList.extend(d['pnlList'])
+                    totalTurnover += d['totalTurnover']
+                    totalCommission += d['totalCommission']
+                    totalSlippage += d['totalSlippage']
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            
+            if tempKey:
+                removeColumnCache(tempKey)
+            
+            # 恢复原来的回测日期范围
+            self.setStartDate(startDate, self.initDays)
+            self.setEndDate(endDate)
+            self.setHistoryData(historyData)
+        
+        windowList = [window for window in windowList if 'setting' in window]
+        
+        if timeList:
+            result = calculateTradeStatistics(timeList, pnlList, totalTurnover, totalCommission, totalSlippage)
+        else:
+            result = {}
+        result['windowList'] = windowList
+        
+        self.showWalkForwardResult(result)
+        return result
+    
+    #----------------------------------------------------------------------
+    def showWalkForwardResult(self, result):
+        """显示滚动窗口优化的结果"""
+        self.output('=' * 30)
+        self.output(u'滚动窗口优化结果：')
+        for window in result['windowList']:
+            self.output(u'%s - %s\t%s\t样本内：%s\t样本外：%s\t样本外盈亏：%s\t成交：%s' %(
+                window['outSampleStart'], window['outSampleEnd'], str(window['setting']),
+                window['inSampleValue'], window['outSampleValue'], 
+                formatNumber(window['outSampleCapital']), window['outSampleTrades']))
+        
+        if 'capital' not in result:
+            self.output(u'样本外没有成交')
+            return
+        
         self.output('-' * 30)
-        self.output(u'优化结果：')
-        for result in resultList:
-            self.output(u'%s: %s' %(result[0], result[1]))    
+        self.output('Total Trades：\t%s' % formatNumber(result['totalResult']))
+        self.output('Total Return：\t%s' % formatNumber(result['capital']))
+        self.output('Maximum Drawdown: \t%s' % formatNumber(result['maxDrawdown']))
+        self.output('Win Ratio\t\t%s%%' %formatNumber(result['winningRate']))
+        self.output('Sharpe Ratio：\t%s' %formatNumber(result['sharpeRatio']))
         
 
+#----------------------------------------------------------------------
+def calculateTradeStatistics(timeList, pnl, totalTurnover=0, totalCommission=0, totalSlippage=0,
+                             annualDays=ANNUAL_DAYS):
+    """
+    基于每笔交易的平仓时间和净盈亏数组计算回测的统计结果
+
+    除了资金曲线、回撤和胜率等结果之外，还包括按平仓日期汇总的每日盈亏、
+    基于每日盈亏计算的夏普比率（年化，只统计有平仓交易的日期）、最大回撤和最长回撤时间
+    """
+    pnl = np.asarray(pnl, dtype=np.float64)
+    count = len(pnl)
+    
+    # 资金曲线和回撤（资金从0开始，最高净值不低于0）
+    capital = np.cumsum(pnl)
+    maxCapital = np.maximum.accumulate(np.maximum(capital, 0))
+    drawdown = capital - maxCapital
+    
+    # 最长回撤时间：每笔交易距离之前最近一次资金创新高的时间，之前没有创新高时从第一笔交易开始计算
+    dt = np.array(timeList, dtype='datetime64[us]')
+    index = np.arange(count)
+    highIndex = np.maximum.accumulate(np.where(drawdown >= 0, index, 0))
+    maxDrawdownDuration = (dt - dt[highIndex]).max().item()
+    
+    # 盈亏相关数据
+    winning = pnl[pnl >= 0]
+    losing = pnl[pnl < 0]
+    
+    winningRate = len(winning)/count*100                    # 胜率
+    averageWinning = winning.mean() if len(winning) else 0  # 平均每笔盈利
+    averageLosing = losing.mean() if len(losing) else 0     # 平均每笔亏损
+    profitLossRatio = -averageWinning/averageLosing if averageLosing else 0    # 盈亏比
+    
+    # 按平仓日期汇总每日盈亏
+    dateArray, dateIndex = np.unique(dt.astype('datetime64[D]'), return_inverse=True)
+    dailyPnl = np.bincount(dateIndex, weights=pnl)
+    
+    sharpeRatio = 0
+    if len(dailyPnl) > 1:
+        std = dailyPnl.std(ddof=1)
+        if std:
+            sharpeRatio = dailyPnl.mean() / std * np.sqrt(annualDays)
+    
+    # 返回回测结果
+    d = {}
+    d['capital'] = capital[-1]
+    d['maxCapital'] = maxCapital[-1]
+    d['drawdown'] = drawdown[-1]
+    d['totalResult'] = count
+    d['totalTurnover'] = totalTurnover
+    d['totalCommission'] = totalCommission
+    d['totalSlippage'] = totalSlippage
+    d['timeList'] = list(timeList)
+    d['pnlList'] = pnl.tolist()
+    d['capitalList'] = capital.tolist()
+    d['drawdownList'] = drawdown.tolist()
+    d['winningRate'] = winningRate
+    d['averageWinning'] = averageWinning
+    d['averageLosing'] = averageLosing
+    d['profitLossRatio'] = profitLossRatio
+    d['maxDrawdown'] = drawdown.min()
+    d['maxDrawdownDuration'] = maxDrawdownDuration
+    d['dateList'] = dateArray.tolist()
+    d['dailyPnlList'] = dailyPnl.tolist()
+    d['sharpeRatio'] = sharpeRatio
+    
+    return d
+
+
 ########################################################################
-class TradingResult(object):
-    """每笔交易的结果"""
+class OrderPriceIndex(object):
+    """
+    单个方向上活动委托的价格索引
+    
+    按照(价格, 委托序号, 委托编号)从小到大排列，撮合时通过二分查找取出价格满足条件的委托，
+    无需遍历所有的活动委托
+    """
 
     #----------------------------------------------------------------------
-    def __init__(self, entryPrice, entryDt, exitPrice, 
-                 exitDt, volume, rate, slippage, size):
+    def __init__(self):
         """Constructor"""
-        self.entryPrice = entryPrice    # 开仓价格
-        self.exitPrice = exitPrice      # 平仓价格
-        
-        self.entryDt = entryDt          # 开仓时间datetime    
-        self.exitDt = exitDt            # 平仓时间
-        
-        self.volume = volume    # 交易数量（+/-代表方向）
+        self.keyList = []
+    
+    #----------------------------------------------------------------------
+    def __len__(self):
+        """委托数量"""
+        return len(self.keyList)
         
-        self.turnover = (self.entryPrice+self.exitPrice)*size*abs(volume)   # 成交金额
-        self.commission = self.turnover*rate                                # 手续费成本
-        self.slippage = slippage*2*size*abs(volume)                         # 滑点成本
-        self.pnl = ((self.exitPrice - self.entryPrice) * volume * size 
-                    - self.commission - self.slippage)                      # 净盈亏
+    #----------------------------------------------------------------------
+    def add(self, price, seq, orderID):
+        """添加委托，seq为委托序号（发单顺序）"""
+        insort(self.keyList, (price, seq, orderID))
+    
+    #----------------------------------------------------------------------
+    def remove(self, price, seq, orderID):
+        """删除委托"""
+        key = (price, seq, orderID)
+        i = bisect_left(self.keyList, key)
+        if i < len(self.keyList) and self.keyList[i] == key:
+            del self.keyList[i]
+    
+    #----------------------------------------------------------------------
+    def getAbove(self, price):
+        """获取价格大于等于price的委托，返回(委托序号, 委托编号)的列表"""
+        i = bisect_left(self.keyList, (price,))
+        return [key[1:] for key in self.keyList[i:]]
+    
+    #----------------------------------------------------------------------
+    def getBelow(self, price):
+        """获取价格小于等于price的委托，返回(委托序号, 委托编号)的列表"""
+        i = bisect_right(self.keyList, (price, INFINITY))
+        return [key[1:] for key in self.keyList[:i]]
+    
+    #----------------------------------------------------------------------
+    def clear(self):
+        """清空"""
+        del self.keyList[:]
 
 
 ########################################################################
@@ -901,6 +1727,13 @@ class OptimizationSetting(object):
         
         self.optimizeTarget = ''        # 优化目标字段
         
+        self.search = GridSearch()      # 参数搜索方法，默认遍历所有参数组合
+        self.maxEvaluation = 0          # 最大评估次数，0为不限制
+        self.maxTime = 0                # 最长优化时间（秒），0为不限制
+        
+        self.leaderboardSize = 10       # 排行榜显示的数量，0为不显示
+        self.resultFileName = ''        # 优化结果文件，为空时不保存
+        
     #----------------------------------------------------------------------
     def addParameter(self, name, start, end, step):
         """增加优化参数"""
@@ -924,25 +1757,403 @@ class OptimizationSetting(object):
     #----------------------------------------------------------------------
     def generateSetting(self):
         """生成优化参数组合"""
+        return list(self.iterSetting())
+    
+    #----------------------------------------------------------------------
+    def iterSetting(self):
+        """按顺序逐个生成优化参数组合，不一次性生成所有组合"""
         # 参数名的列表
         nameList = self.paramDict.keys()
         paramList = self.paramDict.values()
         
-        # 使用迭代工具生产参数对组合
-        productList = list(product(*paramList))
-        
-        # 把参数对组合打包到一个个字典组成的列表中
-        settingList = []
-        for p in productList:
-            d = dict(zip(nameList, p))
-            settingList.append(d)
+        # 使用迭代工具生产参数对组合，打包为字典
+        for p in product(*paramList):
+            yield dict(zip(nameList, p))
+    
+    #----------------------------------------------------------------------
+    def getSettingCount(self):
+        """参数组合的总数"""
+        count = 1
+        for l in self.paramDict.values():
+            count *= len(l)
+        return count
     
-        return settingList
+    #----------------------------------------------------------------------
+    def getSetting(self, indexList):
+        """根据每个参数取值的序号生成参数组合"""
+        return dict((name, l[i]) for (name, l), i in zip(self.paramDict.items(), indexList))
     
     #----------------------------------------------------------------------
     def setOptimizeTarget(self, target):
         """设置优化目标字段"""
         self.optimizeTarget = target
+        
+    #----------------------------------------------------------------------
+    def setSearch(self, search):
+        """设置参数搜索方法（GridSearch、RandomSearch、SuccessiveHalvingSearch、GeneticSearch）"""
+        self.search = search
+        
+    #----------------------------------------------------------------------
+    def setBudget(self, maxEvaluation=0, maxTime=0):
+        """设置优化预算：最大评估次数和最长优化时间（秒），0为不限制"""
+        self.maxEvaluation = maxEvaluation
+        self.maxTime = maxTime
+        
+    #----------------------------------------------------------------------
+    def setLeaderboardSize(self, size):
+        """设置优化过程中排行榜显示的数量，0为不显示"""
+        self.leaderboardSize = size
+        
+    #----------------------------------------------------------------------
+    def setResultFile(self, fileName):
+        """
+        设置优化结果文件，每行保存一个回测任务的结果，重新运行优化时跳过已经评估过的任务，
+        为空时不保存结果，也不跳过已经评估过的任务
+        
+        任务的键包括策略类（和父类）、回测引擎的源代码和回测设置，不包括策略使用的其他模块
+        （如ctaIndicator）和数据库中的数据，这些内容修改后需要删除结果文件或者使用新的文件
+        """
+        self.resultFileName = fileName
+
+
+########################################################################
+class Leaderboard(object):
+    """优化结果排行榜，保存目标值最高的size个结果"""
+    
+    #----------------------------------------------------------------------
+    def __init__(self, size):
+        """Constructor"""
+        self.size = size
+        self.resultList = []        # (参数, 目标值)，按目标值从大到小排列
+        
+    #----------------------------------------------------------------------
+    def add(self, setting, targetValue):
+        """添加结果，返回排行榜是否发生了变化"""
+        if not self.size:
+            return False
+        
+        if len(self.resultList) >= self.size and targetValue <= self.resultList[-1][1]:
+            return False
+        
+        # 目标值相同时先加入的排在前面
+        i = 0
+        while i < len(self.resultList) and self.resultList[i][1] >= targetValue:
+            i += 1
+        
+        self.resultList.insert(i, (setting, targetValue))
+        del self.resultList[self.size:]
+        return True
+    
+    #----------------------------------------------------------------------
+    def getResultList(self):
+        """[(参数, 目标值)]"""
+        return list(self.resultList)
+
+
+########################################################################
+class OptimizationResultStore(object):
+    """
+    优化结果文件，每行为一个回测任务结果的json，包括任务的键、参数、日期范围和目标值
+    
+    每个结果写入后立即刷新到磁盘，优化中途退出时已经完成的结果不会丢失
+    """
+    
+    #----------------------------------------------------------------------
+    def __init__(self, fileName):
+        """Constructor"""
+        self.fileName = fileName
+        self.resultDict = {}        # key为任务的键，value为目标值
+        
+        if os.path.exists(fileName):
+            with open(fileName) as f:
+                for line in f:
+                    # 忽略中途退出时没有写完整的行
+                    try:
+                        d = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.resultDict[d['key']] = d['targetValue']
+        
+        self.file = open(fileName, 'a')
+        
+    #----------------------------------------------------------------------
+    def __contains__(self, key):
+        """是否已经评估过"""
+        return key in self.resultDict
+    
+    #----------------------------------------------------------------------
+    def get(self, key):
+        """获取目标值"""
+        return self.resultDict[key]
+    
+    #----------------------------------------------------------------------
+    def add(self, key, task, targetValue):
+        """追加一个结果"""
+        setting, startDate, endDate = task
+        self.resultDict[key] = targetValue
+        
+        d = {'key': key,
+             'setting': setting,
+             'startDate': startDate,
+             'endDate': endDate,
+             'targetValue': targetValue}
+        self.file.write(json.dumps(d) + '\n')
+        self.file.flush()
+    
+    #----------------------------------------------------------------------
+    def close(self):
+        """关闭文件"""
+        self.file.close()
+
+
+########################################################################
+class GridSearch(object):
+    """
+    网格搜索，按顺序遍历所有参数组合
+    
+    搜索方法的接口：
+    iterTask为生成器，每次生成一批回测任务(参数, 开始日期, 结束日期)的列表，
+    优化引擎评估完一批任务并通过addResult添加结果后，再生成下一批；
+    getResultList返回完整日期范围上的评估结果[(参数, 目标值)]，按目标值从大到小排列
+    """
+    
+    #----------------------------------------------------------------------
+    def __init__(self, batchSize=100):
+        """Constructor"""
+        self.batchSize = batchSize      # 每批任务的数量
+        self.startDate = ''             # 完整的回测日期范围
+        self.endDate = ''
+        self.resultDict = OrderedDict() # key为(参数的键, 开始日期, 结束日期)，value为目标值
+        self.settingDict = {}           # key为参数的键，value为参数字典
+        
+    #----------------------------------------------------------------------
+    def clear(self):
+        """清空之前的搜索结果"""
+        self.resultDict.clear()
+        self.settingDict.clear()
+        
+    #----------------------------------------------------------------------
+    def iterTask(self, optimizationSetting, startDate, endDate):
+        """生成回测任务"""
+        self.startDate = startDate
+        self.endDate = endDate
+        return self.iterBatch(optimizationSetting.iterSetting(), startDate, endDate)
+    
+    #----------------------------------------------------------------------
+    def iterBatch(self, settingIterator, startDate, endDate):
+        """把参数逐个生成的参数组合分批打包为回测任务"""
+        taskList = []
+        for setting in settingIterator:
+            taskList.append((setting, startDate, endDate))
+            if len(taskList) >= self.batchSize:
+                yield taskList
+                taskList = []
+        if taskList:
+            yield taskList
+    
+    #----------------------------------------------------------------------
+    def addResult(self, task, targetValue):
+        """添加回测任务的结果"""
+        setting, startDate, endDate = task
+        key = getSettingKey(setting)
+        self.settingDict[key] = setting
+        self.resultDict[(key, startDate, endDate)] = targetValue
+        
+    #----------------------------------------------------------------------
+    def getResult(self, setting, startDate, endDate):
+        """获取已经评估过的结果，没有时返回None"""
+        return self.resultDict.get((getSettingKey(setting), startDate, endDate))
+    
+    #----------------------------------------------------------------------
+    def getResultList(self):
+        """完整日期范围上的评估结果，按目标值从大到小排列"""
+        resultList = [(self.settingDict[key], targetValue) 
+                      for (key, startDate, endDate), targetValue in self.resultDict.items()
+                      if startDate == self.startDate and endDate == self.endDate]
+        resultList.sort(reverse=True, key=lambda result:result[1])
+        return resultList
+
+
+########################################################################
+class RandomSearch(GridSearch):
+    """随机搜索，从所有参数组合中不重复地随机抽取sampleCount个评估"""
+    
+    #----------------------------------------------------------------------
+    def __init__(self, sampleCount=100, seed=None, batchSize=100):
+        """Constructor"""
+        super(RandomSearch, self).__init__(batchSize)
+        self.sampleCount = sampleCount
+        self.seed = seed
+        
+    #----------------------------------------------------------------------
+    def iterTask(self, optimizationSetting, startDate, endDate):
+        """生成回测任务"""
+        self.startDate = startDate
+        self.endDate = endDate
+        settingIterator = iterRandomSetting(optimizationSetting, self.sampleCount, Random(self.seed))
+        return self.iterBatch(settingIterator, startDate, endDate)
+        
+
+########################################################################
+class SuccessiveHalvingSearch(GridSearch):
+    """
+    逐次减半搜索
+    
+    先随机抽取sampleCount个参数组合，在最近的一段较短的日期范围上评估，
+    保留目标值最高的1/eta进入下一轮，日期范围扩大eta倍，最后一轮使用完整的日期范围
+    """
+    
+    #----------------------------------------------------------------------
+    def __init__(self, sampleCount=81, eta=3, roundCount=4, seed=None):
+        """Constructor"""
+        super(SuccessiveHalvingSearch, self).__init__()
+        self.sampleCount = sampleCount
+        self.eta = eta
+        self.roundCount = roundCount
+        self.seed = seed
+        
+    #----------------------------------------------------------------------
+    def iterTask(self, optimizationSetting, startDate, endDate):
+        """生成回测任务"""
+        self.startDate = startDate
+        self.endDate = endDate
+        return self.iterRound(optimizationSetting, startDate, endDate)
+    
+    #----------------------------------------------------------------------
+    def iterRound(self, optimizationSetting, startDate, endDate):
+        """逐轮生成回测任务，根据上一轮的结果筛选参数"""
+        settingList = list(iterRandomSetting(optimizationSetting, self.sampleCount, Random(self.seed)))
+        
+        # 没有设置结束日期时使用今天作为日期范围的终点
+        start = datetime.strptime(startDate, '%Y%m%d')
+        end = datetime.strptime(endDate, '%Y%m%d') if endDate else datetime.now()
+        
+        for n in range(self.roundCount):
+            # 最后一轮使用完整的日期范围，之前每轮使用最近的1/eta^k
+            if n == self.roundCount - 1:
+                roundStartDate, roundEndDate = startDate, endDate
+            else:
+                fraction = self.eta ** -(self.roundCount - 1 - n)
+                roundStart = end - timedelta(days=int((end - start).days * fraction))
+                roundStartDate, roundEndDate = roundStart.strftime('%Y%m%d'), endDate
+            
+            yield [(setting, roundStartDate, roundEndDate) for setting in settingList]
+            
+            # 保留目标值最高的1/eta
+            settingList.sort(reverse=True, key=lambda setting: self.getResult(setting, roundStartDate, roundEndDate))
+            settingList = settingList[:max(1, len(settingList)//self.eta)]
+
+
+########################################################################
+class GeneticSearch(GridSearch):
+    """
+    遗传算法搜索
+    
+    每个个体为各参数取值的序号，每一代通过锦标赛选择、均匀交叉和随机变异生成新的个体，
+    保留目标值最高的eliteCount个个体直接进入下一代，已经评估过的参数组合不会重复评估
+    """
+    
+    #----------------------------------------------------------------------
+    def __init__(self, populationSize=30, generationCount=20, crossoverRate=0.8, 
+                 mutationRate=0.2, eliteCount=2, tournamentSize=3, seed=None):
+        """Constructor"""
+        super(GeneticSearch, self).__init__()
+        self.populationSize = populationSize
+        self.generationCount = generationCount
+        self.crossoverRate = crossoverRate
+        self.mutationRate = mutationRate
+        self.eliteCount = eliteCount
+        self.tournamentSize = tournamentSize
+        self.seed = seed
+        
+    #----------------------------------------------------------------------
+    def iterTask(self, optimizationSetting, startDate, endDate):
+        """生成回测任务"""
+        self.startDate = startDate
+        self.endDate = endDate
+        return self.iterGeneration(optimizationSetting, startDate, endDate)
+    
+    #----------------------------------------------------------------------
+    def iterGeneration(self, optimizationSetting, startDate, endDate):
+        """逐代生成需要评估的新个体"""
+        rnd = Random(self.seed)
+        sizeList = [len(l) for l in optimizationSetting.paramDict.values()]
+        
+        def getValue(individual):
+            return self.getResult(optimizationSetting.getSetting(individual), startDate, endDate)
+        
+        def select(population):
+            """锦标赛选择"""
+            candidateList = [rnd.choice(population) for n in range(self.tournamentSize)]
+            return max(candidateList, key=getValue)
+        
+        # 初始种群为随机抽取的参数组合
+        population = [[rnd.randrange(size) for size in sizeList] for n in range(self.populationSize)]
+        
+        for generation in range(self.generationCount):
+            # 只评估新的参数组合
+            settingDict = {}
+            for individual in population:
+                setting = optimizationSetting.getSetting(individual)
+                if getValue(individual) is None:
+                    settingDict[getSettingKey(setting)] = setting
+            
+            if settingDict:
+                yield [(setting, startDate, endDate) for setting in settingDict.values()]
+            
+            if generation == self.generationCount - 1:
+                break
+            
+            # 精英直接进入下一代
+            population.sort(reverse=True, key=getValue)
+            newPopulation = [list(individual) for individual in population[:self.eliteCount]]
+            
+            while len(newPopulation) < self.populationSize:
+                child = list(select(population))
+                
+                # 均匀交叉
+                if rnd.random() < self.crossoverRate:
+                    other = select(population)
+                    child = [a if rnd.random() < 0.5 else b for a, b in zip(child, other)]
+                
+                # 随机变异
+                for i, size in enumerate(sizeList):
+                    if rnd.random() < self.mutationRate:
+                        child[i] = rnd.randrange(size)
+                
+                newPopulation.append(child)
+            
+            population = newPopulation
+
+
+#----------------------------------------------------------------------
+def getOrderType(direction, offset):
+    """根据方向和开平获取CTA委托类型"""
+    if direction == DIRECTION_LONG:
+        return CTAORDER_BUY if offset == OFFSET_OPEN else CTAORDER_COVER
+    else:
+        return CTAORDER_SHORT if offset == OFFSET_OPEN else CTAORDER_SELL
+
+#----------------------------------------------------------------------
+def getSettingKey(setting):
+    """参数字典的键，用于判断参数组合是否相同"""
+    return tuple(sorted(setting.items()))
+
+
+#----------------------------------------------------------------------
+def iterRandomSetting(optimizationSetting, sampleCount, rnd):
+    """从所有参数组合中不重复地随机抽取sampleCount个，不生成全部组合"""
+    sizeList = [len(l) for l in optimizationSetting.paramDict.values()]
+    total = optimizationSetting.getSettingCount()
+    
+    for index in rnd.sample(xrange(total), min(sampleCount, total)):
+        # 把组合的序号转换为每个参数取值的序号（最后一个参数变化最快，和product的顺序一致）
+        indexList = []
+        for size in reversed(sizeList):
+            index, i = divmod(index, size)
+            indexList.append(i)
+        indexList.reverse()
+        yield optimizationSetting.getSetting(indexList)
 
 
 #----------------------------------------------------------------------
@@ -956,15 +2167,28 @@ def formatNumber(n):
 def optimize(strategyClass, setting, targetName,
              mode, startDate, initDays, endDate,
              slippage, rate, size,
-             dbName, symbol):
+             dbName, symbol, sharedDataKey='',
+             queueFillActive=False, latency=0, slotDataActive=False,
+             storageBackend='', journalPath=''):
     """多进程优化时跑在每个进程中运行的函数"""
     engine = BacktestingEngine()
     engine.setBacktestingMode(mode)
     engine.setStartDate(startDate, initDays)
+    engine.setEndDate(endDate)
     engine.setSlippage(slippage)
-    engine.setRate(rate)
+    engine.setCommission(rate)
     engine.setSize(size)
     engine.setDatabase(dbName, symbol)
+    engine.setQueueFillActive(queueFillActive, latency)
+    engine.setSlotDataActive(slotDataActive)
+    if storageBackend:
+        engine.setStorageBackend(storageBackend, journalPath)
+    
+    # 使用父进程共享的历史数据，否则和原来一样各自从数据库载入
+    if sharedDataKey:
+        engine.setSharedData(sharedDataKey)
+    else:
+        engine.setCacheActive(False)
     
     engine.initStrategy(strategyClass, setting)
     engine.runBacktesting()
@@ -975,6 +2199,295 @@ def optimize(strategyClass, setting, targetName,
         targetValue = 0            
     return (str(setting), targetValue)    
 
+#----------------------------------------------------------------------
+def getStrategyKey(strategyClass):
+    """
+    策略类的键，包括模块名、类名和策略类（包括父类，如CtaTemplate）源代码的哈希值，
+    策略代码修改后之前的优化结果不再使用
+    """
+    md5 = hashlib.md5()
+    for cls in inspect.getmro(strategyClass):
+        if cls is object:
+            continue
+        try:
+            md5.update(inspect.getsource(cls))
+        except (IOError, TypeError):
+            md5.update(cls.__name__)
+    
+    return '%s.%s.%s' %(strategyClass.__module__, strategyClass.__name__, md5.hexdigest())
+
+#----------------------------------------------------------------------
+def getEngineKey(engineClass):
+    """
+    回测引擎的键：引擎类（包括父类）、价格索引和回测结果计算源代码的哈希值，
+    撮合或者结果计算的逻辑修改后之前的优化结果不再使用
+    """
+    objList = [cls for cls in inspect.getmro(engineClass) if cls is not object]
+    objList.extend([OrderPriceIndex, calculateTradeStatistics])
+    
+    md5 = hashlib.md5()
+    for obj in objList:
+        try:
+            md5.update(inspect.getsource(obj))
+        except (IOError, TypeError):
+            md5.update(obj.__name__)
+    return md5.hexdigest()
+
+#----------------------------------------------------------------------
+def optimizeTask(args):
+    """进程池imap_unordered使用的函数，args为(任务序号, optimize的参数)，返回(任务序号, 目标值)"""
+    n, optimizeArgs = args
+    return n, optimize(*optimizeArgs)[1]
+
+#----------------------------------------------------------------------
+def benchmarkParallelOptimization(shareData, dbName=MINUTE_DB_NAME, symbol='IF0000',
+                                  startDate='20140101', endDate=''):
+    """
+    并行优化的性能测试：统计总耗时和父进程、子进程的峰值内存占用
+    
+    由于子进程的内存统计在同一进程中会累计，shareData为True和False两种情况
+    需要分别在单独的python进程中运行以便对比，例如：
+    python -c "from ctaBacktesting import *; benchmarkParallelOptimization(False)"
+    
+    注意共享数据时子进程的RSS中包含了内存映射文件的页面，这部分内存在进程间共享，
+    实际占用的物理内存要小于子进程RSS之和
+    """
+    import resource
+    from ctaDemo import DoubleEmaDemo
+    
+    engine = BacktestingEngine()
+    engine.setBacktestingMode(engine.BAR_MODE)
+    engine.setStartDate(startDate)
+    engine.setEndDate(endDate)
+    engine.setSlippage(0.2)
+    engine.setCommission(0.3/10000)
+    engine.setSize(300)
+    engine.setDatabase(dbName, symbol)
+    
+    setting = OptimizationSetting()
+    setting.setOptimizeTarget('capital')
+    setting.addParameter('fastK', 0.1, 0.9, 0.1)
+    setting.addParameter('slowK', 0.01, 0.09, 0.01)
+    
+    start = _time()
+    engine.runParallelOptimization(DoubleEmaDemo, setting, shareData)
+    cost = _time() - start
+    
+    # Linux下ru_maxrss的单位为KB
+    parentRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    childRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    
+    print u'共享数据：%s' %shareData
+    print u'总耗时：%.2f秒' %cost
+    print u'父进程峰值内存：%.1fMB，子进程最大峰值内存：%.1fMB，进程数：%s' %(parentRss, childRss,
+                                                         multiprocessing.cpu_count())
+
+
+#----------------------------------------------------------------------
+def benchmarkOrderMatching(orderCount=1000, tickCount=1000000, priceTick=0.2, seed=0):
+    """
+    委托撮合的性能测试：网格策略在tick模式下保持orderCount个活动限价单，
+    推送tickCount个随机游走的tick，统计撮合的耗时
+    
+    作为对比，在前10000个tick上统计遍历所有活动委托判断是否成交（价格索引之前的撮合方式）
+    的耗时，并按比例估算全部tick的耗时
+    """
+    from ctaTemplate import CtaTemplate
+    
+    basePrice = 3000.0
+    
+    class GridStrategy(CtaTemplate):
+        """网格策略，成交后在反方向挂单，保持活动委托的数量不变"""
+        className = 'GridStrategy'
+        
+        def onInit(self):
+            pass
+        
+        def onStart(self):
+            for n in range(orderCount//2):
+                self.buy(basePrice - priceTick*(n+1), 1)
+                self.short(basePrice + priceTick*(n+1), 1)
+        
+        def onTick(self, tick):
+            pass
+        
+        def onOrder(self, order):
+            pass
+        
+        def onTrade(self, trade):
+            if trade.direction == DIRECTION_LONG:
+                self.short(trade.price + priceTick, 1)
+            else:
+                self.buy(trade.price - priceTick, 1)
+    
+    engine = BacktestingEngine()
+    engine.setBacktestingMode(engine.TICK_MODE)
+    engine.initStrategy(GridStrategy)
+    engine.startStrategy()
+    
+    np.random.seed(seed)
+    priceList = (basePrice + np.cumsum(np.random.randint(-1, 2, tickCount)) * priceTick).tolist()
+    
+    tick = CtaTickData()
+    tick.datetime = datetime(2010, 1, 4, 9, 0)
+    
+    # 遍历所有活动委托的撮合方式（只判断是否成交，不处理成交）
+    scanCount = min(tickCount, 10000)
+    start = _time()
+    for price in priceList[:scanCount]:
+        askPrice = price + priceTick
+        bidPrice = price - priceTick
+        for orderID, order in engine.workingLimitOrderDict.items():
+            buyCross = order.direction==DIRECTION_LONG and order.price>=askPrice
+            sellCross = order.direction==DIRECTION_SHORT and order.price<=bidPrice
+    scanCost = (_time() - start) * tickCount / scanCount
+    
+    start = _time()
+    for price in priceList:
+        tick.lastPrice = price
+        tick.askPrice1 = price + priceTick
+        tick.bidPrice1 = price - priceTick
+        engine.newTick(tick)
+    cost = _time() - start
+    
+    print u'活动委托数：%s，tick数：%s，成交笔数：%s' %(len(engine.workingLimitOrderDict), tickCount,
+                                              len(engine.tradeDict))
+    print u'价格索引撮合耗时：%.2f秒，每秒处理%.0f个tick' %(cost, tickCount/cost)
+    print u'遍历全部委托估算耗时（仅判断成交）：%.2f秒' %scanCost
+
+
+#----------------------------------------------------------------------
+def benchmarkBacktestingResult(tradeCount=500000, seed=0):
+    """
+    回测结果计算的性能测试：生成tradeCount笔随机方向和数量的成交（包含大量部分平仓），
+    统计calculateBacktestingResult的耗时
+    """
+    engine = BacktestingEngine()
+    engine.setSize(300)
+    engine.setCommission(0.3/10000)
+    engine.setSlippage(0.2)
+    
+    np.random.seed(seed)
+    directionList = np.random.randint(0, 2, tradeCount).tolist()
+    volumeList = np.random.randint(1, 10, tradeCount).tolist()
+    priceList = (3000 + np.cumsum(np.random.randn(tradeCount))).tolist()
+    
+    dt = datetime(2010, 1, 4, 9, 0)
+    delta = timedelta(seconds=30)
+    for n in xrange(tradeCount):
+        trade = VtTradeData()
+        trade.tradeID = str(n+1)
+        trade.direction = DIRECTION_LONG if directionList[n] else DIRECTION_SHORT
+        trade.price = priceList[n]
+        trade.volume = volumeList[n]
+        trade.dt = dt
+        engine.tradeDict[trade.tradeID] = trade
+        dt += delta
+    
+    start = _time()
+    d = engine.calculateBacktestingResult()
+    cost = _time() - start
+    
+    print u'成交笔数：%s，配对交易笔数：%s' %(tradeCount, d['totalResult'])
+    print u'回测结果计算耗时：%.2f秒' %cost
+
+
+#----------------------------------------------------------------------
+def benchmarkQueueFill(tickCount=1000000, latency=1500, seed=0):
+    """
+    排队撮合模型的性能测试：在随机生成的tick数据上运行一个在买一卖一挂单的做市策略，
+    对比原有撮合方式、没有延时的排队撮合模型和有延时的排队撮合模型（latency为委托延时毫秒数）
+    的耗时、成交笔数和盈亏
+    
+    测试tick的间隔为500毫秒，延时不超过间隔时委托都在下一个tick到达，和没有延时的结果相同，
+    因此默认延时设为超过3个tick
+    """
+    from ctaTemplate import CtaTemplate
+    
+    priceTick = 0.2
+    
+    class QuoteStrategy(CtaTemplate):
+        """在买一卖一挂单，价格偏离最优价超过2跳时撤单（不等待撤单回报）"""
+        className = 'QuoteStrategy'
+        
+        def onInit(self):
+            self.buyOrderID = ''
+            self.sellOrderID = ''
+            self.buyPrice = 0
+            self.sellPrice = 0
+        
+        def onStart(self):
+            pass
+        
+        def onOrder(self, order):
+            if order.status in (STATUS_ALLTRADED, STATUS_CANCELLED):
+                if order.vtOrderID == self.buyOrderID:
+                    self.buyOrderID = ''
+                elif order.vtOrderID == self.sellOrderID:
+                    self.sellOrderID = ''
+        
+        def onTrade(self, trade):
+            pass
+        
+        def onTick(self, tick):
+            if not self.buyOrderID and self.pos < 10:
+                self.buyPrice = tick.bidPrice1
+                self.buyOrderID = self.buy(self.buyPrice, 2)
+            elif self.buyOrderID and self.buyPrice < tick.bidPrice1 - 2*priceTick:
+                self.cancelOrder(self.buyOrderID)
+                self.buyOrderID = ''
+            
+            if not self.sellOrderID and self.pos > -10:
+                self.sellPrice = tick.askPrice1
+                self.sellOrderID = self.sell(self.sellPrice, 2)
+            elif self.sellOrderID and self.sellPrice > tick.askPrice1 + 2*priceTick:
+                self.cancelOrder(self.sellOrderID)
+                self.sellOrderID = ''
+    
+    # 随机游走的盘口数据，买卖价差1跳，最新价为买一或卖一
+    print u'生成%s个测试tick数据' %tickCount
+    np.random.seed(seed)
+    bidList = (3000 + np.cumsum(np.random.randint(-1, 2, tickCount)) * priceTick).round(1).tolist()
+    bidVolumeList = np.random.randint(1, 50, tickCount).tolist()
+    askVolumeList = np.random.randint(1, 50, tickCount).tolist()
+    volumeList = np.cumsum(np.random.poisson(5, tickCount)).tolist()
+    sideList = np.random.randint(0, 2, tickCount).tolist()
+    
+    tick = CtaTickData()
+    startDatetime = datetime(2010, 1, 4, 9, 0)
+    dtList = [startDatetime + timedelta(milliseconds=500*n) for n in xrange(tickCount)]
+    
+    for active, orderLatency in [(False, 0), (True, 0), (True, latency)]:
+        engine = BacktestingEngine()
+        engine.setBacktestingMode(engine.TICK_MODE)
+        engine.setQueueFillActive(active, orderLatency)
+        engine.initStrategy(QuoteStrategy)
+        engine.startStrategy()
+        
+        start = _time()
+        for n in xrange(tickCount):
+            tick.datetime = dtList[n]
+            tick.bidPrice1 = bidList[n]
+            tick.askPrice1 = bidList[n] + priceTick
+            tick.bidVolume1 = bidVolumeList[n]
+            tick.askVolume1 = askVolumeList[n]
+            tick.volume = volumeList[n]
+            tick.lastPrice = tick.askPrice1 if sideList[n] else tick.bidPrice1
+            engine.newTick(tick)
+        cost = _time() - start
+        
+        partCount = len([order for order in engine.limitOrderDict.values() 
+                         if order.tradedVolume and order.tradedVolume < order.totalVolume])
+        volume = sum([trade.volume for trade in engine.tradeDict.values()])
+        
+        print u'排队撮合：%s，延时：%s毫秒，耗时：%.2f秒，每秒处理%.0f个tick' %(active, orderLatency, 
+                                                           cost, tickCount/cost)
+        print u'委托数：%s，成交笔数：%s，成交量：%s，部分成交的委托：%s' %(len(engine.limitOrderDict), 
+                                                         len(engine.tradeDict), volume, partCount)
+        
+        d = engine.calculateBacktestingResult()
+        print u'平仓盈亏：%s' %formatNumber(d.get('capital', 0))
+
 
 if __name__ == '__main__':
     # 以下内容是一段回测脚本的演示，用户可以根据自己的需求修改
@@ -32,6 +32,10 @@ SETTING_DB_NAME = 'VnTrader_Setting_Db'
 TICK_DB_NAME = 'VnTrader_Tick_Db'
 DAILY_DB_NAME = 'VnTrader_Daily_Db'
 MINUTE_DB_NAME = 'VnTrader_1Min_Db'
+MINUTE_5_DB_NAME = 'VnTrader_5Min_Db'
+MINUTE_15_DB_NAME = 'VnTrader_15Min_Db'
+MINUTE_30_DB_NAME = 'VnTrader_30Min_Db'
+HOUR_DB_NAME = 'VnTrader_1Hour_Db'
 
 # 引擎类型，用于区分当前策略的运行环境
 ENGINETYPE_BACKTESTING = 'backtesting'  # 回测
@@ -39,6 +43,7 @@ ENGINETYPE_TRADING = 'trading'          # 实盘
 
 # CTA引擎中涉及的数据类定义
 from vtConstant import EMPTY_UNICODE, EMPTY_STRING, EMPTY_FLOAT, EMPTY_INT
+from vtFunction import createSlotClass
 
 ########################################################################
 class StopOrder(object):
@@ -130,4 +135,10 @@ class CtaTickData(object):
         self.askVolume2 = EMPTY_INT
         self.askVolume3 = EMPTY_INT
         self.askVolume4 = EMPTY_INT
-        self.askVolume5 = EMPTY_INT    
\ No newline at end of file
+        self.askVolume5 = EMPTY_INT
+
+
+# 使用__slots__的紧凑版本数据类，字段和默认值与原数据类相同，回测等需要大量创建对象的场合使用，
+# 需要字典时使用toDict和fromDict（见vtFunction.createSlotClass）
+CtaBarDataSlot = createSlotClass(CtaBarData, 'CtaBarDataSlot')
+CtaTickDataSlot = createSlotClass(CtaTickData, 'CtaTickDataSlot')
@@ -0,0 +1,518 @@
+# encoding: UTF-8
+
+"""
+本模块中包含回测使用的列式历史数据：
+1. 将数据库中某个合约一段时间的K线或Tick一次性载入为按字段存储的numpy数组
+  （datetime64时间、float64价格、int64成交量和持仓量）
+2. 回测时按顺序从数组中生成CtaBarData/CtaTickData推送给回测引擎
+3. 列式数据的本地磁盘缓存（每个字段一个.npy文件，使用内存映射读取），
+   同一份数据的重复回测和并行优化只需从数据库读取一次
+4. 从Journal存储（vtJournal）的记录直接生成列式数据，无需逐条转换
+5. 只回测一次的数据（没有缓存）不生成列式数据，回测时直接从查询指针逐条生成对象
+
+相比于对每条数据库记录都创建对象再通过__dict__赋值，列式数据可以直接
+按时间切片，并在需要时分块批量转换为python对象。生成列式数据本身的耗时
+超过一次逐条回测，因此只用于同一份数据的重复回测（缓存、优化）。
+"""
+
+from __future__ import division
+
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from itertools import izip
+from operator import itemgetter
+from time import time
+import os
+import gc
+import json
+import shutil
+
+import numpy as np
+
+from ctaBase import *
+from vtJournal import datetimeToMicrosecond
+from vtFunction import SlotData, getDataDict
+
+
+# 列数据的类型
+DATETIME_DTYPE = 'datetime64[us]'
+FLOAT_DTYPE = 'float64'
+INT_DTYPE = 'int64'
+
+# 批量转换为python对象时每块的数据量
+CHUNK_SIZE = 100000
+
+# 1970年1月1日的序数，用于datetime转换
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+# 从数据库读取K线和Tick时的字段投影：回测不使用_id，在服务器端去掉后客户端
+# 不需要为每条数据解码生成ObjectId对象
+DOCUMENT_PROJECTION = {'_id': False}
+
+# 本地缓存目录
+CACHE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'dataCache')
+CACHE_META_FILE = 'meta.json'
+CACHE_MISS_SUFFIX = '.miss'     # 单次回测未命中缓存时的记录文件，同一缓存第二次使用时才生成缓存
+
+
+########################################################################
+class ColumnData(object):
+    """
+    列式历史数据
+
+    columnDict中保存字段名到numpy数组的映射，其中datetime字段为必须，
+    数据按照datetime从小到大排列
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, dataClass, columnDict):
+        """Constructor"""
+        self.dataClass = dataClass          # 生成数据对象使用的类，CtaBarData或CtaTickData
+        self.columnDict = columnDict        # 字段名：数组
+
+    #----------------------------------------------------------------------
+    def __len__(self):
+        """数据量"""
+        return len(self.columnDict['datetime'])
+
+    #----------------------------------------------------------------------
+    def getColumn(self, name):
+        """获取某个字段的数组"""
+        return self.columnDict[name]
+
+    #----------------------------------------------------------------------
+    def sliceByDatetime(self, start=None, end=None):
+        """
+        按时间切片，包含start不包含end，返回的新对象中的数组为原数组的视图
+        start和end为datetime对象，None表示不限制
+        """
+        dt = self.columnDict['datetime']
+
+        if start is None:
+            startIndex = 0
+        else:
+            startIndex = dt.searchsorted(np.datetime64(start, 'us'), 'left')
+
+        if end is None:
+            endIndex = len(dt)
+        else:
+            endIndex = dt.searchsorted(np.datetime64(end, 'us'), 'left')
+
+        columnDict = OrderedDict()
+        for name, column in self.columnDict.items():
+            columnDict[name] = column[startIndex:endIndex]
+
+        return ColumnData(self.dataClass, columnDict)
+
+    #----------------------------------------------------------------------
+    def iterData(self):
+        """按顺序生成数据对象"""
+        dataClass = self.dataClass
+        new = dataClass.__new__
+
+        nameList = self.columnDict.keys()
+        slot = issubclass(dataClass, SlotData)
+
+        for n in xrange(0, len(self), CHUNK_SIZE):
+            # 整块转换为python对象（datetime64数组的tolist会返回datetime对象）
+            columnList = [column[n:n+CHUNK_SIZE].tolist() for column in self.columnDict.values()]
+
+            for row in izip(*columnList):
+                if slot:
+                    # 使用__slots__的数据类没有__dict__，忽略数据类之外的字段
+                    yield dataClass.fromDict(dict(izip(nameList, row)))
+                else:
+                    # 字段已经完整，无需调用__init__
+                    data = new(dataClass)
+                    data.__dict__ = dict(izip(nameList, row))
+                    yield data
+
+    #----------------------------------------------------------------------
+    def toList(self):
+        """转换为数据对象的列表"""
+        return list(self.iterData())
+
+
+########################################################################
+class CursorData(object):
+    """
+    数据库查询指针数据，和ColumnData一样按顺序生成数据对象，但是不保存数据，只能遍历一次
+
+    用于只回测一次的数据：直接使用查询指针解码出的字典作为数据对象的__dict__，
+    不需要转换为列式数据再生成字典
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, dataClass, cursor):
+        """Constructor"""
+        self.dataClass = dataClass          # 生成数据对象使用的类
+        self.cursor = cursor                # 查询指针，或者任何字典的可迭代对象
+
+    #----------------------------------------------------------------------
+    def iterData(self):
+        """按顺序生成数据对象"""
+        dataClass = self.dataClass
+
+        if issubclass(dataClass, SlotData):
+            for d in self.cursor:
+                yield dataClass.fromDict(d)
+        else:
+            new = dataClass.__new__
+            for d in self.cursor:
+                data = new(dataClass)
+                data.__dict__ = d
+                yield data
+
+    #----------------------------------------------------------------------
+    def toList(self):
+        """转换为数据对象的列表"""
+        return list(self.iterData())
+
+
+#----------------------------------------------------------------------
+def getColumnDtype(value):
+    """根据字段的默认值或者第一条数据中的值确定数组类型，None表示由numpy自动推断"""
+    if isinstance(value, datetime):
+        return DATETIME_DTYPE
+    elif isinstance(value, bool):
+        return None
+    elif isinstance(value, float):
+        return FLOAT_DTYPE
+    elif isinstance(value, (int, long)):
+        return INT_DTYPE
+    else:
+        return None
+
+#----------------------------------------------------------------------
+def makeColumn(valueList, dtype):
+    """将python对象列表转换为数组，转换失败时保留为object数组"""
+    try:
+        return np.array(valueList, dtype=dtype)
+    except (ValueError, TypeError):
+        return np.array(valueList, dtype=object)
+
+#----------------------------------------------------------------------
+def makeDatetimeColumn(valueList):
+    """
+    将datetime对象列表转换为datetime64数组
+    先在python中计算微秒数再转换，比numpy逐个解析datetime对象快数倍
+    """
+    try:
+        l = [((d.toordinal()-EPOCH_ORDINAL)*86400 + d.hour*3600 + d.minute*60 + d.second)*1000000 + d.microsecond
+             for d in valueList]
+        return np.array(l, dtype=INT_DTYPE).view(DATETIME_DTYPE)
+    except AttributeError:
+        # 存在None等非datetime的值
+        return makeColumn(valueList, DATETIME_DTYPE)
+
+#----------------------------------------------------------------------
+def readColumnList(cursor, default):
+    """
+    从查询指针中读取数据，返回字段名列表和每个字段的值列表
+    字段以第一条数据为准（不包括_id），缺少字段时使用default中的默认值
+    """
+    nameList = None
+    rowList = []
+
+    for d in cursor:
+        # 根据第一条数据确定字段
+        if nameList is None:
+            nameList = [name for name in d.keys() if name != '_id']
+            if 'datetime' not in nameList:
+                nameList.append('datetime')
+            getter = itemgetter(*nameList)
+            if len(nameList) == 1:
+                getter = lambda d, getter=getter: (getter(d),)
+
+        # 一次取出所有字段
+        try:
+            rowList.append(getter(d))
+        except KeyError:
+            rowList.append(tuple([d.get(name, default.get(name)) for name in nameList]))
+
+    if nameList is None:
+        return [], []
+
+    return nameList, zip(*rowList)
+
+#----------------------------------------------------------------------
+def loadColumnData(cursor, dataClass):
+    """
+    从数据库查询指针（或者任何字典的可迭代对象）中读取数据，生成ColumnData
+
+    数据类中定义的字段使用其默认值的类型，其他字段由第一条数据的值确定类型
+    """
+    default = getDataDict(dataClass())
+    default['datetime'] = datetime(1970, 1, 1)
+
+    # 大量创建元组时python的垃圾回收会反复遍历所有对象，读取和转换期间暂停
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        return makeColumnData(cursor, dataClass, default)
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+#----------------------------------------------------------------------
+def makeColumnData(cursor, dataClass, default):
+    """从查询指针中读取数据并转换为ColumnData，default为数据类字段的默认值"""
+    nameList, valueListList = readColumnList(cursor, default)
+
+    columnDict = OrderedDict()
+
+    if not nameList:
+        # 没有数据时按照数据类的字段生成空数组
+        for name, value in default.items():
+            columnDict[name] = np.array([], dtype=getColumnDtype(value) or object)
+        return ColumnData(dataClass, columnDict)
+
+    # 每个字段转换完成后立即释放其值列表，降低峰值内存
+    valueListList = list(valueListList)
+    for n, name in enumerate(nameList):
+        valueList = valueListList[n]
+        valueListList[n] = None
+        dtype = getColumnDtype(default.get(name, valueList[0]))
+        if dtype == DATETIME_DTYPE:
+            columnDict[name] = makeDatetimeColumn(valueList)
+        else:
+            columnDict[name] = makeColumn(valueList, dtype)
+
+    # 数据库中的数据不保证有序，按时间稳定排序
+    dt = columnDict['datetime']
+    if len(dt) > 1 and (dt[1:] < dt[:-1]).any():
+        index = dt.argsort(kind='mergesort')
+        for name in columnDict.keys():
+            columnDict[name] = columnDict[name][index]
+
+    return ColumnData(dataClass, columnDict)
+
+#----------------------------------------------------------------------
+def loadJournalColumnData(journal, dbName, symbol, dataClass, startDate=None, endDate=None):
+    """
+    从Journal存储中读取[startDate, endDate]范围内的记录，生成ColumnData
+    记录的每个字段直接作为数组（单个文件时为内存映射的视图），datetime字段转换为datetime64视图
+    """
+    start = None
+    end = None
+    if startDate:
+        start = datetimeToMicrosecond(startDate)
+    if endDate:
+        end = datetimeToMicrosecond(endDate) + 1
+
+    records = journal.readRecords(dbName, symbol, start, end)
+
+    columnDict = OrderedDict()
+    for name in records.dtype.names:
+        if name == 'datetime':
+            columnDict[name] = records[name].view(DATETIME_DTYPE)
+        else:
+            columnDict[name] = records[name]
+
+    return ColumnData(dataClass, columnDict)
+
+#----------------------------------------------------------------------
+def getCacheKey(dbName, symbol, mode, startDate, endDate):
+    """生成缓存的键（缓存目录名），没有结束日期时使用latest"""
+    return '_'.join([dbName, symbol, mode, startDate, endDate or 'latest'])
+
+#----------------------------------------------------------------------
+def getSourceState(collection, flt):
+    """查询数据库中数据的状态（数据量和最后一条数据的时间），用于检查缓存是否过期"""
+    count = collection.find(flt).count()
+    
+    lastDatetime = ''
+    cursor = collection.find(flt, {'datetime': True}).sort('datetime', -1).limit(1)
+    for d in cursor:
+        lastDatetime = d['datetime'].isoformat()
+
+    return count, lastDatetime
+
+#----------------------------------------------------------------------
+def saveColumnCache(key, columnData, count, lastDatetime):
+    """将列式数据保存到缓存目录中，先写入临时目录再替换，避免读取到写了一半的缓存"""
+    path = os.path.join(CACHE_PATH, key)
+    tempPath = '%s.%s.tmp' %(path, os.getpid())
+
+    if os.path.exists(tempPath):
+        shutil.rmtree(tempPath)
+    os.makedirs(tempPath)
+
+    for name, column in columnData.columnDict.items():
+        np.save(os.path.join(tempPath, name+'.npy'), column)
+
+    meta = {'nameList': columnData.columnDict.keys(),
+            'count': count,
+            'lastDatetime': lastDatetime}
+    with open(os.path.join(tempPath, CACHE_META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tempPath, path)
+
+#----------------------------------------------------------------------
+def loadColumnCache(key, dataClass):
+    """
+    从缓存目录中读取列式数据，数组以只读内存映射的方式打开（不复制数据），
+    返回ColumnData和缓存的元数据，缓存不存在时返回None, None
+    """
+    path = os.path.join(CACHE_PATH, key)
+
+    try:
+        with open(os.path.join(path, CACHE_META_FILE)) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None, None
+
+    columnDict = OrderedDict()
+    for name in meta['nameList']:
+        name = str(name)
+        fileName = os.path.join(path, name+'.npy')
+        try:
+            columnDict[name] = np.load(fileName, mmap_mode='r')
+        except ValueError:
+            # object类型的数组无法使用内存映射
+            columnDict[name] = np.load(fileName, allow_pickle=True)
+
+    return ColumnData(dataClass, columnDict), meta
+
+#----------------------------------------------------------------------
+def removeColumnCache(key):
+    """删除缓存"""
+    path = os.path.join(CACHE_PATH, key)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+#----------------------------------------------------------------------
+def loadCachedColumnData(collection, flt, dataClass, key, once=False):
+    """
+    优先从本地缓存读取列式数据，缓存不存在或者数据库中的数据量、最后一条
+    数据的时间发生变化（例如没有结束日期时有了新的数据）时从数据库重新读取，
+    并更新缓存
+
+    once为True时（单次回测）第一次未命中只记录下来，返回None，由调用者直接从查询指针
+    回测（生成列式数据和缓存的耗时超过一次逐条回测）；同一缓存再次未命中时才生成缓存
+
+    返回ColumnData（或None）和是否命中缓存
+    """
+    count, lastDatetime = getSourceState(collection, flt)
+
+    columnData, meta = loadColumnCache(key, dataClass)
+    if meta and meta['count'] == count and meta['lastDatetime'] == lastDatetime:
+        return columnData, True
+
+    missFileName = os.path.join(CACHE_PATH, key + CACHE_MISS_SUFFIX)
+    if once and not os.path.exists(missFileName):
+        if not os.path.exists(CACHE_PATH):
+            os.makedirs(CACHE_PATH)
+        open(missFileName, 'w').close()
+        return None, False
+
+    if os.path.exists(missFileName):
+        os.remove(missFileName)
+
+    columnData = loadColumnData(collection.find(flt, DOCUMENT_PROJECTION), dataClass)
+    saveColumnCache(key, columnData, count, lastDatetime)
+
+    # 重新以内存映射的方式打开，和命中缓存时保持一致
+    columnData, meta = loadColumnCache(key, dataClass)
+    return columnData, False
+
+#----------------------------------------------------------------------
+def generateBarDocument(count, startDatetime=datetime(2010, 1, 4, 9, 0), seed=0):
+    """生成count条随机游走的1分钟K线数据（和数据库中读取出的字典格式相同），用于测试"""
+    np.random.seed(seed)
+    close = 3000 + np.cumsum(np.random.randn(count))
+    open_ = np.append(close[0], close[:-1])
+    high = np.maximum(open_, close) + np.random.rand(count)
+    low = np.minimum(open_, close) - np.random.rand(count)
+    volume = np.random.randint(1, 1000, count)
+    openInterest = 100000 + np.cumsum(np.random.randint(-10, 11, count))
+
+    l = []
+    dt = startDatetime
+    delta = timedelta(minutes=1)
+    for n in xrange(count):
+        d = {'vtSymbol': 'IF0000',
+             'symbol': 'IF0000',
+             'exchange': '',
+             'open': float(open_[n]),
+             'high': float(high[n]),
+             'low': float(low[n]),
+             'close': float(close[n]),
+             'date': dt.strftime('%Y%m%d'),
+             'time': dt.strftime('%H:%M:%S'),
+             'datetime': dt,
+             'volume': int(volume[n]),
+             'openInterest': int(openInterest[n])}
+        l.append(d)
+        dt += delta
+    return l
+
+#----------------------------------------------------------------------
+def benchmark(count=1000000):
+    """
+    性能测试：使用本地生成的count条K线数据，对比单次回测的三种方式的耗时（读取和推送）：
+    1. 原有方式：逐条解码并通过__dict__赋值创建对象（读取完整的文档，包括_id）
+    2. 查询指针数据（CursorData）：BacktestingEngine.runBacktesting没有可用缓存时的方式
+    3. 列式数据：首次回测需要读取和转换，之后每次回测（命中缓存、优化）只需推送
+    
+    数据库读取使用BSON编码后的数据模拟（pymongo的查询指针在客户端做同样的解码），
+    不包含网络传输的耗时，方式2和3使用DOCUMENT_PROJECTION，模拟服务器端已经去掉_id的文档
+    """
+    import bson
+    from bson.objectid import ObjectId
+    
+    print u'生成%s条测试K线数据' %count
+    docList = generateBarDocument(count)
+    rawList = [bson.BSON.encode(d) for d in docList]
+    for d in docList:
+        d['_id'] = ObjectId()
+    fullRawList = [bson.BSON.encode(d) for d in docList]
+    del docList
+    
+    def cursor(l):
+        """模拟数据库查询指针"""
+        for raw in l:
+            yield bson.BSON(raw).decode()
+
+    result = {'count': 0, 'close': 0}
+    def onBar(bar):
+        result['count'] += 1
+        result['close'] = bar.close
+
+    # 原有方式，每次回测都要从数据库读取
+    start = time()
+    for d in cursor(fullRawList):
+        data = CtaBarData()
+        data.__dict__ = d
+        onBar(data)
+    oldCost = time() - start
+    print u'原有方式单次回测读取和推送耗时：%.2f秒' %oldCost
+    del fullRawList
+
+    # 查询指针数据，没有缓存的单次回测
+    start = time()
+    for bar in CursorData(CtaBarData, cursor(rawList)).iterData():
+        onBar(bar)
+    cursorCost = time() - start
+    print u'查询指针数据单次回测读取和推送耗时：%.2f秒，原有方式的%.0f%%' %(cursorCost, cursorCost/oldCost*100)
+
+    # 列式数据，只需要读取一次
+    start = time()
+    columnData = loadColumnData(cursor(rawList), CtaBarData)
+    loadCost = time() - start
+
+    start = time()
+    for bar in columnData.iterData():
+        onBar(bar)
+    feedCost = time() - start
+    print u'列式数据读取耗时（只需一次）：%.2f秒，之后每次回测推送耗时：%.2f秒，原有方式的%.0f%%' %(
+        loadCost, feedCost, feedCost/oldCost*100)
+
+    print u'推送数据量：%s，最后收盘价：%s' %(result['count']//3, result['close'])
+    print u'列式数据内存占用：%.1fMB' %(sum([column.nbytes for column in columnData.columnDict.values()])/1024/1024)
+
+if __name__ == '__main__':
+    benchmark()
@@ -12,6 +12,8 @@
 """
 
 
+import numpy as np
+
 from ctaBase import *
 from ctaTemplate import CtaTemplate
 
@@ -174,6 +176,31 @@ class DoubleEmaDemo(CtaTemplate):
         # 发出状态更新事件
         self.putEvent()
         
+    #----------------------------------------------------------------------
+    def calculateTargetPos(self, data, startIndex):
+        """计算向量化回测用的目标仓位数组，逻辑和onBar一致"""
+        close = data['close']
+        
+        # 计算快慢均线，以及上一根K线的均线值（第一根K线为0，和onBar一致）
+        fastMa = calculateEma(close, self.fastK)
+        slowMa = calculateEma(close, self.slowK)
+        fastMa1 = np.append(0, fastMa[:-1])
+        slowMa1 = np.append(0, slowMa[:-1])
+        
+        # 金叉为1，死叉为-1，初始化数据中的信号不交易
+        crossOver = (fastMa>slowMa) & (fastMa1<slowMa1)
+        crossBelow = (fastMa<slowMa) & (fastMa1>slowMa1)
+        signal = crossOver.astype(int) - crossBelow.astype(int)
+        signal[:startIndex] = 0
+        
+        # 目标仓位为最近一次信号的方向，在出现信号前为0
+        index = np.where(signal != 0, np.arange(len(signal)), 0)
+        index = np.maximum.accumulate(index)
+        targetPos = signal[index]
+        
+        # 所有的委托均以信号K线的收盘价委托，和onBar一样未成交的委托保持原来的价格
+        return targetPos, close[index]
+        
     #----------------------------------------------------------------------
     def onOrder(self, order):
         """收到委托变化推送（必须由用户继承实现）"""
@@ -186,6 +213,23 @@ class DoubleEmaDemo(CtaTemplate):
         # 对于无需做细粒度委托控制的策略，可以忽略onOrder
         pass
     
+
+#----------------------------------------------------------------------
+def calculateEma(array, k):
+    """
+    计算EMA数组，第一个值为数组的第一个值
+    递推计算方式和DoubleEmaDemo.onBar完全一致，保证向量化回测结果相同
+    """
+    l = []
+    ma = 0
+    for x in array.tolist():
+        if not ma:
+            ma = x
+        else:
+            ma = x * k + ma * (1 - k)
+        l.append(ma)
+    return np.array(l)
+    
     
 ########################################################################################
 class OrderManagementDemo(CtaTemplate):
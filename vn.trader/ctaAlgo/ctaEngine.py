@@ -27,7 +27,7 @@ from ctaSetting import STRATEGY_CLASS
 from eventEngine import *
 from vtConstant import *
 from vtGateway import VtSubscribeReq, VtOrderReq, VtCancelOrderReq, VtLogData
-from vtFunction import todayDate
+from vtFunction import todayDate, getTickConverter, getDataDict
 
 
 ########################################################################
@@ -96,6 +96,9 @@ class CtaEngine(object):
         # set engine type to real trading
         self.engineType = ENGINETYPE_TRADING
         
+        # 将vtTickData转化为ctaTickData的函数
+        self.convertTick = getTickConverter(CtaTickData)
+        
         # 注册事件监听
         # register event
         self.registerEvent()
@@ -272,13 +275,7 @@ class CtaEngine(object):
         # 推送tick到对应的策略实例进行处理
         if tick.vtSymbol in self.tickStrategyDict:
             # 将vtTickData数据转化为ctaTickData
-            ctaTick = CtaTickData()
-            d = ctaTick.__dict__
-            for key in d.keys():
-                if key != 'datetime':
-                    d[key] = tick.__getattribute__(key)
-            # 添加datetime字段
-            ctaTick.datetime = datetime.strptime(' '.join([tick.date, tick.time]), '%Y%m%d %H:%M:%S.%f')
+            ctaTick = self.convertTick(tick)
             
             # 逐个推送到策略实例中
             l = self.tickStrategyDict[tick.vtSymbol]
@@ -344,7 +341,7 @@ class CtaEngine(object):
     #----------------------------------------------------------------------
     def insertData(self, dbName, collectionName, data):
         """插入数据到数据库（这里的data可以是CtaTickData或者CtaBarData）"""
-        self.mainEngine.dbInsert(dbName, collectionName, data.__dict__)
+        self.mainEngine.dbInsert(dbName, collectionName, getDataDict(data))
     
     #----------------------------------------------------------------------
     def loadBar(self, dbName, collectionName, days):
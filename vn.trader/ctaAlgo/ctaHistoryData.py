@@ -3,18 +3,33 @@
 """
 本模块中主要包含：
 1. 从通联数据下载历史行情的引擎
-2. 用来把MultiCharts导出的历史数据载入到MongoDB中用的函数
+2. 用来把MultiCharts、TB等软件导出的CSV格式历史数据载入到MongoDB（或者回测使用的
+   本地列式缓存）中用的函数
+
+批量下载使用线程池并行请求（请求频率限制和失败重试见datayesClient），每个合约的数据
+使用一次bulk_write批量upsert写入数据库。下载过程中完成的合约记录在断点文件中，
+中断后再次运行时跳过已经完成的合约，全部完成后删除断点文件。
 """
 
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from itertools import islice, izip
+from operator import itemgetter
+import csv
+import json
+import os
+import numpy as np
 import pymongo
+from pymongo import UpdateOne
 from time import time
 from multiprocessing.pool import ThreadPool
 
 from ctaBase import *
 from vtConstant import *
 from vtFunction import loadMongoSetting
-from datayesClient import DatayesClient
+from datayesClient import DatayesClient, DatayesError
+from ctaDataSource import (ColumnData, saveColumnCache, EPOCH_ORDINAL,
+                           DATETIME_DTYPE, FLOAT_DTYPE, INT_DTYPE)
 
 
 # 以下为vn.trader和通联数据规定的交易所代码映射 
@@ -26,17 +41,53 @@ VT_TO_DATAYES_EXCHANGE[EXCHANGE_DCE] = 'XDCE'       # 大商所
 DATAYES_TO_VT_EXCHANGE = {v:k for k,v in VT_TO_DATAYES_EXCHANGE.items()}
 
 
+# 以下为支持的CSV格式
+# header：是否有标题行，有标题行时columnDict的value为列名，否则为列序号
+# columnDict：字段到列的映射，日期和时间可以分为date、time两列，也可以是同一列datetime（用空格分隔）
+# dateFormat、timeFormat：日期和时间的格式
+CSV_DIALECT_MC = 'mc'               # MultiCharts导出
+CSV_DIALECT_TB = 'tb'               # TB（交易开拓者）导出
+CSV_DIALECT_GENERIC = 'generic'     # 通用的OHLCV格式
+
+CSV_DIALECT_SETTING = {}
+CSV_DIALECT_SETTING[CSV_DIALECT_MC] = {
+    'header': True,
+    'columnDict': {'date': 'Date', 'time': 'Time', 'open': 'Open', 'high': 'High', 
+                   'low': 'Low', 'close': 'Close', 'volume': 'TotalVolume'},
+    'dateFormat': '%Y/%m/%d',
+    'timeFormat': '%H:%M:%S'
+}
+CSV_DIALECT_SETTING[CSV_DIALECT_TB] = {
+    'header': False,
+    'columnDict': {'date': 0, 'time': 1, 'open': 2, 'high': 3, 'low': 4, 'close': 5, 
+                   'volume': 6, 'openInterest': 7},
+    'dateFormat': '%Y/%m/%d',
+    'timeFormat': '%H:%M'
+}
+CSV_DIALECT_SETTING[CSV_DIALECT_GENERIC] = {
+    'header': True,
+    'columnDict': {'datetime': 'datetime', 'open': 'open', 'high': 'high', 'low': 'low',
+                   'close': 'close', 'volume': 'volume'},
+    'dateFormat': '%Y-%m-%d',
+    'timeFormat': '%H:%M:%S'
+}
+
+
 ########################################################################
 class HistoryDataEngine(object):
     """CTA模块用的历史数据引擎"""
 
     #----------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, datayesClient=None):
         """Constructor"""
         host, port = loadMongoSetting()
         
         self.dbClient = pymongo.MongoClient(host, port)
-        self.datayesClient = DatayesClient()
+        self.datayesClient = datayesClient or DatayesClient()
+        
+        # 并行下载的断点续传记录文件
+        path = os.path.abspath(os.path.dirname(__file__))
+        self.checkpointFileName = os.path.join(path, 'HistoryData_checkpoint.json')
         
     #----------------------------------------------------------------------
     def lastTradeDate(self):
@@ -98,6 +149,7 @@ class HistoryDataEngine(object):
         """
         下载期货合约的日行情，symbol是合约代码，
         若最后四位为0000（如IF0000），代表下载连续合约。
+        返回是否下载成功（没有数据也算成功）
         """
         print u'开始下载%s日行情' %symbol
         
@@ -128,13 +180,14 @@ class HistoryDataEngine(object):
                 params['startDate'] = last['date']
         
         # 开始下载数据
-        data = self.datayesClient.downloadData(path, params)
+        try:
+            data = self.datayesClient.requestData(path, params)
+        except DatayesError, e:
+            print u'%s下载失败：%s' %(symbol, e.message)
+            return False
         
         if data:
-            # 创建datetime索引
-            self.dbClient[DAILY_DB_NAME][symbol].ensure_index([('datetime', pymongo.ASCENDING)], 
-                                                                      unique=True)                
-
+            barList = []
             for d in data:
                 bar = CtaBarData()
                 bar.vtSymbol = symbol
@@ -150,19 +203,24 @@ class HistoryDataEngine(object):
                     bar.datetime = datetime.strptime(bar.date, '%Y%m%d')
                     bar.volume = d.get('turnoverVol', 0)
                     bar.openInterest = d.get('openInt', 0)
-                except KeyError:
+                except (KeyError, ValueError):
                     print d
-                
-                flt = {'datetime': bar.datetime}
-                self.dbClient[DAILY_DB_NAME][symbol].update_one(flt, {'$set':bar.__dict__}, upsert=True)            
+                    continue
+                barList.append(bar)
             
-                print u'%s下载完成' %symbol
+            self.saveBarList(DAILY_DB_NAME, symbol, barList)
+            print u'%s下载完成，数据%s条' %(symbol, len(barList))
         else:
             print u'找不到合约%s' %symbol
+        
+        return True
             
     #----------------------------------------------------------------------
-    def downloadAllFuturesDailyBar(self):
-        """下载所有期货的主力合约日行情"""
+    def downloadAllFuturesDailyBar(self, workerCount=10, resume=True):
+        """
+        下载所有期货的主力合约日行情
+        workerCount为并行下载的线程数，resume为是否从上次中断的断点继续
+        """
         start = time()
         print u'开始下载所有期货的主力合约日行情'
         
@@ -170,17 +228,103 @@ class HistoryDataEngine(object):
         
         print u'代码列表读取成功，产品代码：%s' %productSymbolSet
         
-        # 这里也测试了线程池，但可能由于下载函数中涉及较多的数据格
-        # 式转换，CPU开销较大，多线程效率并无显著改变。
-        #p = ThreadPool(10)
-        #p.map(self.downloadFuturesDailyBar, productSymbolSet)
-        #p.close()
-        #p.join()
+        # 原先逐个产品下载并且每条数据单独upsert，耗时主要在网络和数据库的往返上，
+        # 改为批量写入后使用线程池并行下载
+        symbolList = sorted([productSymbol+'0000' for productSymbol in productSymbolSet])
+        failedList = self.downloadParallel('FuturesDailyBar', self.downloadFuturesDailyBar, 
+                                           symbolList, workerCount, resume)
         
-        for productSymbol in productSymbolSet:
-            self.downloadFuturesDailyBar(productSymbol+'0000')
-
+        if failedList:
+            print u'以下合约下载失败，再次运行时将重新下载：%s' %failedList
         print u'所有期货的主力合约日行情已经全部下载完成, 耗时%s秒' %(time()-start)
+    
+    #----------------------------------------------------------------------
+    def downloadParallel(self, taskName, downloadFunc, symbolList, workerCount=10, resume=True):
+        """
+        使用线程池并行下载，downloadFunc(symbol)返回是否下载成功，返回下载失败的代码列表
+        
+        完成的代码按照任务名和最近交易日记录在断点文件中，resume为True时跳过断点文件中
+        已经完成的代码，所有代码都下载成功后删除断点文件
+        """
+        tradeDate = self.lastTradeDate()
+        
+        if resume:
+            finishedSet = self.loadCheckpoint(taskName, tradeDate)
+        else:
+            finishedSet = set()
+        
+        todoList = [symbol for symbol in symbolList if symbol not in finishedSet]
+        if finishedSet:
+            print u'从断点继续下载，已完成%s个，剩余%s个' %(len(symbolList)-len(todoList), len(todoList))
+        
+        def downloadTask(symbol):
+            """返回代码和是否成功，线程中的异常不会中断其他代码的下载"""
+            try:
+                return symbol, downloadFunc(symbol)
+            except Exception, e:
+                print u'%s下载异常：%s' %(symbol, e)
+                return symbol, False
+        
+        failedList = []
+        pool = ThreadPool(workerCount)
+        try:
+            for symbol, success in pool.imap_unordered(downloadTask, todoList):
+                if success:
+                    finishedSet.add(symbol)
+                    self.saveCheckpoint(taskName, tradeDate, finishedSet)
+                else:
+                    failedList.append(symbol)
+        finally:
+            pool.close()
+            pool.join()
+        
+        if not failedList:
+            self.clearCheckpoint()
+        
+        return sorted(failedList)
+    
+    #----------------------------------------------------------------------
+    def loadCheckpoint(self, taskName, tradeDate):
+        """读取断点文件中同一任务和交易日已经完成的代码集合"""
+        try:
+            with open(self.checkpointFileName) as f:
+                checkpoint = json.load(f)
+        except (IOError, ValueError):
+            return set()
+        
+        if checkpoint.get('taskName') != taskName or checkpoint.get('tradeDate') != tradeDate:
+            return set()
+        return set(checkpoint.get('finished', []))
+    
+    #----------------------------------------------------------------------
+    def saveCheckpoint(self, taskName, tradeDate, finishedSet):
+        """保存断点文件"""
+        checkpoint = {'taskName': taskName,
+                      'tradeDate': tradeDate,
+                      'finished': sorted(finishedSet)}
+        with open(self.checkpointFileName, 'w') as f:
+            json.dump(checkpoint, f)
+    
+    #----------------------------------------------------------------------
+    def clearCheckpoint(self):
+        """删除断点文件"""
+        if os.path.exists(self.checkpointFileName):
+            os.remove(self.checkpointFileName)
+    
+    #----------------------------------------------------------------------
+    def saveBarList(self, dbName, symbol, barList):
+        """使用一次bulk_write把K线数据批量upsert到数据库，以datetime去重"""
+        if not barList:
+            return
+        
+        collection = self.dbClient[dbName][symbol]
+        
+        # 创建datetime索引
+        collection.ensure_index([('datetime', pymongo.ASCENDING)], unique=True)
+        
+        requestList = [UpdateOne({'datetime': bar.datetime}, {'$set': bar.__dict__}, upsert=True)
+                       for bar in barList]
+        collection.bulk_write(requestList, ordered=False)
         
     #----------------------------------------------------------------------
     def downloadFuturesIntradayBar(self, symbol):
@@ -199,10 +343,7 @@ class HistoryDataEngine(object):
         if data:
             today = datetime.now().strftime('%Y%m%d')
             
-            # 创建datetime索引
-            self.dbClient[MINUTE_DB_NAME][symbol].ensure_index([('datetime', pymongo.ASCENDING)], 
-                                                                      unique=True)                
-
+            barList = []
             for d in data:
                 bar = CtaBarData()
                 bar.vtSymbol = symbol
@@ -218,12 +359,12 @@ class HistoryDataEngine(object):
                     bar.datetime = datetime.strptime(bar.date + ' ' + bar.time, '%Y%m%d %H:%M')
                     bar.volume = d.get('totalVolume', 0)
                     bar.openInterest = 0
-                except KeyError:
+                except (KeyError, ValueError):
                     print d
-                
-                flt = {'datetime': bar.datetime}
-                self.dbClient[MINUTE_DB_NAME][symbol].update_one(flt, {'$set':bar.__dict__}, upsert=True)            
+                    continue
+                barList.append(bar)
             
+            self.saveBarList(MINUTE_DB_NAME, symbol, barList)
             print u'%s下载完成' %symbol
         else:
             print u'找不到合约%s' %symbol   
@@ -283,10 +424,7 @@ class HistoryDataEngine(object):
         data = self.datayesClient.downloadData(path, params)
         
         if data:
-            # 创建datetime索引
-            self.dbClient[DAILY_DB_NAME][symbol].ensure_index([('datetime', pymongo.ASCENDING)], 
-                                                                unique=True)                
-
+            barList = []
             for d in data:
                 bar = CtaBarData()
                 bar.vtSymbol = symbol
@@ -301,12 +439,12 @@ class HistoryDataEngine(object):
                     bar.time = ''
                     bar.datetime = datetime.strptime(bar.date, '%Y%m%d')
                     bar.volume = d.get('turnoverVol', 0)
-                except KeyError:
+                except (KeyError, ValueError):
                     print d
-                
-                flt = {'datetime': bar.datetime}
-                self.dbClient[DAILY_DB_NAME][symbol].update_one(flt, {'$set':bar.__dict__}, upsert=True)            
+                    continue
+                barList.append(bar)
             
+            self.saveBarList(DAILY_DB_NAME, symbol, barList)
             print u'%s下载完成' %symbol
         else:
             print u'找不到合约%s' %symbol    
@@ -314,45 +452,161 @@ class HistoryDataEngine(object):
 
 
 #----------------------------------------------------------------------
-def loadMcCsv(fileName, dbName, symbol):
-    """将Multicharts导出的csv格式的历史数据插入到Mongo数据库中"""
-    import csv
+def readCsvChunk(fileName, setting, chunkSize):
+    """分块读取CSV文件，每次生成字段名到字符串值元组的字典"""
+    with open(fileName, 'rb') as f:
+        reader = csv.reader(f)
+        
+        # 有标题行的格式按照列名查找列，否则直接使用列序号
+        if setting['header']:
+            header = [name.strip() for name in reader.next()]
+            header[0] = header[0].lstrip('\xef\xbb\xbf')     # 去除UTF-8的BOM
+            indexDict = OrderedDict([(key, header.index(name)) for key, name in setting['columnDict'].items()])
+        else:
+            indexDict = OrderedDict(setting['columnDict'].items())
+        
+        keyList = indexDict.keys()
+        getter = itemgetter(*indexDict.values())
+        
+        while True:
+            rowList = [getter(row) for row in islice(reader, chunkSize) if row]
+            if not rowList:
+                break
+            yield dict(zip(keyList, zip(*rowList)))
+
+#----------------------------------------------------------------------
+def parseDatetimeColumn(dateList, timeList, dateFormat, timeFormat):
+    """
+    向量化解析日期和时间字符串，返回(datetime64数组, YYYYMMDD格式的日期数组, HH:MM:SS格式的时间数组)
+    
+    K线数据中日期和时间的取值大量重复，只对不重复的值调用strptime，再通过数组索引映射到所有数据
+    """
+    uniqueDate, dateIndex = np.unique(np.array(dateList), return_inverse=True)
+    dayList = []
+    dateStrList = []
+    for s in uniqueDate:
+        d = datetime.strptime(s.strip(), dateFormat)
+        dayList.append(d.toordinal() - EPOCH_ORDINAL)
+        dateStrList.append(d.strftime('%Y%m%d'))
+    
+    uniqueTime, timeIndex = np.unique(np.array(timeList), return_inverse=True)
+    secondList = []
+    timeStrList = []
+    for s in uniqueTime:
+        t = datetime.strptime(s.strip(), timeFormat)
+        secondList.append(t.hour*3600 + t.minute*60 + t.second)
+        timeStrList.append(t.strftime('%H:%M:%S'))
+    
+    day = np.array(dayList, dtype=INT_DTYPE)[dateIndex]
+    second = np.array(secondList, dtype=INT_DTYPE)[timeIndex]
+    dt = ((day * 86400 + second) * 1000000).view(DATETIME_DTYPE)
+    
+    return dt, np.array(dateStrList)[dateIndex], np.array(timeStrList)[timeIndex]
+
+#----------------------------------------------------------------------
+def loadCsv(fileName, dbName, symbol, dialect=CSV_DIALECT_MC, chunkSize=100000, 
+            toDatabase=True, cacheKey=''):
+    """
+    将CSV格式的K线数据分块导入
+    
+    dialect为CSV格式（见CSV_DIALECT_SETTING），每块数据的日期时间向量化解析后，使用
+    无序的bulk_write批量upsert到数据库（以datetime去重）
+    
+    cacheKey不为空时同时把全部数据写入回测使用的本地列式缓存，回测时通过
+    BacktestingEngine.setSharedData(cacheKey)直接使用，无需数据库；toDatabase为False时
+    只写入缓存
+    
+    返回导入的数据量
+    """
+    setting = CSV_DIALECT_SETTING[dialect]
     
     start = time()
     print u'开始读取CSV文件%s中的数据插入到%s的%s中' %(fileName, dbName, symbol)
     
-    # 锁定集合，并创建索引
-    host, port = loadMongoSetting()
+    if toDatabase:
+        host, port = loadMongoSetting()
+        client = pymongo.MongoClient(host, port)    
+        collection = client[dbName][symbol]
+        collection.ensure_index([('datetime', pymongo.ASCENDING)], unique=True)
     
-    client = pymongo.MongoClient(host, port)    
-    collection = client[dbName][symbol]
-    collection.ensure_index([('datetime', pymongo.ASCENDING)], unique=True)   
+    count = 0
+    columnListDict = OrderedDict()      # 写入缓存用，key为字段名，value为每块数据的数组列表
     
-    # 读取数据和插入到数据库
-    reader = csv.DictReader(file(fileName, 'r'))
-    for d in reader:
-        bar = CtaBarData()
-        bar.vtSymbol = symbol
-        bar.symbol = symbol
-        bar.open = float(d['Open'])
-        bar.high = float(d['High'])
-        bar.low = float(d['Low'])
-        bar.close = float(d['Close'])
-        bar.date = datetime.strptime(d['Date'], '%Y/%m/%d').strftime('%Y%m%d')
-        bar.time = d['Time']
-        """
-        Warnings:
-        We have to use datetime.strptime to insert data, otherwise MongoDB cannot recognise it as a date.
-        Even pandas.to_datetime cannot set it as a ISODate, ISODate is needed while doing indexing.
-        """
-        bar.datetime = datetime.strptime(bar.date + ' ' + bar.time, '%Y%m%d %H:%M:%S')
-        bar.volume = d['TotalVolume']
+    for chunk in readCsvChunk(fileName, setting, chunkSize):
+        if 'datetime' in chunk:
+            # 日期和时间在同一列时先按空格拆分
+            dateTime = np.char.partition(np.array(chunk['datetime']), ' ')
+            dateList, timeList = dateTime[:, 0], dateTime[:, 2]
+        else:
+            dateList, timeList = chunk['date'], chunk['time']
+        dt, dateArray, timeArray = parseDatetimeColumn(dateList, timeList, 
+                                                       setting['dateFormat'], setting['timeFormat'])
+        
+        columnDict = OrderedDict()
+        columnDict['datetime'] = dt
+        columnDict['date'] = dateArray
+        columnDict['time'] = timeArray
+        for name in ['open', 'high', 'low', 'close']:
+            columnDict[name] = np.array(chunk[name], dtype=FLOAT_DTYPE)
+        for name in ['volume', 'openInterest']:
+            if name in chunk:
+                columnDict[name] = np.array(chunk[name], dtype=FLOAT_DTYPE).astype(INT_DTYPE)
+            else:
+                columnDict[name] = np.zeros(len(dt), dtype=INT_DTYPE)
+        
+        if toDatabase:
+            nameList = columnDict.keys()
+            requestList = []
+            for row in izip(*[column.tolist() for column in columnDict.values()]):
+                d = dict(izip(nameList, row))
+                d['vtSymbol'] = symbol
+                d['symbol'] = symbol
+                d['exchange'] = EMPTY_STRING
+                requestList.append(UpdateOne({'datetime': d['datetime']}, {'$set': d}, upsert=True))
+            collection.bulk_write(requestList, ordered=False)
+        
+        if cacheKey:
+            for name, column in columnDict.items():
+                columnListDict.setdefault(name, []).append(column)
+        
+        count += len(dt)
+        cost = time() - start
+        print u'已导入%s条数据，耗时%.1f秒，速度%.0f条/秒' %(count, cost, count/max(cost, 1e-6))
+    
+    if cacheKey and count:
+        saveCsvCache(cacheKey, symbol, columnListDict)
+        print u'数据已写入本地缓存%s' %cacheKey
+    
+    cost = time() - start
+    print u'插入完毕，数据%s条，耗时%.1f秒，速度%.0f条/秒' %(count, cost, count/max(cost, 1e-6))
+    return count
 
-        flt = {'datetime': bar.datetime}
-        collection.update_one(flt, {'$set':bar.__dict__}, upsert=True)  
-        print bar.date, bar.time
+#----------------------------------------------------------------------
+def saveCsvCache(cacheKey, symbol, columnListDict):
+    """把CSV导入的各块数据合并后按时间排序，保存为回测使用的列式缓存"""
+    columnDict = OrderedDict()
+    for name, columnList in columnListDict.items():
+        columnDict[name] = np.concatenate(columnList)
+    
+    dt = columnDict['datetime']
+    if len(dt) > 1 and (dt[1:] < dt[:-1]).any():
+        index = dt.argsort(kind='mergesort')
+        for name in columnDict.keys():
+            columnDict[name] = columnDict[name][index]
+        dt = columnDict['datetime']
     
-    print u'插入完毕，耗时：%s' % (time()-start)
+    count = len(dt)
+    for name in ['vtSymbol', 'symbol']:
+        columnDict[name] = np.repeat(np.array([symbol]), count)
+    columnDict['exchange'] = np.repeat(np.array([EMPTY_STRING]), count)
+    
+    lastDatetime = dt[-1].item().isoformat()
+    saveColumnCache(cacheKey, ColumnData(CtaBarData, columnDict), count, lastDatetime)
+
+#----------------------------------------------------------------------
+def loadMcCsv(fileName, dbName, symbol):
+    """将Multicharts导出的csv格式的历史数据插入到Mongo数据库中"""
+    return loadCsv(fileName, dbName, symbol, CSV_DIALECT_MC)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,418 @@
+# encoding: UTF-8
+
+"""
+本模块中包含CTA策略使用的增量指标计算工具：
+1. 基于数组的环形缓存RingBuffer，每次更新为O(1)，可以随时取出按时间顺序排列的数组视图
+2. 增量计算的SMA、EMA、ATR、RSI、布林带、唐奇安通道，每根K线更新一次，计算结果和
+   talib中同名函数对整个数据序列计算的最后一个值一致
+
+使用方法（以ATR为例）：
+    atr = AtrIndicator(14)
+    for bar in barList:
+        atr.update(bar.high, bar.low, bar.close)
+        if atr.inited:
+            print atr.value
+"""
+
+from __future__ import division
+
+from collections import deque
+from time import time
+
+import numpy as np
+
+
+########################################################################
+class RingBuffer(object):
+    """
+    环形缓存
+
+    内部使用两倍长度的数组，每个数据同时写入两个位置，从而任何时候最近size个
+    数据在数组中都是连续的，getArray无需复制即可返回按时间顺序排列的视图
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, size):
+        """Constructor"""
+        self.size = size
+        self.count = 0                          # 累计写入的数据数量
+        self.pos = 0                            # 下一个数据写入的位置
+        self.array = np.zeros(size*2)
+
+    #----------------------------------------------------------------------
+    def update(self, value):
+        """写入新的数据，返回被覆盖的最旧的数据（缓存未满时为0）"""
+        pos = self.pos
+        array = self.array
+
+        old = array.item(pos)
+        array[pos] = value
+        array[pos+self.size] = value
+
+        pos += 1
+        if pos == self.size:
+            pos = 0
+        self.pos = pos
+
+        self.count += 1
+        return old
+
+    #----------------------------------------------------------------------
+    def getArray(self):
+        """获取按时间顺序排列的数组视图（缓存未满时前面的数据为0）"""
+        return self.array[self.pos:self.pos+self.size]
+
+    #----------------------------------------------------------------------
+    def getLast(self, n=1):
+        """获取倒数第n个数据"""
+        return self.array[self.pos+self.size-n]
+
+    #----------------------------------------------------------------------
+    @property
+    def full(self):
+        """缓存是否已满"""
+        return self.count >= self.size
+
+
+########################################################################
+class SmaIndicator(object):
+    """简单移动平均，对应talib.SMA/talib.MA"""
+
+    #----------------------------------------------------------------------
+    def __init__(self, length):
+        """Constructor"""
+        self.length = length
+        self.buffer = RingBuffer(length)
+        self.total = 0                          # 窗口内数据之和
+
+        self.inited = False                     # 数据量是否足够
+        self.value = 0
+
+    #----------------------------------------------------------------------
+    def update(self, value):
+        """更新数据，返回最新的均值"""
+        buffer = self.buffer
+        old = buffer.update(value)
+
+        # 每写满一轮重新求和，避免累加的浮点误差
+        if buffer.pos == 0:
+            self.total = buffer.getArray().sum()
+        else:
+            self.total += value - old
+
+        if buffer.count >= self.length:
+            self.inited = True
+            self.value = self.total / self.length
+        return self.value
+
+
+########################################################################
+class EmaIndicator(object):
+    """指数移动平均，对应talib.EMA：第一个值为前length个数据的简单平均，平滑系数为2/(length+1)"""
+
+    #----------------------------------------------------------------------
+    def __init__(self, length):
+        """Constructor"""
+        self.length = length
+        self.k = 2 / (length + 1)
+        self.count = 0
+        self.total = 0                          # 计算初始值用的数据之和
+
+        self.inited = False
+        self.value = 0
+
+    #----------------------------------------------------------------------
+    def update(self, value):
+        """更新数据，返回最新的EMA"""
+        self.count += 1
+
+        if self.inited:
+            self.value = (value - self.value) * self.k + self.value
+        else:
+            self.total += value
+            if self.count == self.length:
+                self.inited = True
+                self.value = self.total / self.length
+        return self.value
+
+
+########################################################################
+class AtrIndicator(object):
+    """
+    平均真实波幅，对应talib.ATR
+    第一根K线没有前收盘价不计算真实波幅，第length根之后的第一个值为真实波幅的
+    简单平均，之后使用Wilder平滑：(前值*(length-1) + 真实波幅) / length
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, length):
+        """Constructor"""
+        self.length = length
+        self.count = 0                          # 已计算的真实波幅数量
+        self.total = 0
+        self.preClose = None                    # 前收盘价
+
+        self.inited = False
+        self.value = 0
+
+    #----------------------------------------------------------------------
+    def update(self, high, low, close):
+        """更新K线数据，返回最新的ATR"""
+        preClose = self.preClose
+        self.preClose = close
+
+        if preClose is None:
+            return self.value
+
+        tr = max(high - low, abs(high - preClose), abs(low - preClose))
+        self.count += 1
+
+        if self.inited:
+            self.value = (self.value * (self.length - 1) + tr) / self.length
+        else:
+            self.total += tr
+            if self.count == self.length:
+                self.inited = True
+                self.value = self.total / self.length
+        return self.value
+
+
+########################################################################
+class RsiIndicator(object):
+    """
+    相对强弱指标，对应talib.RSI
+    前length个涨跌幅的平均值作为初始的平均涨幅和平均跌幅，之后使用Wilder平滑
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, length):
+        """Constructor"""
+        self.length = length
+        self.count = 0                          # 已计算的涨跌幅数量
+        self.gain = 0                           # 平均涨幅
+        self.loss = 0                           # 平均跌幅
+        self.preClose = None
+
+        self.inited = False
+        self.value = 0
+
+    #----------------------------------------------------------------------
+    def update(self, close):
+        """更新收盘价，返回最新的RSI"""
+        preClose = self.preClose
+        self.preClose = close
+
+        if preClose is None:
+            return self.value
+
+        change = close - preClose
+        if change > 0:
+            gain = change
+            loss = 0
+        else:
+            gain = 0
+            loss = -change
+
+        self.count += 1
+        length = self.length
+
+        if self.inited:
+            self.gain = (self.gain * (length - 1) + gain) / length
+            self.loss = (self.loss * (length - 1) + loss) / length
+        else:
+            self.gain += gain
+            self.loss += loss
+            if self.count < length:
+                return self.value
+            self.inited = True
+            self.gain /= length
+            self.loss /= length
+
+        total = self.gain + self.loss
+        if total:
+            self.value = 100 * self.gain / total
+        else:
+            self.value = 0
+        return self.value
+
+
+########################################################################
+class BollIndicator(object):
+    """
+    布林带，对应talib.BBANDS（均线为SMA，标准差为总体标准差）
+    mid为中轨，up为上轨，down为下轨
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, length, devUp=2, devDown=2):
+        """Constructor"""
+        self.length = length
+        self.devUp = devUp
+        self.devDown = devDown
+
+        self.buffer = RingBuffer(length)
+        self.base = 0                           # 基准值，求和时减去以减少浮点误差
+        self.total = 0                          # 窗口内数据与基准值之差的和
+        self.squareTotal = 0                    # 窗口内数据与基准值之差的平方和
+
+        self.inited = False
+        self.mid = 0
+        self.up = 0
+        self.down = 0
+        self.std = 0
+
+    #----------------------------------------------------------------------
+    def update(self, value):
+        """更新数据，返回(上轨, 中轨, 下轨)"""
+        buffer = self.buffer
+        old = buffer.update(value)
+
+        # 每写满一轮以当前均值为基准重新求和，避免累加的浮点误差
+        if buffer.pos == 0:
+            array = buffer.getArray()
+            self.base = array.mean()
+            array = array - self.base
+            self.total = array.sum()
+            self.squareTotal = (array * array).sum()
+        else:
+            base = self.base
+            value -= base
+            old -= base
+            self.total += value - old
+            self.squareTotal += value * value - old * old
+
+        if buffer.count >= self.length:
+            self.inited = True
+
+            length = self.length
+            mean = self.total / length
+            variance = self.squareTotal / length - mean * mean
+            if variance > 0:
+                self.std = variance ** 0.5
+            else:
+                self.std = 0
+
+            self.mid = mean + self.base
+            self.up = self.mid + self.devUp * self.std
+            self.down = self.mid - self.devDown * self.std
+
+        return self.up, self.mid, self.down
+
+
+########################################################################
+class DonchianIndicator(object):
+    """
+    唐奇安通道，对应talib.MAX(high)和talib.MIN(low)，包括当前K线
+    使用单调队列，每次更新的平摊复杂度为O(1)
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, length):
+        """Constructor"""
+        self.length = length
+        self.count = 0
+        self.highQueue = deque()                # (序号, 最高价)，最高价单调递减
+        self.lowQueue = deque()                 # (序号, 最低价)，最低价单调递增
+
+        self.inited = False
+        self.up = 0
+        self.down = 0
+
+    #----------------------------------------------------------------------
+    def update(self, high, low):
+        """更新K线数据，返回(上轨, 下轨)"""
+        n = self.count
+        self.count += 1
+
+        highQueue = self.highQueue
+        while highQueue and highQueue[-1][1] <= high:
+            highQueue.pop()
+        highQueue.append((n, high))
+        if highQueue[0][0] <= n - self.length:
+            highQueue.popleft()
+
+        lowQueue = self.lowQueue
+        while lowQueue and lowQueue[-1][1] >= low:
+            lowQueue.pop()
+        lowQueue.append((n, low))
+        if lowQueue[0][0] <= n - self.length:
+            lowQueue.popleft()
+
+        if self.count >= self.length:
+            self.inited = True
+            self.up = highQueue[0][1]
+            self.down = lowQueue[0][1]
+
+        return self.up, self.down
+
+
+#----------------------------------------------------------------------
+def benchmark(count=20000, bufferSize=1000):
+    """
+    性能测试：对比AtrRsiStrategy原有的每根K线平移数组并用talib重新计算整个缓存的
+    方式和增量计算的耗时，同时检查两者计算结果的最大差异
+    """
+    import talib
+
+    np.random.seed(0)
+    close = 3000 + np.cumsum(np.random.randn(count))
+    high = close + np.random.rand(count)
+    low = close - np.random.rand(count)
+
+    atrLength = 22
+    atrMaLength = 10
+    rsiLength = 5
+
+    # 原有方式
+    start = time()
+    highArray = np.zeros(bufferSize)
+    lowArray = np.zeros(bufferSize)
+    closeArray = np.zeros(bufferSize)
+    atrArray = np.zeros(bufferSize)
+    oldResult = []
+    for n in xrange(count):
+        closeArray[0:bufferSize-1] = closeArray[1:bufferSize]
+        highArray[0:bufferSize-1] = highArray[1:bufferSize]
+        lowArray[0:bufferSize-1] = lowArray[1:bufferSize]
+        closeArray[-1] = close[n]
+        highArray[-1] = high[n]
+        lowArray[-1] = low[n]
+
+        if n+1 < bufferSize:
+            continue
+
+        atrValue = talib.ATR(highArray, lowArray, closeArray, atrLength)[-1]
+        atrArray[0:bufferSize-1] = atrArray[1:bufferSize]
+        atrArray[-1] = atrValue
+        atrMa = talib.MA(atrArray, atrMaLength)[-1]
+        rsiValue = talib.RSI(closeArray, rsiLength)[-1]
+        oldResult.append((atrValue, atrMa, rsiValue))
+    oldCost = time() - start
+
+    # 增量计算
+    start = time()
+    atr = AtrIndicator(atrLength)
+    atrMa = SmaIndicator(atrMaLength)
+    rsi = RsiIndicator(rsiLength)
+    newResult = []
+    for h, l, c in zip(high.tolist(), low.tolist(), close.tolist()):
+        atrValue = atr.update(h, l, c)
+        rsiValue = rsi.update(c)
+
+        if atr.count+1 < bufferSize:
+            continue
+
+        atrMaValue = atrMa.update(atrValue)
+        newResult.append((atrValue, atrMaValue, rsiValue))
+    newCost = time() - start
+
+    # 原有方式的ATR均线数组需要先积累bufferSize个值，只比较均线有效的部分
+    diff = np.abs(np.array(oldResult) - np.array(newResult))[atrMaLength:].max(axis=0)
+
+    print u'K线数量：%s，缓存大小：%s' %(count, bufferSize)
+    print u'talib重新计算耗时：%.3f秒，增量计算耗时：%.3f秒' %(oldCost, newCost)
+    print u'最大差异 ATR：%.3e，ATR均线：%.3e，RSI：%.3e' %tuple(diff)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,498 @@
+# encoding: UTF-8
+
+'''
+组合回测引擎，同时回测多个合约上的多个策略。
+
+每个策略使用一个独立的BacktestingEngine作为其ctaEngine，函数接口和单合约回测完全一样，
+策略代码无需修改；每个合约的历史数据只载入一次，所有合约的数据按时间合并为一个
+事件序列（预先排序的索引），依次推送给订阅了该合约的策略，并只撮合该策略自己的委托。
+
+策略还可以订阅其他合约作为辅助品种（K线模式），辅助品种的K线从同一个事件序列中获取，
+和BacktestEngineMultiTF一样通过onBar(bar, infobar=...)推送，不再为每根K线查询辅助品种的数据库指针。
+
+This file provides a portfolio backtesting engine running multiple strategies on multiple symbols.
+Every strategy gets its own BacktestingEngine with the same APIs as CTA engine, historical data of
+all symbols are merged into one time-ordered stream by a pre-sorted index.
+'''
+
+from __future__ import division
+
+from datetime import datetime
+from collections import OrderedDict
+from functools import partial
+from time import time as _time     # 避免通过import *覆盖脚本中导入的time模块
+
+import numpy as np
+
+from ctaBase import *
+from ctaBacktesting import BacktestingEngine, calculateTradeStatistics, formatNumber
+from ctaDataSource import CHUNK_SIZE, ColumnData, loadColumnData, generateBarDocument
+from vtFunction import loadVtSetting, getDataDict
+from vtJournal import STORAGE_MONGO, JOURNAL_PATH
+
+
+########################################################################
+class PortfolioBacktestingEngine(object):
+    """
+    组合回测引擎
+
+    使用方法：
+    1. addSymbol添加合约及其合约大小、手续费率和滑点
+    2. addStrategy添加策略，策略参数中的vtSymbol和辅助品种infoSymbolList必须是已经添加的合约
+    3. runBacktesting运行回测，calculateBacktestingResult计算组合和每个策略的回测结果
+    """
+
+    TICK_MODE = BacktestingEngine.TICK_MODE
+    BAR_MODE = BacktestingEngine.BAR_MODE
+
+    #----------------------------------------------------------------------
+    def __init__(self):
+        """Constructor"""
+        self.mode = self.BAR_MODE
+
+        self.startDate = ''
+        self.initDays = 0
+        self.endDate = ''
+
+        self.cacheActive = True
+        self.slotDataActive = False
+        setting = loadVtSetting()
+        self.storageBackend = setting.get('storageBackend', STORAGE_MONGO)
+        self.journalPath = setting.get('journalPath') or JOURNAL_PATH
+
+        # 合约配置字典，key为vtSymbol，value为配置字典（dbName、size、rate、slippage）
+        self.symbolDict = OrderedDict()
+
+        # 外部直接设置的历史数据，key为vtSymbol，value为ColumnData对象
+        self.historyDataDict = {}
+
+        # 策略回测引擎字典，key为策略名称，value为该策略使用的BacktestingEngine
+        self.engineDict = OrderedDict()
+
+        # 回测用的数据，key为vtSymbol，value为ColumnData对象
+        self.backtestingDataDict = OrderedDict()
+
+    #----------------------------------------------------------------------
+    def setStartDate(self, startDate='20100416', initDays=10):
+        """设置回测的启动日期"""
+        self.startDate = startDate
+        self.initDays = initDays
+
+    #----------------------------------------------------------------------
+    def setEndDate(self, endDate=''):
+        """设置回测的结束日期"""
+        self.endDate = endDate
+
+    #----------------------------------------------------------------------
+    def setBacktestingMode(self, mode):
+        """设置回测模式"""
+        self.mode = mode
+
+    #----------------------------------------------------------------------
+    def setCacheActive(self, active):
+        """设置是否使用本地缓存的历史数据"""
+        self.cacheActive = active
+
+    #----------------------------------------------------------------------
+    def setSlotDataActive(self, active):
+        """设置是否使用__slots__版本的数据类"""
+        self.slotDataActive = active
+
+    #----------------------------------------------------------------------
+    def setStorageBackend(self, backend, journalPath=''):
+        """设置历史数据的存储后端"""
+        self.storageBackend = backend
+        if journalPath:
+            self.journalPath = journalPath
+
+    #----------------------------------------------------------------------
+    def addSymbol(self, vtSymbol, dbName=MINUTE_DB_NAME, size=1, rate=0, slippage=0):
+        """添加合约，dbName为历史数据所在的数据库，集合名和vtSymbol相同"""
+        self.symbolDict[vtSymbol] = {'dbName': dbName,
+                                     'size': size,
+                                     'rate': rate,
+                                     'slippage': slippage}
+
+    #----------------------------------------------------------------------
+    def setHistoryData(self, vtSymbol, columnData):
+        """直接设置合约的历史数据（ColumnData对象，包括初始化数据），回测时不再从数据库载入"""
+        self.historyDataDict[vtSymbol] = columnData
+
+    #----------------------------------------------------------------------
+    def addStrategy(self, strategyClass, setting=None, infoSymbolList=None):
+        """
+        添加策略，返回策略对象
+        setting中没有name时使用"策略类名.合约代码"作为名称，名称重复时在后面加上序号
+        infoSymbolList为辅助品种的合约代码列表，策略通过onBar(bar, infobar=...)接收辅助品种的K线
+        """
+        if infoSymbolList:
+            engine = InfoBarBacktestingEngine()
+        else:
+            engine = BacktestingEngine()
+        engine.initStrategy(strategyClass, setting)
+        strategy = engine.strategy
+
+        vtSymbol = strategy.vtSymbol
+        for symbol in [vtSymbol] + list(infoSymbolList or []):
+            if symbol not in self.symbolDict:
+                raise KeyError(u'策略%s的合约%s尚未添加' %(strategy.className, symbol))
+
+        symbolSetting = self.symbolDict[vtSymbol]
+        engine.setDatabase(symbolSetting['dbName'], vtSymbol)
+        engine.setSize(symbolSetting['size'])
+        engine.setCommission(symbolSetting['rate'])
+        engine.setSlippage(symbolSetting['slippage'])
+
+        if infoSymbolList:
+            for infoSymbol in infoSymbolList:
+                engine.addInfoSymbol(self.symbolDict[infoSymbol]['dbName'], infoSymbol)
+
+        if setting and setting.get('name'):
+            name = setting['name']
+        else:
+            name = '%s.%s' %(strategy.className, vtSymbol)
+
+        uniqueName = name
+        n = 1
+        while uniqueName in self.engineDict:
+            n += 1
+            uniqueName = '%s.%s' %(name, n)
+
+        strategy.name = uniqueName
+        self.engineDict[uniqueName] = engine
+        return strategy
+
+    #----------------------------------------------------------------------
+    def configureEngine(self, engine):
+        """把组合的回测设置应用到策略的回测引擎上"""
+        engine.setBacktestingMode(self.mode)
+        engine.setStartDate(self.startDate, self.initDays)
+        engine.setEndDate(self.endDate)
+        engine.setCacheActive(self.cacheActive)
+        engine.setSlotDataActive(self.slotDataActive)
+        engine.setStorageBackend(self.storageBackend, self.journalPath)
+
+    #----------------------------------------------------------------------
+    def loadHistoryData(self):
+        """载入所有合约的历史数据，每个合约只载入一次，再设置到订阅该合约的每个策略引擎中"""
+        self.backtestingDataDict.clear()
+
+        for engine in self.engineDict.values():
+            self.configureEngine(engine)
+
+        for vtSymbol, symbolSetting in self.symbolDict.items():
+            engineList = self.getSymbolEngineList(vtSymbol)
+            infoEngineList = self.getInfoEngineList(vtSymbol)
+            if not engineList and not infoEngineList:
+                continue
+
+            # 只作为辅助品种的合约使用单独的引擎载入数据
+            if engineList:
+                loader = engineList[0]
+            else:
+                loader = BacktestingEngine()
+                self.configureEngine(loader)
+                loader.setDatabase(symbolSetting['dbName'], vtSymbol)
+
+            if vtSymbol in self.historyDataDict:
+                loader.setHistoryData(self.historyDataDict[vtSymbol])
+            else:
+                loader.loadHistoryData()
+
+            for engine in engineList[1:]:
+                engine.setHistoryData(loader.historyData)
+
+            for engine in infoEngineList:
+                engine.setInfoInitData(vtSymbol, loader.historyData)
+
+            self.backtestingDataDict[vtSymbol] = loader.backtestingData
+
+    #----------------------------------------------------------------------
+    def getSymbolEngineList(self, vtSymbol):
+        """获取交易某个合约的策略引擎列表"""
+        return [engine for engine in self.engineDict.values() if engine.symbol == vtSymbol]
+
+    #----------------------------------------------------------------------
+    def getInfoEngineList(self, vtSymbol):
+        """获取以某个合约为辅助品种的策略引擎列表"""
+        return [engine for engine in self.engineDict.values()
+                if isinstance(engine, InfoBarBacktestingEngine) and vtSymbol in engine.infoKeyDict]
+
+    #----------------------------------------------------------------------
+    def runBacktesting(self):
+        """
+        运行回测
+
+        所有合约的数据按时间合并后依次推送，同一时间的数据按照addSymbol的顺序推送；
+        同一合约上的多个策略收到的是同一个数据对象，策略中不应修改推送的数据
+
+        有策略订阅辅助品种时，同一时间的数据先更新所有辅助品种的K线，再推送给策略，
+        和BacktestEngineMultiTF一样，策略收到时间不晚于当前K线的辅助品种K线
+        """
+        self.loadHistoryData()
+
+        self.output("Start portfolio backtesing!")
+
+        for engine in self.engineDict.values():
+            engine.startStrategy()
+
+        # 每个合约的数据推送函数列表、辅助品种更新函数列表和数据生成器
+        funcListList = []
+        infoFuncListList = []
+        iterList = []
+        datetimeList = []
+
+        for vtSymbol, columnData in self.backtestingDataDict.items():
+            engineList = self.getSymbolEngineList(vtSymbol)
+            if self.mode == self.BAR_MODE:
+                funcListList.append([engine.newBar for engine in engineList])
+                infoFuncListList.append([partial(engine.updateInfoBar, vtSymbol)
+                                         for engine in self.getInfoEngineList(vtSymbol)])
+            else:
+                funcListList.append([engine.newTick for engine in engineList])
+                infoFuncListList.append([])
+
+            iterList.append(columnData.iterData().next)
+            datetimeList.append(columnData.getColumn('datetime'))
+
+        infoActive = any(infoFuncListList)
+        if self.mode != self.BAR_MODE and any([isinstance(engine, InfoBarBacktestingEngine)
+                                               for engine in self.engineDict.values()]):
+            self.output(u'辅助品种只支持K线模式，Tick模式下不推送辅助品种的K线')
+
+        self.output("Processing historical data...")
+
+        start = _time()
+        sequence = mergeDatetimeIndex(datetimeList)
+
+        # 分块转换为python整数，避免一次性生成过长的列表
+        if not infoActive:
+            for n in xrange(0, len(sequence), CHUNK_SIZE):
+                for i in sequence[n:n+CHUNK_SIZE].tolist():
+                    data = iterList[i]()
+                    for func in funcListList[i]:
+                        func(data)
+        else:
+            # 同一时间的数据先更新辅助品种，时间变化时再推送给策略
+            pendingList = []
+            currentDatetime = None
+            for n in xrange(0, len(sequence), CHUNK_SIZE):
+                for i in sequence[n:n+CHUNK_SIZE].tolist():
+                    data = iterList[i]()
+                    if data.datetime != currentDatetime:
+                        for funcList, pendingData in pendingList:
+                            for func in funcList:
+                                func(pendingData)
+                        pendingList = []
+                        currentDatetime = data.datetime
+
+                    for func in infoFuncListList[i]:
+                        func(data)
+                    pendingList.append((funcListList[i], data))
+
+            for funcList, pendingData in pendingList:
+                for func in funcList:
+                    func(pendingData)
+
+        self.output("No more historical data, data volumn: %s, time cost: %.2fs" %(len(sequence), _time()-start))
+
+    #----------------------------------------------------------------------
+    def calculateBacktestingResult(self):
+        """
+        计算回测结果
+
+        返回的字典中包括组合整体的结果（字段和BacktestingEngine的结果相同，
+        每笔交易按平仓时间合并），以及strategyResult：策略名称到该策略回测结果的字典
+        """
+        self.output("Calculating portfolio backtesting result")
+
+        strategyResult = OrderedDict()
+        tradeList = []          # (平仓时间, 盈亏)
+
+        totalTurnover = 0
+        totalCommission = 0
+        totalSlippage = 0
+
+        for name, engine in self.engineDict.items():
+            d = engine.calculateBacktestingResult()
+            strategyResult[name] = d
+            if not d:
+                continue
+
+            tradeList.extend(zip(d['timeList'], d['pnlList']))
+            totalTurnover += d['totalTurnover']
+            totalCommission += d['totalCommission']
+            totalSlippage += d['totalSlippage']
+
+        if not tradeList:
+            self.output("No trade has been recorded")
+            return {}
+
+        # 按平仓时间排序，时间相同时保持策略添加的顺序
+        tradeList.sort(key=lambda trade: trade[0])
+        timeList = [trade[0] for trade in tradeList]
+        pnlList = [trade[1] for trade in tradeList]
+
+        d = calculateTradeStatistics(timeList, pnlList, totalTurnover, totalCommission, totalSlippage)
+        d['strategyResult'] = strategyResult
+
+        return d
+
+    #----------------------------------------------------------------------
+    def showBacktestingResult(self):
+        """显示回测结果"""
+        d = self.calculateBacktestingResult()
+        if not d:
+            return
+
+        self.output('-' * 30)
+        for name, result in d['strategyResult'].items():
+            if result:
+                self.output('%s\tTrades: %s\tReturn: %s' %(name, formatNumber(result['totalResult']),
+                                                           formatNumber(result['capital'])))
+            else:
+                self.output('%s\tNo trade' %name)
+
+        self.output('-' * 30)
+        self.output('First Trade：\t%s' % d['timeList'][0])
+        self.output('Last Trade：\t%s' % d['timeList'][-1])
+
+        self.output('Total Trades：\t%s' % formatNumber(d['totalResult']))
+        self.output('Total Return：\t%s' % formatNumber(d['capital']))
+        self.output('Maximum Drawdown: \t%s' % formatNumber(min(d['drawdownList'])))
+
+        self.output('Win Ratio\t\t%s%%' %formatNumber(d['winningRate']))
+        self.output('Profit Factor：\t%s' %formatNumber(d['profitLossRatio']))
+        self.output('Sharpe Ratio：\t%s' %formatNumber(d['sharpeRatio']))
+        self.output('Max Drawdown Duration：\t%s' %d['maxDrawdownDuration'])
+
+    #----------------------------------------------------------------------
+    def output(self, content):
+        """输出内容"""
+        print str(datetime.now()) + "\t" + content
+
+
+########################################################################
+class InfoBarBacktestingEngine(BacktestingEngine):
+    """
+    组合回测中订阅了辅助品种的策略使用的回测引擎
+
+    和BacktestEngineMultiTF的接口一致：辅助品种的键为"数据库名 合约代码"，
+    onBar(bar, infobar=...)推送的字典中为上一根K线之后收到的最新辅助品种K线，没有时为None；
+    initInfoCursor中为策略初始化期间的辅助品种数据（字典的迭代器），供策略的onInit使用
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self):
+        """Constructor"""
+        super(InfoBarBacktestingEngine, self).__init__()
+
+        self.infoKeyDict = OrderedDict()    # key为辅助品种的vtSymbol，value为infobar中的键
+        self.infobar = OrderedDict()        # key为辅助品种的键，value为尚未推送的最新K线
+        self.initInfoCursor = {}            # key为辅助品种的键，value为初始化数据的迭代器
+
+    #----------------------------------------------------------------------
+    def addInfoSymbol(self, dbName, vtSymbol):
+        """添加辅助品种"""
+        key = ' '.join([dbName, vtSymbol])
+        self.infoKeyDict[vtSymbol] = key
+        self.infobar[key] = None
+
+    #----------------------------------------------------------------------
+    def setInfoInitData(self, vtSymbol, columnData):
+        """设置辅助品种的历史数据，其中策略启动日期之前的部分作为初始化数据"""
+        initData = columnData.sliceByDatetime(end=self.strategyStartDate).toList()
+        self.initInfoCursor[self.infoKeyDict[vtSymbol]] = iter([getDataDict(data) for data in initData])
+
+    #----------------------------------------------------------------------
+    def updateInfoBar(self, vtSymbol, bar):
+        """收到辅助品种的K线"""
+        self.infobar[self.infoKeyDict[vtSymbol]] = bar
+
+    #----------------------------------------------------------------------
+    def newBar(self, bar):
+        """新的K线，和辅助品种的K线一起推送到策略中"""
+        self.bar = bar
+        self.dt = bar.datetime
+        self.updatePosition()       # Update total position value based on new Bar
+        self.crossLimitOrder()      # 先撮合限价单
+        self.crossStopOrder()       # 再撮合停止单
+
+        infobar = self.infobar.copy()
+        for key in self.infobar:
+            self.infobar[key] = None
+        self.strategy.onBar(bar, infobar=infobar)    # 推送K线到策略中
+
+
+#----------------------------------------------------------------------
+def mergeDatetimeIndex(datetimeList):
+    """
+    合并多个各自按时间排序的datetime64数组，返回合并后每个位置的数据来自的数组序号，
+    时间相同时按照数组的顺序排列（使用稳定排序）
+    """
+    if not datetimeList:
+        return np.array([], dtype=np.int32)
+
+    indexList = [np.full(len(dt), n, dtype=np.int32) for n, dt in enumerate(datetimeList)]
+    order = np.concatenate(datetimeList).argsort(kind='mergesort')
+    return np.concatenate(indexList)[order]
+
+
+#----------------------------------------------------------------------
+def benchmarkPortfolioBacktesting(symbolCount=30, count=100000):
+    """
+    组合回测的性能测试：使用本地生成的symbolCount个合约、每个count条K线数据，
+    每个合约运行一个双均线策略，统计时间合并和整体回测的耗时
+    """
+    from datetime import timedelta
+    from ctaDemo import DoubleEmaDemo
+
+    print u'生成%s个合约，每个%s条测试K线数据' %(symbolCount, count)
+    engine = PortfolioBacktestingEngine()
+    engine.setBacktestingMode(engine.BAR_MODE)
+    engine.setStartDate('20100104', 10)
+
+    startDatetime = datetime(2010, 1, 4, 9, 0)
+    for n in range(symbolCount):
+        vtSymbol = 'TEST%s' %n
+        # 每个合约的开始时间错开，模拟不同的交易时段
+        docList = generateBarDocument(count, startDatetime + timedelta(minutes=n), seed=n)
+        engine.addSymbol(vtSymbol, size=10, rate=0.3/10000, slippage=0.2)
+        engine.setHistoryData(vtSymbol, loadColumnData(docList, CtaBarData))
+        engine.addStrategy(DoubleEmaDemo, {'vtSymbol': vtSymbol})
+        del docList
+
+    datetimeList = [columnData.getColumn('datetime') for columnData in engine.historyDataDict.values()]
+    start = _time()
+    mergeDatetimeIndex(datetimeList)
+    print u'时间合并耗时：%.3f秒' %(_time()-start)
+
+    start = _time()
+    engine.runBacktesting()
+    cost = _time() - start
+
+    d = engine.calculateBacktestingResult()
+    total = symbolCount * count
+    print u'组合回测耗时：%.2f秒，每秒处理%.0f条数据，总成交笔数：%s' %(cost, total/cost,
+                                                       d.get('totalResult', 0))
+
+
+if __name__ == '__main__':
+    # 组合回测的演示脚本
+    from ctaDemo import DoubleEmaDemo
+
+    engine = PortfolioBacktestingEngine()
+    engine.setBacktestingMode(engine.BAR_MODE)
+    engine.setStartDate('20140101')
+
+    # 添加合约：合约代码、数据库、合约大小、手续费率、滑点
+    engine.addSymbol('IF0000', MINUTE_DB_NAME, 300, 0.3/10000, 0.2)
+    engine.addSymbol('IH0000', MINUTE_DB_NAME, 300, 0.3/10000, 0.2)
+
+    # 添加策略，同一合约可以运行多个策略
+    engine.addStrategy(DoubleEmaDemo, {'vtSymbol': 'IF0000'})
+    engine.addStrategy(DoubleEmaDemo, {'vtSymbol': 'IF0000', 'fastK': 0.8, 'slowK': 0.05})
+    engine.addStrategy(DoubleEmaDemo, {'vtSymbol': 'IH0000'})
+
+    engine.runBacktesting()
+    engine.showBacktestingResult()
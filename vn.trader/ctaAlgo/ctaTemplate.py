@@ -16,7 +16,7 @@ class CtaTemplate(object):
     className = 'CtaTemplate'
     author = EMPTY_UNICODE
     
-    # MongoDB数据库的名称，K线数据库默认为1分钟
+    # MongoDB数据库的名称，K线数据库默认为1分钟，也可以使用数据记录引擎生成的其他周期（如MINUTE_5_DB_NAME）
     tickDbName = TICK_DB_NAME
     barDbName = MINUTE_DB_NAME
     
@@ -89,6 +89,15 @@ class CtaTemplate(object):
         """收到Bar推送（必须由用户继承实现）"""
         raise NotImplementedError
     
+    #----------------------------------------------------------------------
+    def calculateTargetPos(self, data, startIndex):
+        """
+        计算向量化回测用的目标仓位数组（可选实现）
+        data为历史数据字段名到numpy数组的字典，startIndex为回测开始的位置，
+        返回每根K线结束时的目标仓位数组，或者(目标仓位数组, 委托价格数组)
+        """
+        raise NotImplementedError
+    
     #----------------------------------------------------------------------
     def buy(self, price, volume, stop=False):
         """买开"""
@@ -1,19 +1,67 @@
 # encoding: UTF-8
 
-'''一个简单的通联数据客户端，主要使用requests开发，比通联官网的python例子更为简洁。'''
+'''
+一个简单的通联数据客户端，主要使用requests开发，比通联官网的python例子更为简洁。
 
+客户端可以在多个线程中共享使用：
+1. 每个线程使用各自的requests.Session保持连接
+2. 所有线程共享请求频率限制（datayes.json中的rateLimit，每秒请求次数，0为不限制）
+3. 网络异常、http状态码429和5xx时按照retryDelay * 2^n秒的间隔重试，最多重试maxRetry次
+'''
 
-import requests
+import os
 import json
+from threading import Lock, local
+from time import time, sleep
+
+import requests
 
 FILENAME = 'datayes.json'
 HTTP_OK = 200
+HTTP_RETRY_STATUS = set([429, 500, 502, 503, 504])     # 需要重试的http状态码
+NO_DATA_CODE = -1                                       # 查询成功但没有数据时的返回代码
+
+
+########################################################################
+class DatayesError(Exception):
+    """通联数据请求失败（重试之后仍然失败，或者返回了查询失败的信息）"""
+    pass
+
+
+########################################################################
+class RateLimiter(object):
+    """请求频率限制，保证相邻两次请求的间隔不小于1/rate秒，可以在多个线程中共享"""
+
+    #----------------------------------------------------------------------
+    def __init__(self, rate):
+        """Constructor"""
+        if rate > 0:
+            self.interval = 1.0 / rate
+        else:
+            self.interval = 0
+
+        self.nextTime = 0               # 下一次允许请求的时间
+        self.lock = Lock()
+
+    #----------------------------------------------------------------------
+    def wait(self):
+        """等待到允许请求的时间"""
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time()
+            requestTime = max(now, self.nextTime)
+            self.nextTime = requestTime + self.interval
+
+        if requestTime > now:
+            sleep(requestTime - now)
 
 
 ########################################################################
 class DatayesClient(object):
     """通联数据客户端"""
-    
+
     name = u'通联数据客户端'
 
     #----------------------------------------------------------------------
@@ -24,20 +72,27 @@ class DatayesClient(object):
         self.token = ''     # 授权码
         self.header = {}    # http请求头部
         self.settingLoaded = False  # 配置是否已经读取
-        
+
+        self.timeout = 30           # 单次请求超时（秒）
+        self.maxRetry = 3           # 最大重试次数
+        self.retryDelay = 1.0       # 第一次重试前的等待时间（秒），之后每次加倍
+        self.rateLimiter = RateLimiter(0)
+
+        self.local = local()        # 保存每个线程各自的Session
+
         self.loadSetting()
-        
+
     #----------------------------------------------------------------------
     def loadSetting(self):
         """载入配置"""
         try:
             path = os.path.abspath(os.path.dirname(__file__))
-            FILENAME = os.path.join(path, FILENAME)            
-            f = file(FILENAME)
+            fileName = os.path.join(path, FILENAME)
+            f = file(fileName)
         except IOError:
             print u'%s无法打开配置文件' % self.name
             return
-        
+
         setting = json.load(f)
         try:
             self.domain = str(setting['domain'])
@@ -46,38 +101,75 @@ class DatayesClient(object):
         except KeyError:
             print u'%s配置文件字段缺失' % self.name
             return
-        
+
+        self.timeout = setting.get('timeout', self.timeout)
+        self.maxRetry = setting.get('maxRetry', self.maxRetry)
+        self.retryDelay = setting.get('retryDelay', self.retryDelay)
+        self.rateLimiter = RateLimiter(setting.get('rateLimit', 0))
+
         self.header['Connection'] = 'keep_alive'
         self.header['Authorization'] = 'Bearer ' + self.token
         self.settingLoaded = True
-        
+
         print u'%s配置载入完成' % self.name
-        
-    
+
     #----------------------------------------------------------------------
-    def downloadData(self, path, params):
-        """下载数据"""
+    def getSession(self):
+        """获取当前线程的Session"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.header)
+            self.local.session = session
+        return session
+
+    #----------------------------------------------------------------------
+    def requestData(self, path, params):
+        """
+        请求数据，返回数据列表（没有数据时为空列表），失败时抛出DatayesError
+        网络异常和服务器暂时不可用时自动重试
+        """
         if not self.settingLoaded:
-            print u'%s配置未载入' % self.name
-            return None
-        else:
-            url = '/'.join([self.domain, self.version, path])
-            r = requests.get(url=url, headers=self.header, params=params)
-            
-            if r.status_code != HTTP_OK:
-                print u'%shttp请求失败，状态代码%s' %(self.name, r.status_code)
-                return None
+            raise DatayesError(u'%s配置未载入' % self.name)
+
+        url = '/'.join([self.domain, self.version, path])
+        session = self.getSession()
+        error = u''
+
+        for n in range(self.maxRetry + 1):
+            if n:
+                sleep(self.retryDelay * 2 ** (n - 1))
+            self.rateLimiter.wait()
+
+            try:
+                r = session.get(url=url, params=params, timeout=self.timeout)
+            except requests.RequestException, e:
+                error = u'%shttp请求异常：%s' %(self.name, e)
+                continue
+
+            if r.status_code in HTTP_RETRY_STATUS:
+                error = u'%shttp请求失败，状态代码%s' %(self.name, r.status_code)
+                continue
+            elif r.status_code != HTTP_OK:
+                raise DatayesError(u'%shttp请求失败，状态代码%s' %(self.name, r.status_code))
+
+            result = r.json()
+            if result.get('retMsg') == 'Success':
+                return result['data']
+            elif result.get('retCode') == NO_DATA_CODE:
+                return []
+            elif 'retMsg' in result:
+                raise DatayesError(u'%s查询失败，返回信息%s' %(self.name, result['retMsg']))
             else:
-                result = r.json()
-                if 'retMsg' in result and result['retMsg'] == 'Success':
-                    return result['data']
-                else:
-                    if 'retMsg' in result:
-                        print u'%s查询失败，返回信息%s' %(self.name, result['retMsg'])
-                    elif 'message' in result:
-                        print u'%s查询失败，返回信息%s' %(self.name, result['message'])
-                    return None
-                    
-                    
-    
-    
\ No newline at end of file
+                raise DatayesError(u'%s查询失败，返回信息%s' %(self.name, result.get('message')))
+
+        raise DatayesError(error)
+
+    #----------------------------------------------------------------------
+    def downloadData(self, path, params):
+        """下载数据，失败时打印错误信息并返回None"""
+        try:
+            return self.requestData(path, params)
+        except DatayesError, e:
+            print e.message
+            return None
@@ -5,7 +5,7 @@
 
 注意事项：
 1. 作者不对交易盈利做任何保证，策略代码仅供参考
-2. 本策略需要用到talib，没有安装的用户请先参考www.vnpy.org上的教程安装
+2. 指标使用ctaIndicator中的增量计算工具，计算结果和talib一致
 3. 将IF0000_1min.csv用ctaHistoryData.py导入MongoDB后，直接运行本文件即可回测策略
 
 """
@@ -13,9 +13,7 @@
 
 from ctaBase import *
 from ctaTemplate import CtaTemplate
-
-import talib
-import numpy as np
+from ctaIndicator import AtrIndicator, RsiIndicator, SmaIndicator
 
 
 ########################################################################
@@ -36,15 +34,11 @@ class AtrRsiStrategy(CtaTemplate):
     bar = None                  # K线对象
     barMinute = EMPTY_STRING    # K线当前的分钟
 
-    bufferSize = 1000                  # 需要缓存的数据的大小
+    bufferSize = 1000                   # 开始计算指标前需要的K线数量
                                         # Pre-calculation number
     bufferCount = 0                     # 目前已经缓存了的数据的计数
-    highArray = np.zeros(bufferSize)    # K线最高价的数组
-    lowArray = np.zeros(bufferSize)     # K线最低价的数组
-    closeArray = np.zeros(bufferSize)   # K线收盘价的数组
     
-    atrCount = 0                        # 目前已经缓存了的ATR的计数
-    atrArray = np.zeros(bufferSize)     # ATR指标的数组
+    atrCount = 0                        # 目前已经计算了的ATR的计数
     atrValue = 0                        # 最新的ATR指标数值
     atrMa = 0                           # ATR移动平均的数值
 
@@ -86,6 +80,12 @@ class AtrRsiStrategy(CtaTemplate):
         # 否则会出现多个策略实例之间数据共享的情况，有可能导致潜在的策略逻辑错误风险，
         # 策略类中的这些可变对象属性可以选择不写，全都放在__init__下面，写主要是为了阅读
         # 策略时方便（更多是个编程习惯的选择）        
+        self.orderList = []
+        
+        # 增量计算的指标，每个策略实例单独创建
+        self.atr = AtrIndicator(self.atrLength)
+        self.atrMaIndicator = SmaIndicator(self.atrMaLength)
+        self.rsi = RsiIndicator(self.rsiLength)
 
     #----------------------------------------------------------------------
     def onInit(self):
@@ -156,35 +156,24 @@ class AtrRsiStrategy(CtaTemplate):
             self.cancelOrder(orderID)
         self.orderList = []
 
-        # 保存K线数据
-        self.closeArray[0:self.bufferSize-1] = self.closeArray[1:self.bufferSize]
-        self.highArray[0:self.bufferSize-1] = self.highArray[1:self.bufferSize]
-        self.lowArray[0:self.bufferSize-1] = self.lowArray[1:self.bufferSize]
-        
-        self.closeArray[-1] = bar.close
-        self.highArray[-1] = bar.high
-        self.lowArray[-1] = bar.low
+        # 增量更新指标，每根K线的计算量和缓存大小无关
+        atrValue = self.atr.update(bar.high, bar.low, bar.close)
+        rsiValue = self.rsi.update(bar.close)
         
         self.bufferCount += 1
         if self.bufferCount < self.bufferSize:
             return
 
         # 计算指标数值
-        self.atrValue = talib.ATR(self.highArray, 
-                                  self.lowArray, 
-                                  self.closeArray,
-                                  self.atrLength)[-1]
-        self.atrArray[0:self.bufferSize-1] = self.atrArray[1:self.bufferSize]
-        self.atrArray[-1] = self.atrValue
+        self.atrValue = atrValue
+        self.atrMaIndicator.update(atrValue)
 
         self.atrCount += 1
         if self.atrCount < self.bufferSize:
             return
 
-        self.atrMa = talib.MA(self.atrArray, 
-                              self.atrMaLength)[-1]
-        self.rsiValue = talib.RSI(self.closeArray, 
-                                  self.rsiLength)[-1]
+        self.atrMa = self.atrMaIndicator.value
+        self.rsiValue = rsiValue
 
         # 判断是否要进行交易
         
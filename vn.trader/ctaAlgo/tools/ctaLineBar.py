@@ -6,9 +6,10 @@
 from vtConstant import *
 from ctaBase import *
 
+from ctaIndicator import RingBuffer, SmaIndicator, BollIndicator, DonchianIndicator
+
 from datetime import datetime
 
-import talib as ta
 import numpy
 import copy,csv
 
@@ -34,6 +35,8 @@ class CtaLineBar(object):
     self.lineM.onTick(tick)
     self.lineM5.onTick(tick) # 如果你使用2个周期
     3、在onBar事件中，按照k线结束使用；其他任何情况下bar内使用，通过对象使用即可，self.lineM.lineBar[-1].close
+    4、已完成K线的高低收和成交量保存在固定长度的数组中，各指标在K线完成时增量更新，
+       lineBar和各指标队列只保留有限长度，多周期、多合约同时运行时内存和计算量保持稳定
     """
 
     # 参数列表，保存了参数的名称
@@ -44,7 +47,8 @@ class CtaLineBar(object):
         # OnBar事件回调函数
         self.onBarFunc = onBarFunc
 
-        # 参数列表
+        # 参数列表（复制类属性，避免多个实例重复添加）
+        self.paramList = list(self.paramList)
         self.paramList.append('barTimeInterval')
         self.paramList.append('inputPreLen')
         self.paramList.append('inputEma1Len')
@@ -101,6 +105,8 @@ class CtaLineBar(object):
         # K线保存数据
         self.bar = None                # K线数据对象
         self.lineBar = []              # K线缓存数据队列
+        self.maxBarLen = 60 * 8        # K线缓存数据队列的最大长度
+        self.barCount = 0              # 累计生成的K线数量（包括当前未完成的K线）
         self.barFirstTick =False       # K线的第一条Tick数据
 
         # K 线的相关计算结果数据
@@ -171,6 +177,9 @@ class CtaLineBar(object):
         if setting:
             self.setParam(setting)
 
+        # 已完成K线的数据数组和增量计算的指标
+        self.__initIndicator()
+
     def setParam(self, setting):
         """设置参数"""
         d = self.__dict__
@@ -202,7 +211,7 @@ class CtaLineBar(object):
         l1 = len(self.lineBar)
 
         if l1 == 0:
-            self.lineBar.append(bar)
+            self.__appendBar(bar)
             self.onBar(bar)
             return
 
@@ -210,7 +219,7 @@ class CtaLineBar(object):
         lastBar = self.lineBar[-1]
 
         if (bar.datetime - lastBar.datetime).seconds >= self.barTimeInterval:
-            self.lineBar.append(bar)
+            self.__appendBar(bar)
             self.onBar(bar)
             return
 
@@ -223,6 +232,10 @@ class CtaLineBar(object):
 
     def onBar(self, bar):
         """OnBar事件"""
+        # 新K线推入后，倒数第二根K线已完成，更新数据数组和增量指标
+        if self.barCount > 1:
+            self.__updateClosedBar(self.lineBar[-2])
+
         # 计算相关数据
         self.__recountPreHighLow()
         self.__recountEma()
@@ -261,7 +274,7 @@ class CtaLineBar(object):
 
         self.barFirstTick = True                  # 标识该Tick属于该Bar的第一个tick数据
 
-        self.lineBar.append(self.bar)           # 推入到lineBar队列
+        self.__appendBar(self.bar)              # 推入到lineBar队列
 
     # ----------------------------------------------------------------------
     def __drawLineBar(self, tick):
@@ -275,10 +288,6 @@ class CtaLineBar(object):
             self.onBar(self.bar)
             return
 
-        # 清除8交易小时前的数据，
-        if l1 > 60 * 8:
-            del self.lineBar[0]
-
         # 与最后一个BAR的时间比对，判断是否超过5分钟
         lastBar = self.lineBar[-1]
 
@@ -311,7 +320,7 @@ class CtaLineBar(object):
                     upbar.high = upbar.close
                     upbar.volume = 0
 
-                    self.lineBar.append(upbar)
+                    self.__appendBar(upbar)
                     self.onBar(upbar)
 
             else:                                            # 价格往下跳
@@ -325,14 +334,14 @@ class CtaLineBar(object):
                     downbar.low = downbar.close
                     downbar.volume = 0
 
-                    self.lineBar.append(downbar)
+                    self.__appendBar(downbar)
                     self.onBar(downbar)
 
             # 生成平移K线，减小Pdi，Mdi、ADX变动
             for i in range(0, jumpBars*2, 1):
                 equalbar=copy.deepcopy(self.lineBar[-1])
                 equalbar.volume = 0
-                self.lineBar.append(equalbar)
+                self.__appendBar(equalbar)
                 self.onBar(equalbar)
 
             # 重新指定为最后一个Bar
@@ -382,6 +391,140 @@ class CtaLineBar(object):
             else:
                 lastBar.color = COLOR_EQUAL
 
+    # ----------------------------------------------------------------------
+    def __initIndicator(self):
+        """根据参数创建已完成K线的数据数组和增量计算的指标"""
+        # 已完成K线的最高、最低、收盘价和成交量数组，长度满足各指标的最大周期
+        bufferSize = max(2, self.inputPreLen, self.inputEma1Len, self.inputEma2Len, self.inputDmiLen,
+                         self.inputAtr1Len, self.inputAtr2Len, self.inputAtr3Len, self.inputVolLen,
+                         self.inputRsiLen, self.inputCmiLen, self.inputBollLen)
+        self.highArray = RingBuffer(bufferSize)
+        self.lowArray = RingBuffer(bufferSize)
+        self.closeArray = RingBuffer(bufferSize)
+        self.volumeArray = RingBuffer(bufferSize)
+
+        # 前inputPreLen周期的最高和最低
+        if self.inputPreLen > 0:
+            self.preDonchian = DonchianIndicator(self.inputPreLen)
+
+        # 前inputEma1Len、inputEma2Len周期收盘价的均值
+        if self.inputEma1Len > 0:
+            self.ema1Sma = SmaIndicator(self.inputEma1Len)
+        if self.inputEma2Len > 0:
+            self.ema2Sma = SmaIndicator(self.inputEma2Len)
+
+        # 前inputDmiLen周期的TR、做多价差、做空价差之和，以及计算ADX用的DX均值
+        if self.inputDmiLen > 0:
+            self.trSma = SmaIndicator(self.inputDmiLen)
+            self.pdmSma = SmaIndicator(self.inputDmiLen)
+            self.mdmSma = SmaIndicator(self.inputDmiLen)
+            self.dxSma = SmaIndicator(self.inputDmiLen)
+            self.dxCount = 0                    # 累计计算的DX数量
+            self.dxSmaIndex = -1                # 最后一个计入均值的DX序号
+
+        # 前maxAtrLen周期的TR
+        maxAtrLen = max(self.inputAtr1Len, self.inputAtr2Len, self.inputAtr3Len)
+        if maxAtrLen > 0:
+            self.trArray = RingBuffer(maxAtrLen)
+
+        # 前inputVolLen周期的平均成交量
+        if self.inputVolLen > 0:
+            self.volSma = SmaIndicator(self.inputVolLen)
+
+        # 前inputRsiLen周期的平均涨幅和平均跌幅
+        if self.inputRsiLen > 0:
+            self.gainSma = SmaIndicator(self.inputRsiLen)
+            self.lossSma = SmaIndicator(self.inputRsiLen)
+
+        # 前inputCmiLen-1周期收盘价的最高和最低（加上当前K线共inputCmiLen周期）
+        if self.inputCmiLen > 1:
+            self.cmiDonchian = DonchianIndicator(self.inputCmiLen-1)
+
+        # 前inputBollLen周期收盘价的布林带
+        if self.inputBollLen > 0:
+            self.boll = BollIndicator(self.inputBollLen, self.inputBollStdRate, self.inputBollStdRate)
+
+    # ----------------------------------------------------------------------
+    def __appendBar(self, bar):
+        """推入新的K线，超过最大长度时删除最早的K线"""
+        if len(self.lineBar) > self.maxBarLen:
+            del self.lineBar[0]
+
+        self.lineBar.append(bar)
+        self.barCount += 1
+
+    # ----------------------------------------------------------------------
+    def __updateClosedBar(self, bar):
+        """K线完成后，更新数据数组和增量指标，每根K线只更新一次"""
+        high = bar.high
+        low = bar.low
+        close = bar.close
+
+        # 计算真实波幅和动向（第一根K线没有前一根K线，只计算最高与最低的价差）
+        if self.closeArray.count:
+            preHigh = self.highArray.getLast()
+            preLow = self.lowArray.getLast()
+            preClose = self.closeArray.getLast()
+
+            tr = max(high - low, abs(high - preClose), abs(low - preClose))
+            highPrehighSpread = high - preHigh
+            lowPrelowSpread = preLow - low
+            change = close - preClose
+        else:
+            tr = high - low
+            highPrehighSpread = EMPTY_FLOAT
+            lowPrelowSpread = EMPTY_FLOAT
+            change = None
+
+        self.highArray.update(high)
+        self.lowArray.update(low)
+        self.closeArray.update(close)
+        self.volumeArray.update(bar.volume)
+
+        if self.inputPreLen > 0:
+            self.preDonchian.update(high, low)
+
+        if self.inputEma1Len > 0:
+            self.ema1Sma.update(close)
+        if self.inputEma2Len > 0:
+            self.ema2Sma.update(close)
+
+        if self.inputDmiLen > 0:
+            pdm = EMPTY_FLOAT
+            if highPrehighSpread > 0 and highPrehighSpread > lowPrelowSpread:
+                pdm = highPrehighSpread
+
+            mdm = EMPTY_FLOAT
+            if lowPrelowSpread > 0 and lowPrelowSpread > highPrehighSpread:
+                mdm = lowPrelowSpread
+
+            self.trSma.update(tr)
+            self.pdmSma.update(pdm)
+            self.mdmSma.update(mdm)
+
+        if max(self.inputAtr1Len, self.inputAtr2Len, self.inputAtr3Len) > 0:
+            self.trArray.update(tr)
+
+        if self.inputVolLen > 0:
+            self.volSma.update(bar.volume)
+
+        if self.inputRsiLen > 0 and change is not None:
+            self.gainSma.update(max(change, 0))
+            self.lossSma.update(max(-change, 0))
+
+        if self.inputCmiLen > 1:
+            self.cmiDonchian.update(close, close)
+
+        if self.inputBollLen > 0:
+            self.boll.update(close)
+
+    # ----------------------------------------------------------------------
+    def __getTotal(self, sma):
+        """获取滚动求和的结果，小于最小价格单位千分之一的累加误差视为0"""
+        if abs(sma.total) < self.minDiff * 0.001:
+            return EMPTY_FLOAT
+        return sma.total
+
     # ----------------------------------------------------------------------
     def __recountPreHighLow(self):
         """计算 K线的前周期最高和最低"""
@@ -389,23 +532,15 @@ class CtaLineBar(object):
         if self.inputPreLen <= 0:       # 不计算
             return
 
-        # 1、lineBar满足长度才执行计算
-        if len(self.lineBar) < self.inputPreLen:
+        # 1、已完成的K线满足长度才执行计算
+        if not self.preDonchian.inited:
             self.writeCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算High、Low需要：{1}'.
-                             format(len(self.lineBar), self.inputPreLen))
+                             format(self.barCount, self.inputPreLen+1))
             return
 
-        # 2.计算前inputPreLen周期内(不包含当前周期）的Bar高点和低点
-        preHigh = EMPTY_FLOAT
-        preLow = EMPTY_FLOAT
-
-        for i in range(len(self.lineBar)-2, len(self.lineBar)-2-self.inputPreLen, -1):
-
-            if self.lineBar[i].high > preHigh or preHigh == EMPTY_FLOAT:
-                preHigh = self.lineBar[i].high    # 前InputPreLen周期高点
-
-            if self.lineBar[i].low < preLow or preLow == EMPTY_FLOAT:
-                preLow = self.lineBar[i].low     # 前InputPreLen周期低点
+        # 2.前inputPreLen周期内(不包含当前周期）的Bar高点和低点
+        preHigh = self.preDonchian.up
+        preLow = self.preDonchian.down
 
         # 保存
         if len(self.preHigh) > self.inputPreLen * 8:
@@ -418,32 +553,20 @@ class CtaLineBar(object):
         self.preLow.append(preLow)
 
     #----------------------------------------------------------------------
-
-
     def __recountEma(self):
         """计算K线的EMA1 和EMA2"""
-        l = len(self.lineBar)
 
         # 1、lineBar满足长度才执行计算
-        if len(self.lineBar) < max(7, self.inputEma1Len, self.inputEma2Len)+2:
+        if self.barCount < max(7, self.inputEma1Len, self.inputEma2Len)+2:
             self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算EMA需要：{1}'.
-                             format(len(self.lineBar), max(7, self.inputEma1Len, self.inputEma2Len)+2))
+                             format(self.barCount, max(7, self.inputEma1Len, self.inputEma2Len)+2))
             return
 
         # 计算第一条EMA均线
         if self.inputEma1Len > 0:
 
-            if self.inputEma1Len > l:
-                ema1Len = l
-            else:
-                ema1Len = self.inputEma1Len
-
-            # 3、获取前InputN周期(不包含当前周期）的自适应均线
-            listClose=[x.close for x in self.lineBar[-ema1Len - 1:-1]]
-
-            barEma1 = ta.EMA(numpy.array(listClose, dtype=float), ema1Len)[-1]
-
-            barEma1 = round(float(barEma1), 3)
+            # 前InputN周期(不包含当前周期）的均线，与ta.EMA在InputN个数据上的结果一致
+            barEma1 = round(float(self.ema1Sma.value), 3)
 
             if len(self.lineEma1) > self.inputEma1Len*8:
                 del self.lineEma1[0]
@@ -452,22 +575,12 @@ class CtaLineBar(object):
         # 计算第二条EMA均线
         if self.inputEma2Len > 0:
 
-            if self.inputEma2Len > l:
-                ema2Len = l
-            else:
-                ema2Len = self.inputEma2Len
+            barEma2 = round(float(self.ema2Sma.value), 3)
 
-            # 3、获取前InputN周期(不包含当前周期）的自适应均线
-            listClose=[x.close for x in self.lineBar[-ema2Len - 1:-1]]
-            barEma2 = ta.EMA(numpy.array(listClose, dtype=float), ema2Len)[-1]
-
-            barEma2 = round(float(barEma2), 3)
-
-            if len(self.lineEma2) > self.inputEma1Len*8:
+            if len(self.lineEma2) > self.inputEma2Len*8:
                 del self.lineEma2[0]
             self.lineEma2.append(barEma2)
 
-
     def __recountDmi(self):
         """计算K线的DMI数据和条件"""
 
@@ -475,42 +588,14 @@ class CtaLineBar(object):
             return
 
         # 1、lineMx满足长度才执行计算
-        if len(self.lineBar) < self.inputDmiLen+1:
-            self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算DMI需要：{1}'.format(len(self.lineBar), self.inputDmiLen+1))
+        if self.barCount < self.inputDmiLen+1:
+            self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算DMI需要：{1}'.format(self.barCount, self.inputDmiLen+1))
             return
 
-
-        # 2、根据当前High，Low，(不包含当前周期）重新计算TR1，PDM，MDM和ATR
-        barTr1 = EMPTY_FLOAT      # 获取InputP周期内的价差最大值之和
-        barPdm = EMPTY_FLOAT      # InputP周期内的做多价差之和
-        barMdm = EMPTY_FLOAT      # InputP周期内的做空价差之和
-
-        for i in range(len(self.lineBar)-2, len(self.lineBar)-2-self.inputDmiLen, -1):  # 周期 inputDmiLen
-            # 3.1、计算TR1
-
-            # 当前周期最高与最低的价差
-            high_low_spread = self.lineBar[i].high - self.lineBar[i].low
-            # 当前周期最高与昨收价的价差
-            high_preclose_spread = abs(self.lineBar[i].high - self.lineBar[i - 1].close)
-            # 当前周期最低与昨收价的价差
-            low_preclose_spread = abs(self.lineBar[i].low - self.lineBar[i - 1].close)
-
-            # 最大价差
-            max_spread = max(high_low_spread, high_preclose_spread, low_preclose_spread)
-            barTr1 = barTr1 + float(max_spread)
-
-            # 今高与昨高的价差
-            high_prehigh_spread = self.lineBar[i].high - self.lineBar[i - 1].high
-            # 昨低与今低的价差
-            low_prelow_spread = self.lineBar[i - 1].low - self.lineBar[i].low
-
-            # 3.2、计算周期内的做多价差之和
-            if high_prehigh_spread > 0 and high_prehigh_spread > low_prelow_spread:
-                barPdm = barPdm + high_prehigh_spread
-
-            # 3.3、计算周期内的做空价差之和
-            if low_prelow_spread > 0 and low_prelow_spread > high_prehigh_spread:
-                barMdm = barMdm + low_prelow_spread
+        # 2、前inputDmiLen周期（不包含当前周期）的TR1，PDM，MDM之和，在K线完成时滚动更新
+        barTr1 = self.__getTotal(self.trSma)       # 获取InputP周期内的价差最大值之和
+        barPdm = self.__getTotal(self.pdmSma)      # InputP周期内的做多价差之和
+        barMdm = self.__getTotal(self.mdmSma)      # InputP周期内的做空价差之和
 
         # 6、计算上升动向指标，即做多的比率
         if barTr1 == 0:
@@ -544,12 +629,27 @@ class CtaLineBar(object):
             del self.lineDx[0]
 
         self.lineDx.append(dx)
+        self.dxCount += 1
+
+        # 平均趋向指标，等同于ta.EMA(lineDx, inputDmiLen)[-1]：
+        # 以lineDx中前inputDmiLen个DX的均值为初始值，再对其后的DX做指数平滑
+        if self.dxCount <= self.inputDmiLen+1:
+            dxSmaIndex = self.dxCount - 2
+        else:
+            dxSmaIndex = self.dxCount - 3
 
-        # 平均趋向指标，MA计算
-        if len(self.lineDx) < self.inputDmiLen+1:
+        if dxSmaIndex > self.dxSmaIndex:
+            self.dxSma.update(self.lineDx[dxSmaIndex-self.dxCount])
+            self.dxSmaIndex = dxSmaIndex
+
+        if self.dxCount < self.inputDmiLen+1:
             self.barAdx = dx
         else:
-            self.barAdx = ta.EMA(numpy.array(self.lineDx, dtype=float), self.inputDmiLen)[-1]
+            k = 2.0 / (self.inputDmiLen + 1)
+            barAdx = self.dxSma.value
+            for x in self.lineDx[dxSmaIndex-self.dxCount+1:]:
+                barAdx = (x - barAdx) * k + barAdx
+            self.barAdx = barAdx
 
         # 保存Adx值
         if len(self.lineAdx) > self.inputDmiLen+1:
@@ -611,9 +711,9 @@ class CtaLineBar(object):
         if maxAtrLen <= 0:      # 不计算
             return
 
-        if len(self.lineBar) < maxAtrLen+1:
+        if self.barCount < maxAtrLen+1:
             self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算ATR需要：{1}'.
-                             format(len(self.lineBar), maxAtrLen+1))
+                             format(self.barCount, maxAtrLen+1))
             return
 
         # 首次计算
@@ -621,44 +721,24 @@ class CtaLineBar(object):
                 or (self.inputAtr2Len > 0 and len(self.lineAtr2) < 1) \
                 or (self.inputAtr3Len > 0 and len(self.lineAtr3) < 1):
 
-            # 根据当前High，Low，(不包含当前周期）重新计算TR1和ATR
+            # 前maxAtrLen周期(不包含当前周期）的TR数组，分别求各周期内的价差最大值之和
+            trArray = self.trArray.getArray()
+
             barTr1 = EMPTY_FLOAT      # 获取inputAtr1Len周期内的价差最大值之和
             barTr2 = EMPTY_FLOAT      # 获取inputAtr2Len周期内的价差最大值之和
             barTr3 = EMPTY_FLOAT      # 获取inputAtr3Len周期内的价差最大值之和
 
-            j = 0
-            for i in range(len(self.lineBar)-2, len(self.lineBar)-2-maxAtrLen, -1):  # 周期 inputP
-                # 3.1、计算TR
-
-                # 当前周期最高与最低的价差
-                high_low_spread = self.lineBar[i].high - self.lineBar[i].low
-                # 当前周期最高与昨收价的价差
-                high_preclose_spread = abs(self.lineBar[i].high - self.lineBar[i - 1].close)
-                # 当前周期最低与昨收价的价差
-                low_preclose_spread = abs(self.lineBar[i].low - self.lineBar[i - 1].close)
-
-                # 最大价差
-                max_spread = max(high_low_spread, high_preclose_spread, low_preclose_spread)
-                if j < self.inputAtr1Len:
-                    barTr1 = barTr1 + float(max_spread)
-                if j < self.inputAtr2Len:
-                    barTr2 = barTr2 + float(max_spread)
-                if j < self.inputAtr3Len:
-                    barTr3 = barTr3 + float(max_spread)
-
-                j = j + 1
+            if self.inputAtr1Len > 0:
+                barTr1 = float(trArray[-self.inputAtr1Len:].sum())
+            if self.inputAtr2Len > 0:
+                barTr2 = float(trArray[-self.inputAtr2Len:].sum())
+            if self.inputAtr3Len > 0:
+                barTr3 = float(trArray[-self.inputAtr3Len:].sum())
 
         else: # 只计算一个
 
-            # 当前周期最高与最低的价差
-            high_low_spread = self.lineBar[-2].high - self.lineBar[-2].low
-            # 当前周期最高与昨收价的价差
-            high_preclose_spread = abs(self.lineBar[-2].high - self.lineBar[-3].close)
-            # 当前周期最低与昨收价的价差
-            low_preclose_spread = abs(self.lineBar[-2].low - self.lineBar[-3].close)
-
-            # 最大价差
-            barTr1 = max(high_low_spread, high_preclose_spread, low_preclose_spread)
+            # 最近完成的K线的最大价差
+            barTr1 = self.trArray.getLast()
             barTr2 = barTr1
             barTr3 = barTr1
 
@@ -702,17 +782,15 @@ class CtaLineBar(object):
         if self.inputVolLen <= 0:      # 不计算
             return
 
-        if len(self.lineBar) < self.inputVolLen+1:
+        if self.barCount < self.inputVolLen+1:
             self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算Avg Vol需要：{1}'.
-                             format(len(self.lineBar), self.inputVolLen+1))
+                             format(self.barCount, self.inputVolLen+1))
             return
 
-        listVol = [x.volume for x in self.lineBar[-self.inputVolLen-1: -1]]
-
-        sumVol = ta.SUM(numpy.array(listVol, dtype=float), timeperiod=self.inputVolLen)[-1]
-
-        avgVol = round(sumVol/self.inputVolLen, 0)
+        avgVol = round(self.volSma.value, 0)
 
+        if len(self.lineAvgVol) > self.inputVolLen*8:
+            del self.lineAvgVol[0]
         self.lineAvgVol.append(avgVol)
 
     # ----------------------------------------------------------------------
@@ -722,15 +800,23 @@ class CtaLineBar(object):
         if self.inputRsiLen <= 0: return
 
         # 1、lineBar满足长度才执行计算
-        if len(self.lineBar) < self.inputRsiLen+2:
+        if self.barCount < self.inputRsiLen+2:
             self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算RSI需要：{1}'.
-                             format(len(self.lineBar), self.inputRsiLen+2))
+                             format(self.barCount, self.inputRsiLen+2))
             return
 
-        # 3、inputRsiLen(包含当前周期）的相对强弱
-        listClose=[x.close for x in self.lineBar[-self.inputRsiLen - 2:]]
-        barRsi = ta.RSI(numpy.array(listClose, dtype=float), self.inputRsiLen)[-1]
-        barRsi = round(float(barRsi), 3)
+        # 3、inputRsiLen(包含当前周期）的相对强弱，等同于ta.RSI在最近inputRsiLen+2个收盘价上的结果：
+        # 以已完成K线的平均涨幅和平均跌幅为初始值，再加上当前K线的涨跌做一次平滑
+        n = self.inputRsiLen
+        change = self.lineBar[-1].close - self.closeArray.getLast()
+
+        gain = (self.__getTotal(self.gainSma) / n * (n - 1) + max(change, 0)) / n
+        loss = (self.__getTotal(self.lossSma) / n * (n - 1) + max(-change, 0)) / n
+
+        if gain + loss == 0:
+            barRsi = EMPTY_FLOAT
+        else:
+            barRsi = round(100 * gain / (gain + loss), 3)
 
         l = len(self.lineRsi)
         if l > self.inputRsiLen*8:
@@ -782,19 +868,24 @@ class CtaLineBar(object):
         if self.inputCmiLen <= EMPTY_INT: return
 
          # 1、lineBar满足长度才执行计算
-        if len(self.lineBar) < self.inputCmiLen:
+        if self.barCount < self.inputCmiLen:
             self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算CMI需要：{1}'.
-                             format(len(self.lineBar), self.inputCmiLen))
+                             format(self.barCount, self.inputCmiLen))
             return
 
-        listClose =[x.close for x in self.lineBar[-self.inputCmiLen:]]
-        hhv = max(listClose)
-        llv = min(listClose)
+        # inputCmiLen周期（包含当前周期）收盘价的最高和最低
+        close = self.lineBar[-1].close
+        if self.inputCmiLen > 1:
+            hhv = max(self.cmiDonchian.up, close)
+            llv = min(self.cmiDonchian.down, close)
+        else:
+            hhv = close
+            llv = close
 
         if hhv==llv:
             cmi = 100
         else:
-            cmi = abs(self.lineBar[-1].close-self.lineBar[-2].close)*100/(hhv-llv)
+            cmi = abs(close-self.closeArray.getLast())*100/(hhv-llv)
 
         cmi = round(cmi, 2)
 
@@ -805,30 +896,36 @@ class CtaLineBar(object):
 
     def __recountBoll(self):
         """布林特线"""
-        if self.inputBollLen < EMPTY_INT: return
+        if self.inputBollLen <= EMPTY_INT: return
 
-        l = len(self.lineBar)
+        l = self.barCount
 
         if l < min(7, self.inputBollLen)+1:
             self.debugCtaLog(u'数据未充分,当前Bar数据数量：{0}，计算Boll需要：{1}'.
-                             format(len(self.lineBar), min(7, self.inputBollLen)+1))
+                             format(self.barCount, min(7, self.inputBollLen)+1))
             return
 
-        if l < self.inputBollLen+2:
-            bollLen = l-1
-        else:
-            bollLen = self.inputBollLen
-
         # 不包含当前最新的Bar
-        listClose=[x.close for x in self.lineBar[-bollLen - 1:-1]]
-        #
-        upper, middle, lower = ta.BBANDS(numpy.array(listClose, dtype=float),
-                                         timeperiod=bollLen, nbdevup=self.inputBollStdRate,
-                                         nbdevdn=self.inputBollStdRate, matype=0)
-
-        self.lineUpperBand.append(upper[-1])
-        self.lineMiddleBand.append(middle[-1])
-        self.lineLowerBand.append(lower[-1])
+        if self.boll.inited:
+            upper = self.boll.up
+            middle = self.boll.mid
+            lower = self.boll.down
+        else:
+            # 已完成的K线不足inputBollLen根时，使用全部已完成的K线计算
+            listClose = self.closeArray.getArray()[-(l-1):]
+            middle = listClose.mean()
+            std = listClose.std()
+            upper = middle + self.inputBollStdRate * std
+            lower = middle - self.inputBollStdRate * std
+
+        if len(self.lineMiddleBand) > self.inputBollLen*8:
+            del self.lineUpperBand[0]
+            del self.lineMiddleBand[0]
+            del self.lineLowerBand[0]
+
+        self.lineUpperBand.append(upper)
+        self.lineMiddleBand.append(middle)
+        self.lineLowerBand.append(lower)
 
 
     # ----------------------------------------------------------------------
@@ -17,6 +17,7 @@ from vnctpmd import MdApi
 from vnctptd import TdApi
 from ctpDataType import *
 from vtGateway import *
+from vtFunction import TickTimeParser
 
 
 # 以下为一些VT类型和CTP类型的映射字典
@@ -210,6 +211,7 @@ class CtpMdApi(MdApi):
         self.gatewayName = gateway.gatewayName  # gateway对象名称
         
         self.reqID = EMPTY_INT              # 操作请求编号
+        self.timeParser = TickTimeParser()   # Tick时间戳解析器
         
         self.connectionStatus = False       # 连接状态
         self.loginStatus = False            # 登录状态
@@ -334,7 +336,7 @@ class CtpMdApi(MdApi):
         
         # 这里由于交易所夜盘时段的交易日数据有误，所以选择本地获取
         #tick.date = data['TradingDay']
-        tick.date = datetime.now().strftime('%Y%m%d')   
+        tick.date, tick.datetime = self.timeParser.parseLocal(tick.time)
         
         tick.openPrice = data['OpenPrice']
         tick.highPrice = data['HighestPrice']
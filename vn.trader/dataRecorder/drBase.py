@@ -17,6 +17,59 @@ SETTING_DB_NAME = 'VnTrader_Setting_Db'
 TICK_DB_NAME = 'VnTrader_Tick_Db'
 DAILY_DB_NAME = 'VnTrader_Daily_Db'
 MINUTE_DB_NAME = 'VnTrader_1Min_Db'
+MINUTE_5_DB_NAME = 'VnTrader_5Min_Db'
+MINUTE_15_DB_NAME = 'VnTrader_15Min_Db'
+MINUTE_30_DB_NAME = 'VnTrader_30Min_Db'
+HOUR_DB_NAME = 'VnTrader_1Hour_Db'
+DAY_DB_NAME = 'VnTrader_1Day_Db'       # 数据记录生成的日线，和下载的日线（DAILY_DB_NAME）分开保存
+
+# 数据插入队列积压时的处理方式
+OVERFLOW_WARN = 'warn'              # 只发出日志
+OVERFLOW_DROP_TICK = 'dropTick'     # 丢弃Tick数据
+OVERFLOW_BLOCK = 'block'            # 阻塞推送数据的线程
+
+# K线周期的单位
+BAR_UNIT_MINUTE = 'm'
+BAR_UNIT_HOUR = 'h'
+BAR_UNIT_DAY = 'd'
+
+
+#----------------------------------------------------------------------
+def parseBarInterval(interval):
+    """
+    解析K线周期字符串，如'5m'、'1h'、'1d'，返回(单位, 数量)，无效时返回None
+    分钟数需要能整除60，小时数需要能整除24，日线只支持'1d'
+    """
+    try:
+        unit = interval[-1]
+        n = int(interval[:-1])
+    except (IndexError, ValueError):
+        return None
+    
+    if n <= 0:
+        return None
+    if unit == BAR_UNIT_MINUTE and 60 % n == 0:
+        return unit, n
+    if unit == BAR_UNIT_HOUR and 24 % n == 0:
+        return unit, n
+    if unit == BAR_UNIT_DAY and n == 1:
+        return unit, n
+    return None
+
+#----------------------------------------------------------------------
+def getBarDbName(interval):
+    """
+    获取K线周期对应的数据库名称，如'5m'对应VnTrader_5Min_Db
+    日线使用VnTrader_1Day_Db，不写入历史数据下载使用的VnTrader_Daily_Db（该数据库的
+    datetime字段有唯一索引，两者的K线时间相同，插入时会冲突）
+    """
+    unit, n = parseBarInterval(interval)
+    if unit == BAR_UNIT_MINUTE:
+        return 'VnTrader_%dMin_Db' %n
+    elif unit == BAR_UNIT_HOUR:
+        return 'VnTrader_%dHour_Db' %n
+    else:
+        return DAY_DB_NAME
 
 
 # CTA引擎中涉及的数据类定义
@@ -43,7 +96,8 @@ class DrBarData(object):
         self.time = EMPTY_STRING            # 时间
         self.datetime = None                # python的datetime时间对象
         
-        self.volume = EMPTY_INT             # 成交量
+        self.volume = EMPTY_INT             # 成交量（K线第一个Tick的当日累计成交量）
+        self.barVolume = EMPTY_INT          # K线内的成交量
         self.openInterest = EMPTY_INT       # 持仓量
 
 
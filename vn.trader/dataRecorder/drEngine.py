@@ -4,6 +4,22 @@
 本文件中实现了行情数据记录引擎，用于汇总TICK数据，并生成K线插入数据库。
 
 使用DR_setting.json来配置需要收集的合约，以及主力合约代码。
+
+K线周期通过barInterval（所有合约）和barIntervalDict（单个合约）配置，如["1m", "5m", "1h", "1d"]，
+同一个Tick数据流一次生成所有周期的K线，每个周期插入各自的数据库（见drBase.getBarDbName）：
+1. 分钟和小时K线按时钟对齐，如5分钟K线为09:00、09:05，不跨越交易时段的休市
+2. 日线K线按交易日划分，夜盘数据属于下一个交易日，插入VnTrader_1Day_Db，和下载的日线分开保存
+
+数据插入线程按照数据库和集合对队列中的数据分组，使用批量插入写入数据库：
+1. 单个集合缓存的数据达到batchSize条时写入该集合，所有集合缓存的数据达到bufferSize条，
+   或者距离上次写入超过flushInterval秒时写入全部缓存
+2. 队列长度超过highWaterMark时，根据overflowPolicy处理：
+   warn：只发出日志，继续缓存所有数据
+   dropTick：丢弃新的Tick数据，K线数据继续缓存
+   block：阻塞推送数据的线程（即事件引擎的线程），直到队列长度降到highWaterMark以下，
+          最多等待blockTimeout秒，超时后丢弃数据并在积压解除前不再等待，避免数据库
+          停止响应时阻塞其他模块的事件处理
+3. 每隔statsInterval秒发出包含队列长度和写入耗时的统计日志
 '''
 
 import json
@@ -11,13 +27,16 @@ import os
 import copy
 from collections import OrderedDict
 from datetime import datetime, timedelta
-from Queue import Queue
-from threading import Thread
+from Queue import Queue, Full
+from threading import Thread, Lock
+from time import time
+
+from pymongo.errors import BulkWriteError
 
 from eventEngine import *
 from vtGateway import VtSubscribeReq, VtLogData
 from drBase import *
-from vtFunction import todayDate
+from vtFunction import todayDate, getTradingDay, getTickConverter, getDataDict
 
 
 ########################################################################
@@ -43,8 +62,31 @@ class DrEngine(object):
         # Tick对象字典
         self.tickDict = {}
         
-        # K线对象字典
-        self.barDict = {}
+        # 将vtTickData转化为drTickData的函数
+        self.convertTick = getTickConverter(DrTickData)
+        
+        # K线生成器字典，key为合约代码，value为DrBarGenerator
+        self.barGeneratorDict = {}
+        self.barLock = Lock()                   # 事件线程更新K线和退出时推送K线使用的锁
+        
+        # 批量写入和队列积压的处理设置
+        self.batchSize = 1000                   # 单个集合每次批量插入的最大数据量
+        self.bufferSize = 20000                 # 所有集合缓存的最大数据量
+        self.flushInterval = 1.0                # 缓存数据的最长等待写入时间（秒）
+        self.highWaterMark = 100000             # 队列长度警戒线，0表示不限制
+        self.overflowPolicy = OVERFLOW_WARN     # 队列长度超过警戒线时的处理方式
+        self.blockTimeout = 1.0                 # 阻塞模式下等待队列空位的最长时间（秒）
+        self.statsInterval = 60                 # 统计日志的间隔（秒），0表示不输出
+        
+        # 写入统计
+        self.insertCount = 0                    # 已写入的数据量
+        self.batchCount = 0                     # 批量插入的次数
+        self.totalLatency = 0                   # 批量插入的总耗时
+        self.maxLatency = 0                     # 批量插入的最大耗时
+        self.maxQueueSize = 0                   # 插入线程观察到的最大队列长度
+        self.droppedCount = 0                   # 因队列积压丢弃和插入失败的数据量
+        self.overflow = False                   # 队列是否处于积压状态
+        self.blockTimedOut = False              # 阻塞模式下是否已经等待超时
         
         # 负责执行数据库插入的单独线程相关
         self.active = False                     # 工作状态
@@ -60,6 +102,22 @@ class DrEngine(object):
         with open(self.settingFileName) as f:
             drSetting = json.load(f)
             
+            # 批量写入设置
+            if 'writer' in drSetting:
+                d = drSetting['writer']
+                self.batchSize = d.get('batchSize', self.batchSize)
+                self.bufferSize = d.get('bufferSize', self.bufferSize)
+                self.flushInterval = d.get('flushInterval', self.flushInterval)
+                self.highWaterMark = d.get('highWaterMark', self.highWaterMark)
+                self.overflowPolicy = d.get('overflowPolicy', self.overflowPolicy)
+                self.blockTimeout = d.get('blockTimeout', self.blockTimeout)
+                self.statsInterval = d.get('statsInterval', self.statsInterval)
+            
+            # 阻塞模式下由队列的最大长度实现背压，插入数据在事件引擎的线程中执行，
+            # 等待时会暂停所有事件的处理，因此最多等待blockTimeout秒
+            if self.overflowPolicy == OVERFLOW_BLOCK and self.highWaterMark > 0:
+                self.queue = Queue(maxsize=self.highWaterMark)
+            
             # 如果working设为False则不启动行情记录功能
             working = drSetting['working']
             if not working:
@@ -93,6 +151,10 @@ class DrEngine(object):
             if 'bar' in drSetting:
                 l = drSetting['bar']
                 
+                # 需要生成的K线周期，默认只生成1分钟K线
+                defaultIntervalList = drSetting.get('barInterval', ['1m'])
+                intervalDict = drSetting.get('barIntervalDict', {})
+                
                 for setting in l:
                     symbol = setting[0]
                     vtSymbol = symbol
@@ -110,8 +172,14 @@ class DrEngine(object):
                     
                     self.mainEngine.subscribe(req, setting[1])  
                     
-                    bar = DrBarData() 
-                    self.barDict[vtSymbol] = bar
+                    intervalList = []
+                    for interval in intervalDict.get(vtSymbol, defaultIntervalList):
+                        if parseBarInterval(interval):
+                            intervalList.append(interval)
+                        else:
+                            self.writeDrLog(u'%s的K线周期%s无效' %(vtSymbol, interval))
+                    
+                    self.barGeneratorDict[vtSymbol] = DrBarGenerator(intervalList, self.onBar)
                     
             if 'active' in drSetting:
                 d = drSetting['active']
@@ -133,12 +201,7 @@ class DrEngine(object):
         vtSymbol = tick.vtSymbol
 
         # 转化Tick格式
-        drTick = DrTickData()
-        d = drTick.__dict__
-        for key in d.keys():
-            if key != 'datetime':
-                d[key] = tick.__getattribute__(key)
-        drTick.datetime = datetime.strptime(' '.join([tick.date, tick.time]), '%Y%m%d %H:%M:%S.%f')            
+        drTick = self.convertTick(tick)
         
         # 更新Tick数据
         if vtSymbol in self.tickDict:
@@ -152,43 +215,25 @@ class DrEngine(object):
             self.writeDrLog(u'记录Tick数据%s，时间:%s, last:%s, bid:%s, ask:%s' 
                             %(drTick.vtSymbol, drTick.time, drTick.lastPrice, drTick.bidPrice1, drTick.askPrice1))
             
-        # 更新分钟线数据
-        if vtSymbol in self.barDict:
-            bar = self.barDict[vtSymbol]
-            
-            # 如果第一个TICK或者新的一分钟
-            if not bar.datetime or bar.datetime.minute != drTick.datetime.minute:    
-                if bar.vtSymbol:
-                    newBar = copy.copy(bar)
-                    self.insertData(MINUTE_DB_NAME, vtSymbol, newBar)
-                    
-                    if vtSymbol in self.activeSymbolDict:
-                        activeSymbol = self.activeSymbolDict[vtSymbol]
-                        self.insertData(MINUTE_DB_NAME, activeSymbol, newBar)                    
-                    
-                    self.writeDrLog(u'记录分钟线数据%s，时间:%s, O:%s, H:%s, L:%s, C:%s' 
-                                    %(bar.vtSymbol, bar.time, bar.open, bar.high, 
-                                      bar.low, bar.close))
-                         
-                bar.vtSymbol = drTick.vtSymbol
-                bar.symbol = drTick.symbol
-                bar.exchange = drTick.exchange
-                
-                bar.open = drTick.lastPrice
-                bar.high = drTick.lastPrice
-                bar.low = drTick.lastPrice
-                bar.close = drTick.lastPrice
-                
-                bar.date = drTick.date
-                bar.time = drTick.time
-                bar.datetime = drTick.datetime
-                bar.volume = drTick.volume
-                bar.openInterest = drTick.openInterest        
-            # 否则继续累加新的K线
-            else:                               
-                bar.high = max(bar.high, drTick.lastPrice)
-                bar.low = min(bar.low, drTick.lastPrice)
-                bar.close = drTick.lastPrice            
+        # 更新各周期的K线数据
+        if vtSymbol in self.barGeneratorDict:
+            with self.barLock:
+                self.barGeneratorDict[vtSymbol].updateTick(drTick)
+
+    #----------------------------------------------------------------------
+    def onBar(self, interval, bar):
+        """K线生成器的回调函数，插入完成的K线到对应周期的数据库"""
+        vtSymbol = bar.vtSymbol
+        dbName = getBarDbName(interval)
+        self.insertData(dbName, vtSymbol, bar)
+        
+        if vtSymbol in self.activeSymbolDict:
+            activeSymbol = self.activeSymbolDict[vtSymbol]
+            self.insertData(dbName, activeSymbol, bar)
+        
+        self.writeDrLog(u'记录%sK线数据%s，时间:%s %s, O:%s, H:%s, L:%s, C:%s' 
+                        %(interval, vtSymbol, bar.date, bar.time, bar.open, bar.high, 
+                          bar.low, bar.close))
 
     #----------------------------------------------------------------------
     def registerEvent(self):
@@ -198,17 +243,168 @@ class DrEngine(object):
     #----------------------------------------------------------------------
     def insertData(self, dbName, collectionName, data):
         """插入数据到数据库（这里的data可以是CtaTickData或者CtaBarData）"""
-        self.queue.put((dbName, collectionName, data.__dict__))
+        if self.highWaterMark > 0:
+            qsize = self.queue.qsize()
+            
+            # 队列长度超过警戒线
+            if qsize >= self.highWaterMark:
+                if not self.overflow:
+                    self.overflow = True
+                    self.writeDrLog(u'数据插入队列积压，队列长度：%s，处理方式：%s' %(qsize, self.overflowPolicy))
+                
+                if self.overflowPolicy == OVERFLOW_DROP_TICK and dbName == TICK_DB_NAME:
+                    self.droppedCount += 1
+                    return
+            
+            # 队列长度降到警戒线的一半以下，视为积压解除
+            elif self.overflow and qsize < self.highWaterMark / 2:
+                self.overflow = False
+                self.blockTimedOut = False
+                self.writeDrLog(u'数据插入队列积压解除，队列长度：%s，累计丢弃数据：%s' %(qsize, self.droppedCount))
+        
+        item = (dbName, collectionName, getDataDict(data))
+        
+        # 阻塞模式下等待超时后丢弃数据，积压解除前不再等待
+        if self.overflowPolicy == OVERFLOW_BLOCK and self.highWaterMark > 0:
+            try:
+                if self.blockTimedOut:
+                    self.queue.put_nowait(item)
+                else:
+                    self.queue.put(item, timeout=self.blockTimeout)
+            except Full:
+                if not self.blockTimedOut:
+                    self.blockTimedOut = True
+                    self.writeDrLog(u'数据插入队列等待超过%s秒，开始丢弃数据' %self.blockTimeout)
+                
+                self.droppedCount += 1
+                if dbName != TICK_DB_NAME:
+                    self.writeDrLog(u'数据插入队列已满，丢弃K线数据，数据库：%s，集合：%s' %(dbName, collectionName))
+            return
+        
+        self.queue.put(item)
         
     #----------------------------------------------------------------------
     def run(self):
         """运行插入线程"""
+        bufferDict = OrderedDict()      # key为(dbName, collectionName)，value为待插入的数据列表
+        bufferCount = 0                 # 缓存的数据量
+        lastFlush = time()              # 上次写入的时间
+        lastStats = time()              # 上次输出统计的时间
+        
         while self.active:
             try:
-                dbName, collectionName, d = self.queue.get(block=True, timeout=1)
-                self.mainEngine.dbInsert(dbName, collectionName, d)
+                # 阻塞等待第一条数据，之后取出队列中已有的数据直到缓存达到上限
+                item = self.queue.get(block=True, timeout=self.flushInterval)
+                
+                qsize = self.queue.qsize() + 1
+                if qsize > self.maxQueueSize:
+                    self.maxQueueSize = qsize
+                
+                while True:
+                    dbName, collectionName, d = item
+                    key = (dbName, collectionName)
+                    if key in bufferDict:
+                        l = bufferDict[key]
+                        l.append(d)
+                    else:
+                        l = bufferDict[key] = [d]
+                    bufferCount += 1
+                    
+                    # 单个集合的数据达到批量上限则立即写入
+                    if len(l) >= self.batchSize:
+                        self.insertMany(dbName, collectionName, l)
+                        del bufferDict[key]
+                        bufferCount -= len(l)
+                    
+                    if bufferCount >= self.bufferSize:
+                        break
+                    item = self.queue.get_nowait()
             except Empty:
                 pass
+            
+            now = time()
+            if bufferCount >= self.bufferSize or (bufferCount and now - lastFlush >= self.flushInterval):
+                self.writeBuffer(bufferDict)
+                bufferCount = 0
+                lastFlush = now
+            
+            if self.statsInterval and now - lastStats >= self.statsInterval:
+                self.writeStatsLog()
+                lastStats = now
+        
+        # 退出前写入队列中剩余的数据
+        while True:
+            try:
+                dbName, collectionName, d = self.queue.get_nowait()
+            except Empty:
+                break
+            key = (dbName, collectionName)
+            if key in bufferDict:
+                bufferDict[key].append(d)
+            else:
+                bufferDict[key] = [d]
+        self.writeBuffer(bufferDict)
+        
+    #----------------------------------------------------------------------
+    def writeBuffer(self, bufferDict):
+        """按集合批量插入缓存的数据，并清空缓存"""
+        for (dbName, collectionName), l in bufferDict.items():
+            self.insertMany(dbName, collectionName, l)
+        
+        bufferDict.clear()
+        
+    #----------------------------------------------------------------------
+    def insertMany(self, dbName, collectionName, l):
+        """批量插入一个集合的数据，并记录耗时，插入失败的数据计入丢弃数量"""
+        start = time()
+        try:
+            count = self.mainEngine.dbInsertMany(dbName, collectionName, l)
+        except BulkWriteError, e:
+            # 无序插入时其他数据已经插入
+            count = e.details['nInserted']
+        except Exception, e:
+            self.droppedCount += len(l)
+            self.writeDrLog(u'批量插入数据失败，数据库：%s，集合：%s，数据量：%s，错误：%s' 
+                            %(dbName, collectionName, len(l), e))
+            return
+        latency = time() - start
+        
+        if count < len(l):
+            self.droppedCount += len(l) - count
+            self.writeDrLog(u'批量插入部分数据失败，数据库：%s，集合：%s，数据量：%s，成功：%s' 
+                            %(dbName, collectionName, len(l), count))
+        
+        self.insertCount += count
+        self.batchCount += 1
+        self.totalLatency += latency
+        if latency > self.maxLatency:
+            self.maxLatency = latency
+        
+    #----------------------------------------------------------------------
+    def getStats(self):
+        """获取数据写入的统计信息，耗时单位为毫秒"""
+        d = OrderedDict()
+        d['queueSize'] = self.queue.qsize()
+        d['maxQueueSize'] = self.maxQueueSize
+        d['insertCount'] = self.insertCount
+        d['batchCount'] = self.batchCount
+        d['droppedCount'] = self.droppedCount
+        
+        if self.batchCount:
+            d['avgLatency'] = self.totalLatency / self.batchCount * 1000
+        else:
+            d['avgLatency'] = 0
+        d['maxLatency'] = self.maxLatency * 1000
+        return d
+    
+    #----------------------------------------------------------------------
+    def writeStatsLog(self):
+        """发出数据写入的统计日志"""
+        d = self.getStats()
+        self.writeDrLog(u'数据写入统计，队列长度：%s，最大队列长度：%s，已写入：%s，批次：%s，'
+                        u'平均耗时：%.1f毫秒，最大耗时：%.1f毫秒，丢弃：%s' 
+                        %(d['queueSize'], d['maxQueueSize'], d['insertCount'], d['batchCount'],
+                          d['avgLatency'], d['maxLatency'], d['droppedCount']))
     #----------------------------------------------------------------------
     def start(self):
         """启动"""
@@ -219,6 +415,13 @@ class DrEngine(object):
     def stop(self):
         """退出"""
         if self.active:
+            # 插入已经结束但还未收到下一个Tick的K线，如收盘后的最后一根K线和日线
+            # 退出在界面线程中调用，需要和事件线程中的updateTick互斥
+            now = datetime.now()
+            with self.barLock:
+                for generator in self.barGeneratorDict.values():
+                    generator.flush(now)
+            
             self.active = False
             self.thread.join()
         
@@ -230,4 +433,136 @@ class DrEngine(object):
         event = Event(type_=EVENT_DATARECORDER_LOG)
         event.dict_['data'] = log
         self.eventEngine.put(event)   
-    
\ No newline at end of file
+    
+
+
+########################################################################
+class DrBarGenerator(object):
+    """
+    K线生成器，从一个合约的Tick数据流中同时生成多个周期的K线
+    
+    K线在收到属于下一个周期的Tick时完成，通过onBar(interval, bar)回调
+
+    volume字段和原有的分钟线一致，为K线第一个Tick的当日累计成交量；barVolume字段为
+    K线内的成交量，由Tick的累计成交量相减得到，启动后的第一个Tick只作为计算的起点
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, intervalList, onBar):
+        """Constructor"""
+        self.onBar = onBar                      # K线完成的回调函数
+        
+        # 周期列表，元素为(周期, 单位, 数量)
+        self.intervalList = [(interval,) + parseBarInterval(interval) for interval in intervalList]
+        
+        self.barDict = {}                       # key为周期，value为当前的K线
+        self.barKeyDict = {}                    # key为周期，value为当前K线所属的时间窗口
+        
+        # 只有生成日线时才需要计算交易日，交易日按照自然日和是否20点之后缓存
+        self.dayActive = any([unit == BAR_UNIT_DAY for interval, unit, n in self.intervalList])
+        self.tradingDayKey = None               # 缓存交易日对应的(自然日序数, 是否20点之后)
+        self.tradingDay = ''                    # 缓存的交易日
+        
+        self.lastVolume = None                  # 上一个Tick的累计成交量
+        
+    #----------------------------------------------------------------------
+    def getBarKey(self, unit, n, dt, tradingDay):
+        """获取时间所属的K线时间窗口，分钟和小时K线为窗口的开始时间，日线为交易日"""
+        if unit == BAR_UNIT_MINUTE:
+            return dt.replace(minute=dt.minute-dt.minute%n, second=0, microsecond=0)
+        elif unit == BAR_UNIT_HOUR:
+            return dt.replace(hour=dt.hour-dt.hour%n, minute=0, second=0, microsecond=0)
+        else:
+            return tradingDay
+        
+    #----------------------------------------------------------------------
+    def updateTick(self, tick):
+        """更新Tick数据"""
+        dt = tick.datetime
+        price = tick.lastPrice
+        
+        if self.dayActive:
+            tradingDayKey = (dt.toordinal(), dt.hour >= 20)
+            if tradingDayKey != self.tradingDayKey:
+                self.tradingDayKey = tradingDayKey
+                self.tradingDay = getTradingDay(dt)
+            tradingDay = self.tradingDay
+        else:
+            tradingDay = ''
+        
+        # 计算这个Tick的成交量，累计成交量减少说明进入了新的交易日，
+        # 启动后的第一个Tick之前的成交无法区分所属的K线，以第一个Tick的累计成交量为起点
+        if self.lastVolume is None:
+            self.lastVolume = tick.volume
+        
+        if tick.volume >= self.lastVolume:
+            volume = tick.volume - self.lastVolume
+        else:
+            volume = tick.volume
+        self.lastVolume = tick.volume
+        
+        for interval, unit, n in self.intervalList:
+            barKey = self.getBarKey(unit, n, dt, tradingDay)
+            bar = self.barDict.get(interval, None)
+            
+            # 进入新的时间窗口，推送已完成的K线
+            if bar and barKey != self.barKeyDict[interval]:
+                self.onBar(interval, bar)
+                bar = None
+            
+            if not bar:
+                bar = DrBarData()
+                bar.vtSymbol = tick.vtSymbol
+                bar.symbol = tick.symbol
+                bar.exchange = tick.exchange
+                
+                bar.open = price
+                bar.high = price
+                bar.low = price
+                
+                # 日线的日期为交易日，和历史数据下载的日线格式一致
+                if unit == BAR_UNIT_DAY:
+                    bar.date = tradingDay
+                    bar.time = ''
+                    bar.datetime = datetime.strptime(tradingDay, '%Y%m%d')
+                else:
+                    bar.date = barKey.strftime('%Y%m%d')
+                    bar.time = barKey.strftime('%H:%M:%S')
+                    bar.datetime = barKey
+                
+                bar.volume = tick.volume
+                bar.barVolume = 0
+                
+                self.barDict[interval] = bar
+                self.barKeyDict[interval] = barKey
+            else:
+                bar.high = max(bar.high, price)
+                bar.low = min(bar.low, price)
+            
+            bar.close = price
+            bar.barVolume += volume
+            bar.openInterest = tick.openInterest
+    
+    #----------------------------------------------------------------------
+    def flush(self, dt):
+        """推送在dt时已经结束的K线，日线在日盘收盘后（15:30至20:00）或交易日变化后视为结束"""
+        tradingDay = getTradingDay(dt)
+        dayClosed = (dt.hour == 15 and dt.minute >= 30) or (16 <= dt.hour < 20)
+        
+        for interval, unit, n in self.intervalList:
+            bar = self.barDict.get(interval, None)
+            if not bar:
+                continue
+            
+            barKey = self.barKeyDict[interval]
+            if unit == BAR_UNIT_MINUTE:
+                finished = dt >= barKey + timedelta(minutes=n)
+            elif unit == BAR_UNIT_HOUR:
+                finished = dt >= barKey + timedelta(hours=n)
+            else:
+                finished = dayClosed or tradingDay != barKey
+            
+            if finished:
+                self.onBar(interval, bar)
+                del self.barDict[interval]
+                del self.barKeyDict[interval]
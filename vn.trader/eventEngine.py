@@ -2,9 +2,10 @@
 
 # 系统模块
 from Queue import Queue, Empty
-from threading import Thread
+from threading import Thread, Lock
 from time import sleep
-from collections import defaultdict
+from time import time as _time     # 避免通过from eventEngine import *覆盖其他模块导入的time模块
+from collections import defaultdict, deque
 
 # 第三方模块
 from PyQt4.QtCore import QTimer
@@ -129,6 +130,13 @@ class EventEngine(object):
         """处理事件"""
         """process event"""
 
+        # 先将事件传递给监听通用类型（事件类型前缀，如EVENT_TICK）的处理函数
+        # first pass the event to handlers registered on the general type (prefix, e.g. EVENT_TICK)
+        
+        prefix = getEventPrefix(event.type_)
+        if prefix in self.__handlers:
+            [handler(event) for handler in self.__handlers[prefix]]
+
         # 检查是否存在对该事件进行监听的处理函数
         # check whether this event has a handler function
 
@@ -221,15 +229,38 @@ class EventEngine(object):
 ########################################################################
 class EventEngine2(object):
     """
-    计时器使用python线程的事件驱动引擎        
+    计时器使用python线程的事件驱动引擎
+    
+    事件类型支持层级订阅：类型为EVENT_TICK+vtSymbol的事件会先推送给注册
+    在EVENT_TICK上的处理函数，再推送给注册在EVENT_TICK+vtSymbol上的处理函数，
+    因此接口只需要推送一个事件。
+    
+    batchMode为True时，事件处理线程每次取出队列中当前所有的事件批量处理，
+    同一批次中同一合约的行情事件只有最新的一条会推送给注册在EVENT_TICK+vtSymbol
+    上的处理函数（通常为界面组件），注册在EVENT_TICK上的处理函数以及委托、
+    成交等事件不会被合并。
+    
+    调用setStatsActive开启运行统计后，可以通过getStats查询事件等待时间、
+    处理函数耗时等统计信息，同时每隔statsInterval秒推送一次EVENT_ENGINE_STATS
+    事件。统计关闭时只增加一次布尔值检查的开销。
     """
 
     #----------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, batchMode=False):
         """初始化事件引擎"""
         # 事件队列
         self.__queue = Queue()
         
+        # 批量处理模式
+        self.__batchMode = batchMode
+        self.__coalescedCount = 0       # 批量模式下被合并（丢弃）的过期事件计数
+        
+        # 运行统计
+        self.__statsActive = False      # 统计开关
+        self.__statsInterval = 10       # 统计事件推送间隔（秒）
+        self.__statsCount = 0           # 推送间隔计数
+        self.__stats = EventEngineStats()
+        
         # 事件引擎开关
         self.__active = False
         
@@ -251,13 +282,22 @@ class EventEngine2(object):
         while self.__active == True:
             try:
                 event = self.__queue.get(block = True, timeout = 1)  # 获取事件的阻塞时间设为1秒
-                self.__process(event)
+                if self.__batchMode:
+                    self.__processBatch(event)
+                elif self.__statsActive:
+                    self.__stats.recordQueueSize(self.__queue.qsize()+1)
+                    self.__processStats(event)
+                else:
+                    self.__process(event)
             except Empty:
                 pass
             
     #----------------------------------------------------------------------
     def __process(self, event):
         """处理事件"""
+        # 先将事件传递给监听通用类型（事件类型前缀，如EVENT_TICK）的处理函数
+        self.__processPrefix(event)
+        
         # 检查是否存在对该事件进行监听的处理函数
         if event.type_ in self.__handlers:
             # 若存在，则按顺序将事件传递给处理函数执行
@@ -266,6 +306,78 @@ class EventEngine2(object):
             # 以上语句为Python列表解析方式的写法，对应的常规循环写法为：
             #for handler in self.__handlers[event.type_]:
                 #handler(event)    
+    
+    #----------------------------------------------------------------------
+    def __processPrefix(self, event):
+        """将事件传递给监听通用类型的处理函数"""
+        prefix = getEventPrefix(event.type_)
+        if prefix in self.__handlers:
+            [handler(event) for handler in self.__handlers[prefix]]
+    
+    #----------------------------------------------------------------------
+    def __processStats(self, event, prefixOnly=False):
+        """处理事件，同时记录等待时间和处理函数的执行时间"""
+        stats = self.__stats
+        now = _time()
+        
+        # 开启统计之前存入的事件没有存入时间
+        putTime = getattr(event, 'putTime', None)
+        if putTime:
+            stats.recordWait(event.type_, now-putTime)
+        
+        typeList = [getEventPrefix(event.type_)]
+        if not prefixOnly:
+            typeList.append(event.type_)
+        
+        for type_ in typeList:
+            if type_ in self.__handlers:
+                for handler in self.__handlers[type_]:
+                    handler(event)
+                    end = _time()
+                    stats.recordHandler(handler, end-now)
+                    now = end
+    
+    #----------------------------------------------------------------------
+    def __processBatch(self, event):
+        """批量处理事件，event为阻塞获取到的第一个事件"""
+        # 一次加锁取出队列中当前所有的事件，避免每个事件都要单独获取一次锁
+        queue = self.__queue
+        queue.mutex.acquire()
+        try:
+            batch = [event]
+            batch.extend(queue.queue)
+            queue.queue.clear()
+            queue.not_full.notify_all()
+        finally:
+            queue.mutex.release()
+        
+        # 开启统计时使用带统计的处理函数
+        if self.__statsActive:
+            self.__stats.recordQueueSize(len(batch))
+            process = self.__processStats
+            processPrefix = lambda event: self.__processStats(event, True)
+        else:
+            process = self.__process
+            processPrefix = self.__processPrefix
+        
+        # 单个事件无需合并
+        if len(batch) == 1:
+            process(event)
+            return
+        
+        # 记录每个可合并事件类型在批次中最新一条的位置
+        lastDict = {}
+        for n, event in enumerate(batch):
+            if isCoalescable(event.type_):
+                lastDict[event.type_] = n
+        
+        # 按原有顺序处理，已经有更新数据的过期事件只传递给通用类型的处理函数
+        for n, event in enumerate(batch):
+            if lastDict.get(event.type_, n) != n:
+                self.__coalescedCount += 1
+                processPrefix(event)
+            else:
+                process(event)
                
     #----------------------------------------------------------------------
     def __runTimer(self):
@@ -277,6 +389,15 @@ class EventEngine2(object):
             # 向队列中存入计时器事件
             self.put(event)    
             
+            # 定时推送统计事件
+            if self.__statsActive:
+                self.__statsCount += 1
+                if self.__statsCount >= self.__statsInterval:
+                    self.__statsCount = 0
+                    event = Event(type_=EVENT_ENGINE_STATS)
+                    event.dict_['data'] = self.getStats()
+                    self.put(event)
+            
             # 等待
             sleep(self.__timerSleep)
 
@@ -333,7 +454,330 @@ class EventEngine2(object):
     #----------------------------------------------------------------------
     def put(self, event):
         """向事件队列中存入事件"""
+        if self.__statsActive:
+            event.putTime = _time()
         self.__queue.put(event)
+        
+    #----------------------------------------------------------------------
+    def getQueueSize(self):
+        """查询当前队列中等待处理的事件数量"""
+        return self.__queue.qsize()
+    
+    #----------------------------------------------------------------------
+    def getCoalescedCount(self):
+        """查询批量模式下被合并的过期事件数量"""
+        return self.__coalescedCount
+    
+    #----------------------------------------------------------------------
+    def setStatsActive(self, active, interval=10):
+        """开关运行统计，interval为推送EVENT_ENGINE_STATS事件的间隔（秒）"""
+        self.__statsInterval = interval
+        self.__statsCount = 0
+        self.__statsActive = active
+        
+    #----------------------------------------------------------------------
+    def getStatsActive(self):
+        """查询运行统计是否开启"""
+        return self.__statsActive
+    
+    #----------------------------------------------------------------------
+    def resetStats(self):
+        """清空统计数据"""
+        self.__stats = EventEngineStats()
+    
+    #----------------------------------------------------------------------
+    def getStats(self):
+        """查询运行统计信息"""
+        d = self.__stats.getSnapshot()
+        d['queueSize'] = self.getQueueSize()
+        d['coalescedCount'] = self.__coalescedCount
+        return d
+
+
+########################################################################
+class ShardedEventEngine(object):
+    """
+    多线程事件驱动引擎，独立使用，不能作为MainEngine中EventEngine2的替代。
+    注册、注销和推送事件的接口和EventEngine2一致，不支持EventEngine2的运行统计
+    （setStatsActive、getStats）
+    
+    行情、成交、委托、持仓事件按照数据的vtSymbol分配到workerCount个工作
+    线程（通道）中处理，保证同一合约的事件按照推送顺序处理；其他事件（账户、
+    日志、计时器等）统一由控制通道处理。
+    
+    注意：处理函数会在多个线程中被调用，需要保证不同合约之间的线程安全。
+    MainEngine中的DataEngine、CtaEngine、RmEngine和DrEngine的处理函数共享
+    内部状态，不是线程安全的，因此MainEngine只使用EventEngine2，其中DrEngine
+    处理行情较慢时仍然会延迟CtaEngine收到行情；本引擎只能用于自行注册线程安全
+    处理函数的场景。
+    
+    每个通道记录事件从存入队列到处理完成的延时分布，使用getLatencyHistogram
+    查询，第n个计数对应的延时范围为[2^n, 2^(n+1))微秒，最后一个计数为更大的延时。
+    """
+    
+    # 按照合约分配通道的通用事件类型
+    shardTypeSet = set([EVENT_TICK, EVENT_TRADE, EVENT_ORDER, EVENT_POSITION])
+    
+    # 延时分布的区间数量
+    histogramSize = 21
+
+    #----------------------------------------------------------------------
+    def __init__(self, workerCount=4):
+        """初始化事件引擎"""
+        # 通道数量，0号为控制通道，其余为工作通道
+        self.__workerCount = workerCount
+        laneCount = workerCount + 1
+        
+        # 每个通道的事件队列和事件处理线程
+        self.__queueList = [Queue() for n in range(laneCount)]
+        self.__threadList = [Thread(target=self.__run, args=(n,)) for n in range(laneCount)]
+        
+        # 每个通道的延时分布
+        self.__histogramList = [[0]*self.histogramSize for n in range(laneCount)]
+        
+        # 合约到通道的映射
+        self.__laneDict = {}
+        self.__laneLock = Lock()
+        
+        # 事件引擎开关
+        self.__active = False
+        
+        # 计时器，用于触发计时器事件
+        self.__timer = Thread(target = self.__runTimer)
+        self.__timerActive = False                      # 计时器工作状态
+        self.__timerSleep = 1                           # 计时器触发间隔（默认1秒）        
+        
+        # 事件类型和处理函数列表的字典，由于会在多个线程中读取，
+        # 注册和注销时总是创建新的列表替换，而不在原列表上修改
+        self.__handlers = {}
+        
+    #----------------------------------------------------------------------
+    def __run(self, lane):
+        """通道的处理线程运行"""
+        queue = self.__queueList[lane]
+        histogram = self.__histogramList[lane]
+        maxBucket = self.histogramSize - 1
+        
+        while self.__active == True:
+            try:
+                putTime, event = queue.get(block = True, timeout = 1)  # 获取事件的阻塞时间设为1秒
+                self.__process(event)
+                
+                # 记录延时（微秒）到分布中
+                latency = int((_time() - putTime) * 1000000)
+                bucket = min(latency.bit_length()-1, maxBucket) if latency else 0
+                histogram[bucket] += 1
+            except Empty:
+                pass
+            
+    #----------------------------------------------------------------------
+    def __process(self, event):
+        """处理事件"""
+        handlers = self.__handlers
+        
+        # 先将事件传递给监听通用类型（事件类型前缀，如EVENT_TICK）的处理函数
+        prefix = getEventPrefix(event.type_)
+        if prefix in handlers:
+            [handler(event) for handler in handlers[prefix]]
+        
+        # 再传递给监听具体事件类型的处理函数
+        if event.type_ in handlers:
+            [handler(event) for handler in handlers[event.type_]]
+    
+    #----------------------------------------------------------------------
+    def __getLane(self, event):
+        """获取事件对应的处理通道"""
+        if getEventPrefix(event.type_) not in self.shardTypeSet:
+            return 0
+        
+        try:
+            vtSymbol = event.dict_['data'].vtSymbol
+        except (KeyError, AttributeError):
+            return 0
+        
+        try:
+            return self.__laneDict[vtSymbol]
+        except KeyError:
+            # 新的合约按照出现顺序轮流分配到工作通道，加锁防止多个接口线程重复分配
+            with self.__laneLock:
+                if vtSymbol not in self.__laneDict:
+                    self.__laneDict[vtSymbol] = len(self.__laneDict) % self.__workerCount + 1
+                return self.__laneDict[vtSymbol]
+    
+    #----------------------------------------------------------------------
+    def __runTimer(self):
+        """运行在计时器线程中的循环函数"""
+        while self.__timerActive:
+            # 创建计时器事件
+            event = Event(type_=EVENT_TIMER)
+        
+            # 向队列中存入计时器事件
+            self.put(event)    
+            
+            # 等待
+            sleep(self.__timerSleep)
+
+    #----------------------------------------------------------------------
+    def start(self):
+        """引擎启动"""
+        # 将引擎设为启动
+        self.__active = True
+        
+        # 启动所有通道的事件处理线程
+        for thread in self.__threadList:
+            thread.start()
+        
+        # 启动计时器，计时器事件间隔默认设定为1秒
+        self.__timerActive = True
+        self.__timer.start()
+    
+    #----------------------------------------------------------------------
+    def stop(self):
+        """停止引擎"""
+        # 将引擎设为停止
+        self.__active = False
+        
+        # 停止计时器
+        self.__timerActive = False
+        self.__timer.join()
+        
+        # 等待所有事件处理线程退出
+        for thread in self.__threadList:
+            thread.join()
+            
+    #----------------------------------------------------------------------
+    def register(self, type_, handler):
+        """注册事件处理函数监听"""
+        handlerList = self.__handlers.get(type_, [])
+        
+        # 若要注册的处理器不在该事件的处理器列表中，则注册该事件
+        if handler not in handlerList:
+            self.__handlers[type_] = handlerList + [handler]
+            
+    #----------------------------------------------------------------------
+    def unregister(self, type_, handler):
+        """注销事件处理函数监听"""
+        handlerList = self.__handlers.get(type_, [])
+        
+        # 如果该函数存在于列表中，则移除
+        if handler in handlerList:
+            handlerList = [h for h in handlerList if h != handler]
+            
+            # 如果函数列表为空，则从引擎中移除该事件类型
+            if handlerList:
+                self.__handlers[type_] = handlerList
+            else:
+                del self.__handlers[type_]
+        
+    #----------------------------------------------------------------------
+    def put(self, event):
+        """向事件队列中存入事件"""
+        self.__queueList[self.__getLane(event)].put((_time(), event))
+        
+    #----------------------------------------------------------------------
+    def getQueueSize(self):
+        """查询当前所有通道中等待处理的事件数量"""
+        return sum([queue.qsize() for queue in self.__queueList])
+    
+    #----------------------------------------------------------------------
+    def getLatencyHistogram(self):
+        """查询每个通道的延时分布，返回通道名称和计数列表的字典"""
+        d = {}
+        for n, histogram in enumerate(self.__histogramList):
+            if n == 0:
+                name = 'control'
+            else:
+                name = 'worker%s' %n
+            d[name] = list(histogram)
+        return d
+
+
+########################################################################
+class EventEngineStats(object):
+    """
+    事件引擎运行统计，由EventEngine2在开启统计后使用
+    
+    统计内容包括：每种事件类型（通用类型）从存入队列到开始处理的等待时间，
+    每个处理函数的调用次数和执行时间的中位数/99分位数（基于最近sampleSize次
+    调用），最大队列深度以及批量模式下被合并的事件数量。
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, sampleSize=1000):
+        """Constructor"""
+        self.sampleSize = sampleSize        # 计算分位数使用的样本数量
+        
+        self.waitDict = {}                  # 事件类型：[次数，总等待时间，最大等待时间]
+        self.handlerDict = {}               # 处理函数：[次数，执行时间样本]
+        self.maxQueueSize = 0               # 最大队列深度
+        
+    #----------------------------------------------------------------------
+    def recordWait(self, type_, wait):
+        """记录事件的排队等待时间"""
+        type_ = getEventPrefix(type_) or type_
+        
+        try:
+            l = self.waitDict[type_]
+        except KeyError:
+            l = [0, 0.0, 0.0]
+            self.waitDict[type_] = l
+        
+        l[0] += 1
+        l[1] += wait
+        if wait > l[2]:
+            l[2] = wait
+        
+    #----------------------------------------------------------------------
+    def recordHandler(self, handler, cost):
+        """记录处理函数的执行时间"""
+        try:
+            l = self.handlerDict[handler]
+        except KeyError:
+            l = [0, deque(maxlen=self.sampleSize)]
+            self.handlerDict[handler] = l
+        
+        l[0] += 1
+        l[1].append(cost)
+        
+    #----------------------------------------------------------------------
+    def recordQueueSize(self, size):
+        """记录队列深度"""
+        if size > self.maxQueueSize:
+            self.maxQueueSize = size
+            
+    #----------------------------------------------------------------------
+    def getSnapshot(self):
+        """
+        获取统计结果快照，时间单位为毫秒
+        
+        可以在其他线程中调用，这里的复制操作（items、list）都在解释器内部一次
+        完成，不会和事件处理线程的更新发生冲突
+        """
+        typeDict = {}
+        for type_, l in self.waitDict.items():
+            count, total, maxWait = l
+            typeDict[type_] = {'count': count,
+                               'avgWait': total / count * 1000,
+                               'maxWait': maxWait * 1000}
+        
+        handlerDict = {}
+        for handler, l in self.handlerDict.items():
+            sample = sorted(l[1])
+            if not sample:
+                continue
+            n = len(sample) - 1
+            
+            name = getHandlerName(handler)
+            if name in handlerDict:
+                name = '%s(%s)' %(name, id(handler))
+                
+            handlerDict[name] = {'count': l[0],
+                                 'p50': sample[int(n*0.5)] * 1000,
+                                 'p99': sample[int(n*0.99)] * 1000}
+            
+        return {'maxQueueSize': self.maxQueueSize,
+                'eventType': typeDict,
+                'handler': handlerDict}
 
 
 ########################################################################
@@ -348,6 +792,41 @@ class Event:
         self.dict_ = {}         # 字典用于保存具体的事件数据
 
 
+# 事件类型到通用类型（前缀）的映射缓存
+eventPrefixDict = {}
+
+#----------------------------------------------------------------------
+def getEventPrefix(type_):
+    """
+    获取事件类型的通用类型，即第一个'.'及之前的部分，
+    如EVENT_TICK+vtSymbol返回EVENT_TICK，本身即为通用类型或者没有'.'时返回空字符串
+    """
+    try:
+        return eventPrefixDict[type_]
+    except KeyError:
+        n = type_.find('.')
+        if n < 0 or n == len(type_)-1:
+            prefix = ''
+        else:
+            prefix = type_[:n+1]
+        eventPrefixDict[type_] = prefix
+        return prefix
+
+#----------------------------------------------------------------------
+def isCoalescable(type_):
+    """检查事件类型在批量处理时是否可以只保留最新的一条（特定合约的行情事件）"""
+    return type_.startswith(EVENT_TICK) and type_ != EVENT_TICK
+
+#----------------------------------------------------------------------
+def getHandlerName(handler):
+    """获取处理函数的名称，绑定方法使用类名.方法名"""
+    name = getattr(handler, '__name__', repr(handler))
+    obj = getattr(handler, '__self__', None)
+    if obj is not None:
+        name = '.'.join([obj.__class__.__name__, name])
+    return name
+
+
 #----------------------------------------------------------------------
 def test():
     """测试函数"""
@@ -372,6 +851,69 @@ def test():
     app.exec_()
     
     
+#----------------------------------------------------------------------
+def benchmark(batchMode, rate=50000, duration=5, symbolCount=100, uiCost=0.00002):
+    """
+    性能测试函数：模拟每秒rate个tick的行情推送（和VtGateway一样每个tick推送
+    一个EVENT_TICK+vtSymbol事件），统计事件处理速度和最大队列深度。
+    uiCost为模拟界面组件处理特定合约行情事件的耗时（秒）。
+    """
+    count = {'event': 0, 'ui': 0}
+    
+    def onTick(event):
+        count['event'] += 1
+    
+    def onUiTick(event):
+        count['event'] += 1
+        count['ui'] += 1
+        end = _time() + uiCost
+        while _time() < end:
+            pass
+    
+    ee = EventEngine2(batchMode)
+    symbolList = ['SYMBOL%s' %n for n in range(symbolCount)]
+    ee.register(EVENT_TICK, onTick)
+    for symbol in symbolList:
+        ee.register(EVENT_TICK+symbol, onUiTick)
+    ee.start()
+    
+    # 按照设定的速度推送行情，同时记录队列深度
+    maxDepth = 0
+    tickCount = 0
+    start = _time()
+    while True:
+        elapsed = _time() - start
+        if elapsed >= duration:
+            break
+        
+        target = int(elapsed * rate)
+        while tickCount < target:
+            symbol = symbolList[tickCount % symbolCount]
+            
+            event = Event(type_=EVENT_TICK+symbol)
+            event.dict_['data'] = symbol
+            ee.put(event)
+            
+            tickCount += 1
+        
+        maxDepth = max(maxDepth, ee.getQueueSize())
+        sleep(0.001)
+    
+    # 等待队列处理完毕（最多等待duration秒）
+    while ee.getQueueSize() and _time() - start < duration * 2:
+        sleep(0.01)
+    elapsed = _time() - start
+    remaining = ee.getQueueSize()
+    ee.stop()
+    
+    print u'批量模式：%s' %batchMode
+    print u'推送tick数量：%s，耗时：%.2f秒' %(tickCount, elapsed)
+    print u'处理事件数量：%s，每秒处理：%.0f' %(count['event'], count['event']/elapsed)
+    print u'界面事件数量：%s，合并事件数量：%s' %(count['ui'], ee.getCoalescedCount())
+    print u'最大队列深度：%s，剩余未处理：%s' %(maxDepth, remaining)
+    print ''
+    
+    
 # 直接运行脚本可以进行测试
 if __name__ == '__main__':
     test()
\ No newline at end of file
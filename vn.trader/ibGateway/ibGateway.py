@@ -318,6 +318,7 @@ class IbWrapper(EWrapper):
             dt = datetime.now()
             tick.time = dt.strftime('%H:%M:%S.%f')
             tick.date = dt.strftime('%Y%m%d')
+            tick.datetime = dt
             
             # 行情数据更新
             newtick = copy(tick)
@@ -336,6 +337,7 @@ class IbWrapper(EWrapper):
             dt = datetime.now()
             tick.time = dt.strftime('%H:%M:%S.%f')
             tick.date = dt.strftime('%Y%m%d')
+            tick.datetime = dt
                 
             # 行情数据更新
             newtick = copy(tick)
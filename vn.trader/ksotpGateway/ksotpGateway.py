@@ -12,6 +12,7 @@ from vnksotpmd import MdApi
 from vnksotptd import TdApi
 from ksotpDataType import *
 from vtGateway import *
+from vtFunction import TickTimeParser
 
 # 以下为一些VT类型和CTP类型的映射字典
 # 价格类型映射
@@ -196,6 +197,7 @@ class KsotpMdApi(MdApi):
         self.gatewayName = gateway.gatewayName  # gateway对象名称
         
         self.reqID = EMPTY_INT              # 操作请求编号
+        self.timeParser = TickTimeParser()   # Tick时间戳解析器
         
         self.connectionStatus = False       # 连接状态
         self.loginStatus = False            # 登录状态
@@ -311,7 +313,7 @@ class KsotpMdApi(MdApi):
         tick.volume = data['Volume']
         tick.openInterest = data['OpenInterest']
         tick.time = '.'.join([data['UpdateTime'], str(data['UpdateMillisec']/100)])
-        tick.date = data['TradingDay']
+        tick.date, tick.datetime = self.timeParser.parseTradingDay(data['TradingDay'], tick.time)
         
         tick.openPrice = data['OpenPrice']
         tick.highPrice = data['HighestPrice']
@@ -12,6 +12,7 @@ from vnltstd import TdApi
 from vnltsqry import QryApi
 from ltsDataType import *
 from vtGateway import *
+from vtFunction import TickTimeParser
 
 
 # 以下为一些VT类型和LTS类型的映射字典
@@ -206,6 +207,7 @@ class LtsMdApi(MdApi):
         self.gatewayName = gateway.gatewayName     #gateway对象名称
         
         self.reqID = EMPTY_INT                  # 操作请求编号
+        self.timeParser = TickTimeParser()   # Tick时间戳解析器
         
         self.connectionStatus = False           # 连接状态
         self.loginStatus = False                # 登陆状态
@@ -326,7 +328,7 @@ class LtsMdApi(MdApi):
         tick.volume = data['Volume']
         tick.openInterest = data['OpenInterest']
         tick.time = '.'.join([data['UpdateTime'], str(data['UpdateMillisec']/100)])
-        tick.date = data['TradingDay']
+        tick.date, tick.datetime = self.timeParser.parseTradingDay(data['TradingDay'], tick.time)
         
         tick.openPrice = data['OpenPrice']
         tick.highPrice = data['HighestPrice']
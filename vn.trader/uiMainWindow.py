@@ -125,6 +125,11 @@ class MainWindow(QtGui.QMainWindow):
         restoreAction = QtGui.QAction(u'还原', self)
         restoreAction.triggered.connect(self.restoreWindow)
         
+        statsAction = QtGui.QAction(u'事件引擎统计', self)
+        statsAction.setCheckable(True)
+        statsAction.setChecked(self.mainEngine.getEventEngineStatsActive())
+        statsAction.triggered.connect(self.setEventEngineStats)
+        
         # 创建菜单
         menubar = self.menuBar()
         
@@ -175,6 +180,7 @@ class MainWindow(QtGui.QMainWindow):
         helpMenu.addAction(restoreAction)
         helpMenu.addAction(aboutAction)  
         helpMenu.addAction(testAction)
+        helpMenu.addAction(statsAction)
     
     #----------------------------------------------------------------------
     def initStatusBar(self):
@@ -197,7 +203,7 @@ class MainWindow(QtGui.QMainWindow):
         
         if self.sbCount == self.sbTrigger:
             self.sbCount = 0
-            self.statusLabel.setText(self.getCpuMemory())
+            self.statusLabel.setText(self.getCpuMemory() + self.getEventEngineStats())
     
     #----------------------------------------------------------------------
     def getCpuMemory(self):
@@ -205,6 +211,27 @@ class MainWindow(QtGui.QMainWindow):
         cpuPercent = psutil.cpu_percent()
         memoryPercent = psutil.virtual_memory().percent
         return u'CPU使用率：%d%%   内存使用率：%d%%' % (cpuPercent, memoryPercent)        
+    
+    #----------------------------------------------------------------------
+    def getEventEngineStats(self):
+        """获取事件引擎运行统计信息，未开启统计时返回空字符串"""
+        if not self.mainEngine.getEventEngineStatsActive():
+            return u''
+        
+        stats = self.mainEngine.getEventEngineStats()
+        
+        # 处理函数p99执行时间的最大值
+        p99 = max([d['p99'] for d in stats['handler'].values()] or [0])
+        
+        return u'   事件队列：%d   最大深度：%d   合并事件：%d   处理耗时p99：%.1f毫秒' %(stats['queueSize'], 
+                                                                              stats['maxQueueSize'],
+                                                                              stats['coalescedCount'],
+                                                                              p99)
+        
+    #----------------------------------------------------------------------
+    def setEventEngineStats(self, checked):
+        """开关事件引擎运行统计"""
+        self.mainEngine.setEventEngineStatsActive(checked)
         
     #----------------------------------------------------------------------
     def connectCtp(self):
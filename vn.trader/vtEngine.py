@@ -8,7 +8,8 @@ from pymongo.errors import ConnectionFailure
 
 from eventEngine import *
 from vtGateway import *
-from vtFunction import loadMongoSetting
+from vtFunction import loadMongoSetting, loadVtSetting
+from vtJournal import JournalStorage, STORAGE_MONGO, STORAGE_JOURNAL, JOURNAL_PATH
 
 from ctaAlgo.ctaEngine import CtaEngine
 from dataRecorder.drEngine import DrEngine
@@ -23,16 +24,31 @@ class MainEngine(object):
     #----------------------------------------------------------------------
     def __init__(self):
         """Constructor"""
-        # 创建事件引擎
-        self.eventEngine = EventEngine2()
+        # 创建事件引擎，批量处理模式由VT_setting.json中的eventEngineBatchMode设置
+        # 各个功能引擎的处理函数不是线程安全的，不能使用多线程的ShardedEventEngine
+        setting = loadVtSetting()
+        self.eventEngine = EventEngine2(setting.get('eventEngineBatchMode', False))
         self.eventEngine.start()
         
+        # 事件引擎运行统计，统计结果会定时写入日志
+        self.eventEngine.register(EVENT_ENGINE_STATS, self.processEventEngineStats)
+        
+        statsInterval = setting.get('eventStatsInterval', 0)
+        if statsInterval:
+            self.setEventEngineStatsActive(True, statsInterval)
+        
         # 创建数据引擎
         self.dataEngine = DataEngine(self.eventEngine)
         
         # MongoDB数据库相关
         self.dbClient = None    # MongoDB客户端对象
         
+        # 使用Journal存储时，Tick和K线数据读写二进制日志文件，其他数据仍然使用MongoDB
+        self.journal = None
+        if setting.get('storageBackend', STORAGE_MONGO) == STORAGE_JOURNAL:
+            self.journal = JournalStorage(setting.get('journalPath') or JOURNAL_PATH,
+                                          setting.get('journalCompress', False))
+        
         # 调用一个个初始化函数
         self.initGateway()
 
@@ -225,6 +241,37 @@ class MainEngine(object):
         event.dict_['data'] = log
         self.eventEngine.put(event)        
     
+    #----------------------------------------------------------------------
+    def setEventEngineStatsActive(self, active, interval=10):
+        """开关事件引擎运行统计"""
+        self.eventEngine.setStatsActive(active, interval)
+        
+    #----------------------------------------------------------------------
+    def getEventEngineStatsActive(self):
+        """查询事件引擎运行统计是否开启"""
+        return self.eventEngine.getStatsActive()
+    
+    #----------------------------------------------------------------------
+    def getEventEngineStats(self):
+        """查询事件引擎运行统计信息"""
+        return self.eventEngine.getStats()
+    
+    #----------------------------------------------------------------------
+    def processEventEngineStats(self, event):
+        """将事件引擎运行统计写入日志"""
+        stats = event.dict_['data']
+        content = u'事件引擎统计：队列深度%s，最大深度%s，合并事件%s' %(stats['queueSize'], 
+                                                                  stats['maxQueueSize'],
+                                                                  stats['coalescedCount'])
+        
+        # 只输出p99执行时间最长的处理函数
+        if stats['handler']:
+            name, d = max(stats['handler'].items(), key=lambda item: item[1]['p99'])
+            content += u'，最慢处理函数%s（调用%s次，p50 %.3f毫秒，p99 %.3f毫秒）' %(name, d['count'],
+                                                                             d['p50'], d['p99'])
+        
+        self.writeLog(content)
+    
     #----------------------------------------------------------------------
     def dbConnect(self):
         """连接MongoDB数据库"""
@@ -249,15 +296,35 @@ class MainEngine(object):
     #----------------------------------------------------------------------
     def dbInsert(self, dbName, collectionName, d):
         """向MongoDB中插入数据，d是具体数据"""
-        if self.dbClient:
+        if self.journal and self.journal.isSupported(dbName):
+            self.journal.insert(dbName, collectionName, d)
+        elif self.dbClient:
             db = self.dbClient[dbName]
             collection = db[collectionName]
             collection.insert(d)
-    
+
+    #----------------------------------------------------------------------
+    def dbInsertMany(self, dbName, collectionName, l):
+        """
+        向MongoDB中批量插入数据，l是数据列表，使用无序插入，单条数据出错不影响其他数据，
+        返回插入的数据量；MongoDB部分数据插入失败时抛出BulkWriteError，
+        其中details['nInserted']为插入成功的数据量
+        """
+        if self.journal and self.journal.isSupported(dbName):
+            return self.journal.insertMany(dbName, collectionName, l)
+        elif self.dbClient and l:
+            db = self.dbClient[dbName]
+            collection = db[collectionName]
+            return len(collection.insert_many(l, ordered=False).inserted_ids)
+        return 0
+
     #----------------------------------------------------------------------
     def dbQuery(self, dbName, collectionName, d):
         """从MongoDB中读取数据，d是查询要求，返回的是数据库查询的指针"""
-        if self.dbClient:
+        if self.journal and self.journal.isSupported(dbName):
+            # Journal存储返回字典列表，和查询指针一样可以遍历
+            return self.journal.query(dbName, collectionName, d)
+        elif self.dbClient:
             db = self.dbClient[dbName]
             collection = db[collectionName]
             cursor = collection.find(d)
@@ -7,11 +7,17 @@
 import os
 import decimal
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import izip
+from operator import attrgetter
+from time import time as _time, mktime
 
 MAX_NUMBER = 10000000000000
 MAX_DECIMAL = 4
 
+TICK_DATETIME_FORMAT = '%Y%m%d %H:%M:%S.%f'     # Tick数据日期和时间拼接后的格式
+MICROSECOND_SCALE = (0, 100000, 10000, 1000, 100, 10, 1)    # 秒的小数部分位数对应的微秒倍数
+
 #----------------------------------------------------------------------
 def safeUnicode(value):
     """检查接口数据潜在的错误，保证转化为的字符串正确"""
@@ -29,26 +35,459 @@ def safeUnicode(value):
     return unicode(value)
 
 #----------------------------------------------------------------------
-def loadMongoSetting():
-    """载入MongoDB数据库的配置"""
+def loadVtSetting():
+    """载入VT_setting.json的配置，返回配置字典，文件不存在或者格式错误时返回空字典"""
     fileName = 'VT_setting.json'
     path = os.path.abspath(os.path.dirname(__file__)) 
     fileName = os.path.join(path, fileName)  
     
     try:
-        f = file(fileName)
-        setting = json.load(f)
-        host = setting['mongoHost']
-        port = setting['mongoPort']
-    except:
-        host = 'localhost'
-        port = 27017
-        
+        with open(fileName) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+#----------------------------------------------------------------------
+def loadMongoSetting():
+    """载入MongoDB数据库的配置"""
+    setting = loadVtSetting()
+    host = setting.get('mongoHost', 'localhost')
+    port = setting.get('mongoPort', 27017)
     return host, port
 
 #----------------------------------------------------------------------
 def todayDate():
     """获取当前本机电脑时间的日期"""
-    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)    
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+#----------------------------------------------------------------------
+def getTradingDay(dt):
+    """
+    获取时间对应的期货交易日（格式为YYYYMMDD的字符串）
+    20点之后的夜盘属于下一个交易日，周五夜盘和周六凌晨属于下周一，不考虑节假日
+    """
+    if dt.hour >= 20:
+        dt = dt + timedelta(days=1)
+    
+    weekday = dt.weekday()
+    if weekday == 5:
+        dt = dt + timedelta(days=2)
+    elif weekday == 6:
+        dt = dt + timedelta(days=1)
+    
+    return dt.strftime('%Y%m%d')
+
+
+########################################################################
+class TickTimeParser(object):
+    """
+    Tick时间戳解析器，用于接口收到行情时生成tick.date和tick.datetime
+
+    1. 日期字符串解析后的结果按日缓存，本地日期缓存到当天结束，不再对每个Tick调用
+       datetime.now().strftime和strptime
+    2. 时间字符串HH:MM:SS.f直接截取各部分转化为整数
+    3. 夜盘Tick的交易日为下一个工作日，使用交易日解析时换算回实际的自然日：20点之后
+       为交易日的前一个工作日，0点之后为前一个工作日的下一天（与getTradingDay对应，
+       不考虑节假日）
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self):
+        """Constructor"""
+        self.dateCache = {}                     # key为日期字符串，value为(年, 月, 日)
+        self.tradingDayCache = {}               # key为交易日，value为(夜盘20点之后的日期, 0点之后的日期)
+
+        self.localDateStart = 0                 # 本地日期开始的时间戳
+        self.localDateEnd = 0                   # 本地日期结束的时间戳
+        self.localDateList = []                 # 本地日期的前一天、当天、后一天的(日期字符串, (年, 月, 日))
+
+    #----------------------------------------------------------------------
+    def getDate(self, date):
+        """获取日期字符串对应的(年, 月, 日)"""
+        try:
+            return self.dateCache[date]
+        except KeyError:
+            dateTuple = (int(date[0:4]), int(date[4:6]), int(date[6:8]))
+            self.dateCache[date] = dateTuple
+            return dateTuple
+
+    #----------------------------------------------------------------------
+    def parse(self, date, time):
+        """解析日期（20151009）和时间（11:20:56.5），返回datetime对象"""
+        year, month, day = self.getDate(date)
+        hour, minute, second, microsecond = parseTimeString(time)
+        return datetime(year, month, day, hour, minute, second, microsecond)
+
+    #----------------------------------------------------------------------
+    def parseTradingDay(self, tradingDay, time):
+        """解析交易日和时间，夜盘的交易日换算为自然日，返回(日期字符串, datetime对象)"""
+        hour, minute, second, microsecond = parseTimeString(time)
+
+        if 6 <= hour < 20:
+            date = tradingDay
+            year, month, day = self.getDate(date)
+        else:
+            if tradingDay not in self.tradingDayCache:
+                self.updateTradingDay(tradingDay)
+            nightDate, midnightDate = self.tradingDayCache[tradingDay]
+
+            if hour >= 20:
+                date, (year, month, day) = nightDate
+            else:
+                date, (year, month, day) = midnightDate
+
+        return date, datetime(year, month, day, hour, minute, second, microsecond)
+
+    #----------------------------------------------------------------------
+    def parseLocal(self, time):
+        """
+        使用本机日期解析时间，返回(日期字符串, datetime对象)
+        本机时钟和交易所时钟在0点附近可能不一致，两者相差超过12小时时说明跨过了0点，
+        使用前一天或者后一天的日期
+        """
+        now = _time()
+        if now >= self.localDateEnd:
+            self.updateLocalDate(now)
+
+        hour, minute, second, microsecond = parseTimeString(time)
+
+        diff = hour*3600 + minute*60 + second - (now - self.localDateStart)
+        if diff > 43200:
+            date, (year, month, day) = self.localDateList[0]
+        elif diff < -43200:
+            date, (year, month, day) = self.localDateList[2]
+        else:
+            date, (year, month, day) = self.localDateList[1]
+
+        return date, datetime(year, month, day, hour, minute, second, microsecond)
+
+    #----------------------------------------------------------------------
+    def updateTradingDay(self, tradingDay):
+        """计算交易日对应的夜盘自然日"""
+        dt = datetime(*self.getDate(tradingDay))
+
+        # 交易日的前一个工作日
+        dt = dt - timedelta(days=1)
+        while dt.weekday() >= 5:
+            dt = dt - timedelta(days=1)
+        nightDate = self.getDateInfo(dt)
+
+        midnightDate = self.getDateInfo(dt + timedelta(days=1))
+
+        self.tradingDayCache[tradingDay] = (nightDate, midnightDate)
+
+    #----------------------------------------------------------------------
+    def updateLocalDate(self, now):
+        """更新本地日期的缓存"""
+        today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        self.localDateList = [self.getDateInfo(today + timedelta(days=n)) for n in (-1, 0, 1)]
+        self.localDateStart = mktime(today.timetuple())
+        self.localDateEnd = mktime((today + timedelta(days=1)).timetuple())
+
+    #----------------------------------------------------------------------
+    def getDateInfo(self, dt):
+        """获取datetime对象的(日期字符串, (年, 月, 日))"""
+        date = dt.strftime('%Y%m%d')
+        return date, self.getDate(date)
+
+
+#----------------------------------------------------------------------
+def parseTimeString(time):
+    """
+    解析时间字符串HH:MM:SS或HH:MM:SS.f，返回(时, 分, 秒, 微秒)
+    秒的小数部分超过6位时截断到微秒，没有补零的格式（如9:30:00）使用strptime解析
+    """
+    if time[2:3] != ':' or time[5:6] != ':':
+        return parseTimeStringSlow(time)
+
+    fraction = time[9:15]
+    if fraction:
+        microsecond = int(fraction) * MICROSECOND_SCALE[len(fraction)]
+    else:
+        microsecond = 0
+
+    return int(time[0:2]), int(time[3:5]), int(time[6:8]), microsecond
+
+#----------------------------------------------------------------------
+def parseTimeStringSlow(time):
+    """使用strptime解析没有补零的时间字符串，返回(时, 分, 秒, 微秒)"""
+    time, _, fraction = time.partition('.')
+    t = datetime.strptime(time, '%H:%M:%S')
+    
+    fraction = fraction[:6]
+    if fraction:
+        microsecond = int(fraction) * MICROSECOND_SCALE[len(fraction)]
+    else:
+        microsecond = 0
+    
+    return t.hour, t.minute, t.second, microsecond
+
+# 供没有在接口中解析datetime的Tick数据使用的全局解析器
+_tickTimeParser = TickTimeParser()
+
+#----------------------------------------------------------------------
+def parseTickDatetime(date, time):
+    """解析Tick数据的日期（20151009）和时间（11:20:56.5），返回datetime对象"""
+    return _tickTimeParser.parse(date, time)
+
+#----------------------------------------------------------------------
+def getTickConverter(tickClass):
+    """
+    生成将VtTickData转化为tickClass对象（如CtaTickData、DrTickData）的函数
+
+    字段列表和取值函数只在生成时计算一次，转化时不再遍历__dict__逐个调用__getattribute__，
+    datetime字段直接使用接口收到行情时解析好的tick.datetime，接口没有解析时才在这里解析
+    """
+    keyList = [key for key in tickClass().__dict__.keys() if key != 'datetime']
+    getter = attrgetter(*keyList)
+
+    def convertTick(tick):
+        """转化Tick数据"""
+        d = dict(izip(keyList, getter(tick)))
+        d['datetime'] = tick.datetime or parseTickDatetime(tick.date, tick.time)
+
+        newTick = tickClass.__new__(tickClass)
+        newTick.__dict__ = d
+        return newTick
+
+    return convertTick
+
+
+########################################################################
+class SlotData(object):
+    """
+    使用__slots__保存字段的数据类的基类，子类由createSlotClass根据普通数据类生成
+
+    对象不再带有__dict__，需要字典的地方（如插入数据库、从数据库记录创建对象）
+    使用toDict和fromDict转化，或者使用兼容两种数据类的getDataDict
+    """
+    __slots__ = ()
+
+    fieldList = ()                  # 字段名列表
+    fieldSet = frozenset()          # 字段名集合
+    fieldGetter = None              # 一次获取所有字段值的函数
+
+    #----------------------------------------------------------------------
+    def toDict(self):
+        """转化为字典"""
+        return dict(izip(self.fieldList, self.fieldGetter(self)))
+
+    #----------------------------------------------------------------------
+    @classmethod
+    def fromDict(cls, d):
+        """从字典创建对象，字典中没有的字段使用默认值，数据类之外的字段（如数据库的_id）被忽略"""
+        data = cls()
+        fieldSet = cls.fieldSet
+        for key, value in d.iteritems():
+            if key in fieldSet:
+                setattr(data, key, value)
+        return data
+
+    #----------------------------------------------------------------------
+    def __getstate__(self):
+        """用于pickle和copy"""
+        return self.toDict()
+
+    #----------------------------------------------------------------------
+    def __setstate__(self, state):
+        """用于pickle和copy"""
+        for key, value in state.iteritems():
+            setattr(self, key, value)
+
+#----------------------------------------------------------------------
+def createSlotClass(dataClass, className):
+    """
+    根据使用__dict__保存字段的数据类（如VtTickData、CtaBarData）生成使用__slots__的版本
+
+    字段和默认值与原数据类相同（默认值应为字符串、数字、None等不可变对象），属性的访问方式不变，
+    每个对象的内存占用和创建时间更少，但是不能再添加数据类之外的属性
+    """
+    default = dataClass().__dict__
+    fieldList = tuple(sorted(default.keys()))
+
+    # 生成逐个字段赋值的__init__，比循环调用setattr快
+    namespace = {}
+    lineList = ['def __init__(self):']
+    for n, key in enumerate(fieldList):
+        namespace['v%d' %n] = default[key]
+        lineList.append('    self.%s = v%d' %(key, n))
+    exec '\n'.join(lineList) in namespace
+
+    classDict = {
+        '__slots__': fieldList,
+        '__init__': namespace['__init__'],
+        '__doc__': dataClass.__doc__,
+        '__module__': dataClass.__module__,
+        'fieldList': fieldList,
+        'fieldSet': frozenset(fieldList),
+        'fieldGetter': attrgetter(*fieldList)
+    }
+    return type(className, (SlotData,), classDict)
+
+#----------------------------------------------------------------------
+def getDataDict(data):
+    """获取数据对象的字段字典，兼容普通数据类和SlotData"""
+    try:
+        return data.__dict__
+    except AttributeError:
+        return data.toDict()
+
+#----------------------------------------------------------------------
+def benchmarkTickConverter(count=100000):
+    """
+    性能测试：对比CtaEngine和DrEngine原有的Tick转化方式（各自遍历__dict__复制字段，
+    并对拼接的时间字符串调用strptime），和接口解析一次datetime后两个引擎使用预先
+    生成的转化函数的耗时
+    """
+    from vtGateway import VtTickData
+    from ctaAlgo.ctaBase import CtaTickData
+    from dataRecorder.drBase import DrTickData
+
+    tickList = []
+    for n in xrange(count):
+        tick = VtTickData()
+        tick.symbol = 'IF1606'
+        tick.vtSymbol = 'IF1606'
+        tick.lastPrice = 3000 + n % 100 * 0.2
+        tick.date = '20160601'
+        tick.time = '%02d:%02d:%02d.%d' %(9 + n // 36000 % 6, n // 600 % 60, n // 10 % 60, n % 2 * 5)
+        tickList.append(tick)
+
+    # 原有方式
+    start = _time()
+    for tick in tickList:
+        for tickClass in (CtaTickData, DrTickData):
+            oldTick = tickClass()
+            d = oldTick.__dict__
+            for key in d.keys():
+                if key != 'datetime':
+                    d[key] = tick.__getattribute__(key)
+            oldTick.datetime = datetime.strptime(' '.join([tick.date, tick.time]), TICK_DATETIME_FORMAT)
+    oldCost = _time() - start
+
+    # 接口解析一次datetime，两个引擎使用转化函数
+    convertCtaTick = getTickConverter(CtaTickData)
+    convertDrTick = getTickConverter(DrTickData)
+
+    start = _time()
+    for tick in tickList:
+        tick.datetime = parseTickDatetime(tick.date, tick.time)
+    parseCost = _time() - start
+
+    start = _time()
+    for tick in tickList:
+        ctaTick = convertCtaTick(tick)
+        drTick = convertDrTick(tick)
+    convertCost = _time() - start
+    newCost = parseCost + convertCost
+
+    # 检查转化结果和原有方式一致
+    if drTick.__dict__ != oldTick.__dict__:
+        print u'转化结果不一致'
+
+    print u'Tick数量：%s' %count
+    print u'原有方式耗时：%.3f秒，每个Tick %.2f微秒' %(oldCost, oldCost/count*1000000)
+    print u'新方式耗时：%.3f秒（接口解析%.3f秒，引擎转化%.3f秒），每个Tick %.2f微秒' %(newCost, parseCost,
+                                                                      convertCost, newCost/count*1000000)
+    print u'加速比：%.1f' %(oldCost/newCost)
+
+
+#----------------------------------------------------------------------
+def benchmarkTickTimeParser(count=200000):
+    """
+    性能测试：对比接口原有的datetime.now().strftime获取日期、拼接字符串后调用strptime的
+    方式，和TickTimeParser的耗时，同时检查解析结果和strptime一致
+    """
+    timeList = ['%02d:%02d:%02d.%d' %(9 + n // 36000 % 6, n // 600 % 60, n // 10 % 60, n % 2 * 5)
+                for n in xrange(count)]
+    tradingDay = '20160601'
+
+    # 原有方式
+    start = _time()
+    oldResult = []
+    for time in timeList:
+        date = datetime.now().strftime('%Y%m%d')
+        oldResult.append(datetime.strptime(' '.join([date, time]), TICK_DATETIME_FORMAT))
+    oldCost = _time() - start
+
+    parser = TickTimeParser()
+
+    start = _time()
+    newResult = [parser.parse(tradingDay, time) for time in timeList]
+    parseCost = _time() - start
+
+    start = _time()
+    for time in timeList:
+        parser.parseLocal(time)
+    localCost = _time() - start
+
+    start = _time()
+    for time in timeList:
+        parser.parseTradingDay(tradingDay, time)
+    tradingDayCost = _time() - start
+
+    # 检查解析结果
+    for time, dt in zip(timeList, newResult):
+        if dt != datetime.strptime(' '.join([tradingDay, time]), TICK_DATETIME_FORMAT):
+            print u'解析结果不一致：%s' %time
+            break
+
+    # 检查夜盘换算：交易日周一的夜盘属于上周五和周六凌晨
+    print parser.parseTradingDay('20160606', '21:00:00.5')
+    print parser.parseTradingDay('20160606', '01:30:00.0')
+    print parser.parseLocal('10:00:00.0')
+
+    print u'时间戳数量：%s' %count
+    print u'strptime耗时：%.3f秒，每个%.2f微秒' %(oldCost, oldCost/count*1000000)
+    print u'parse耗时：%.3f秒，每个%.2f微秒' %(parseCost, parseCost/count*1000000)
+    print u'parseLocal耗时：%.3f秒，每个%.2f微秒' %(localCost, localCost/count*1000000)
+    print u'parseTradingDay耗时：%.3f秒，每个%.2f微秒' %(tradingDayCost, tradingDayCost/count*1000000)
+
+
+#----------------------------------------------------------------------
+def benchmarkSlotData(count=200000):
+    """
+    性能测试：对比普通数据类和__slots__版本的每个对象内存占用（对象本身加上__dict__，
+    不包括字段值）和创建耗时，同时检查toDict和fromDict转化前后字段一致
+    """
+    import sys
+    from vtGateway import (VtTickData, VtOrderData, VtTradeData,
+                           VtTickDataSlot, VtOrderDataSlot, VtTradeDataSlot)
+    from ctaAlgo.ctaBase import CtaTickData, CtaBarData, CtaTickDataSlot, CtaBarDataSlot
+
+    classList = [(VtTickData, VtTickDataSlot),
+                 (VtOrderData, VtOrderDataSlot),
+                 (VtTradeData, VtTradeDataSlot),
+                 (CtaTickData, CtaTickDataSlot),
+                 (CtaBarData, CtaBarDataSlot)]
+
+    print u'对象数量：%s' %count
+    for dataClass, slotClass in classList:
+        data = dataClass()
+        oldSize = sys.getsizeof(data) + sys.getsizeof(data.__dict__)
+        newSize = sys.getsizeof(slotClass())
+
+        start = _time()
+        for n in xrange(count):
+            dataClass()
+        oldCost = _time() - start
+
+        start = _time()
+        for n in xrange(count):
+            slotClass()
+        newCost = _time() - start
+
+        if slotClass.fromDict(data.__dict__).toDict() != data.__dict__:
+            print u'%s转化结果不一致' %slotClass.__name__
+
+        print u'%s：%s字节/对象 -> %s字节/对象，创建耗时%.3f秒 -> %.3f秒' %(dataClass.__name__, oldSize, newSize,
+                                                                 oldCost, newCost)
+
+
+if __name__ == '__main__':
+    benchmarkTickTimeParser()
+    benchmarkTickConverter()
+    benchmarkSlotData()
 
  
@@ -5,6 +5,7 @@ import time
 from eventEngine import *
 
 from vtConstant import *
+from vtFunction import createSlotClass
 
 
 ########################################################################
@@ -20,67 +21,42 @@ class VtGateway(object):
     #----------------------------------------------------------------------
     def onTick(self, tick):
         """市场行情推送"""
-        # 通用事件
-        event1 = Event(type_=EVENT_TICK)
-        event1.dict_['data'] = tick
-        self.eventEngine.put(event1)
-        
-        # 特定合约代码的事件
-        event2 = Event(type_=EVENT_TICK+tick.vtSymbol)
-        event2.dict_['data'] = tick
-        self.eventEngine.put(event2)
+        # 特定合约代码的事件，事件引擎会同时推送给监听通用事件的处理函数
+        event = Event(type_=EVENT_TICK+tick.vtSymbol)
+        event.dict_['data'] = tick
+        self.eventEngine.put(event)
     
     #----------------------------------------------------------------------
     def onTrade(self, trade):
         """成交信息推送"""
-        # 通用事件
-        event1 = Event(type_=EVENT_TRADE)
-        event1.dict_['data'] = trade
-        self.eventEngine.put(event1)
-        
-        # 特定合约的成交事件
-        event2 = Event(type_=EVENT_TRADE+trade.vtSymbol)
-        event2.dict_['data'] = trade
-        self.eventEngine.put(event2)        
+        # 特定合约的成交事件，事件引擎会同时推送给监听通用事件的处理函数
+        event = Event(type_=EVENT_TRADE+trade.vtSymbol)
+        event.dict_['data'] = trade
+        self.eventEngine.put(event)
     
     #----------------------------------------------------------------------
     def onOrder(self, order):
         """订单变化推送"""
-        # 通用事件
-        event1 = Event(type_=EVENT_ORDER)
-        event1.dict_['data'] = order
-        self.eventEngine.put(event1)
-        
-        # 特定订单编号的事件
-        event2 = Event(type_=EVENT_ORDER+order.vtOrderID)
-        event2.dict_['data'] = order
-        self.eventEngine.put(event2)
+        # 特定订单编号的事件，事件引擎会同时推送给监听通用事件的处理函数
+        event = Event(type_=EVENT_ORDER+order.vtOrderID)
+        event.dict_['data'] = order
+        self.eventEngine.put(event)
     
     #----------------------------------------------------------------------
     def onPosition(self, position):
         """持仓信息推送"""
-        # 通用事件
-        event1 = Event(type_=EVENT_POSITION)
-        event1.dict_['data'] = position
-        self.eventEngine.put(event1)
-        
-        # 特定合约代码的事件
-        event2 = Event(type_=EVENT_POSITION+position.vtSymbol)
-        event2.dict_['data'] = position
-        self.eventEngine.put(event2)
+        # 特定合约代码的事件，事件引擎会同时推送给监听通用事件的处理函数
+        event = Event(type_=EVENT_POSITION+position.vtSymbol)
+        event.dict_['data'] = position
+        self.eventEngine.put(event)
     
     #----------------------------------------------------------------------
     def onAccount(self, account):
         """账户信息推送"""
-        # 通用事件
-        event1 = Event(type_=EVENT_ACCOUNT)
-        event1.dict_['data'] = account
-        self.eventEngine.put(event1)
-        
-        # 特定合约代码的事件
-        event2 = Event(type_=EVENT_ACCOUNT+account.vtAccountID)
-        event2.dict_['data'] = account
-        self.eventEngine.put(event2)
+        # 特定账户代码的事件，事件引擎会同时推送给监听通用事件的处理函数
+        event = Event(type_=EVENT_ACCOUNT+account.vtAccountID)
+        event.dict_['data'] = account
+        self.eventEngine.put(event)
     
     #----------------------------------------------------------------------
     def onError(self, error):
@@ -174,6 +150,7 @@ class VtTickData(VtBaseData):
         self.openInterest = EMPTY_INT           # 持仓量
         self.time = EMPTY_STRING                # 时间 11:20:56.5
         self.date = EMPTY_STRING                # 日期 20151009
+        self.datetime = None                    # python的datetime时间对象，由接口收到行情时解析
         
         # 常规行情
         self.openPrice = EMPTY_FLOAT            # 今日开盘价
@@ -428,6 +405,13 @@ class VtCancelOrderReq(object):
         self.orderID = EMPTY_STRING             # 报单号
         self.frontID = EMPTY_STRING             # 前置机号
         self.sessionID = EMPTY_STRING           # 会话号
+
+
+# 使用__slots__的紧凑版本数据类，字段和默认值与原数据类相同，用于需要大量创建对象的场合，
+# 需要字典时使用toDict和fromDict（见vtFunction.createSlotClass）
+VtTickDataSlot = createSlotClass(VtTickData, 'VtTickDataSlot')
+VtOrderDataSlot = createSlotClass(VtOrderData, 'VtOrderDataSlot')
+VtTradeDataSlot = createSlotClass(VtTradeData, 'VtTradeDataSlot')
   
     
     
@@ -438,3 +422,43 @@ class VtCancelOrderReq(object):
     
     
     
+
+
+#----------------------------------------------------------------------
+def benchmark(n=1000000):
+    """
+    性能测试函数：比较每个tick推送两个事件（通用和特定合约）和
+    只推送一个事件时创建的Event对象数量和耗时
+    """
+    from time import time
+    
+    class CountingEngine(object):
+        """只统计事件数量的事件引擎"""
+        def __init__(self):
+            self.count = 0
+        def put(self, event):
+            self.count += 1
+    
+    tick = VtTickData()
+    tick.vtSymbol = 'IF1606'
+    
+    # 原先的推送方式
+    ee = CountingEngine()
+    start = time()
+    for i in xrange(n):
+        event1 = Event(type_=EVENT_TICK)
+        event1.dict_['data'] = tick
+        ee.put(event1)
+        
+        event2 = Event(type_=EVENT_TICK+tick.vtSymbol)
+        event2.dict_['data'] = tick
+        ee.put(event2)
+    print u'双事件推送：%s个tick，创建Event %s个，耗时%.3f秒' %(n, ee.count, time()-start)
+    
+    # 当前的推送方式
+    ee = CountingEngine()
+    gateway = VtGateway(ee, 'BENCHMARK')
+    start = time()
+    for i in xrange(n):
+        gateway.onTick(tick)
+    print u'单事件推送：%s个tick，创建Event %s个，耗时%.3f秒' %(n, ee.count, time()-start)
@@ -0,0 +1,434 @@
+# encoding: UTF-8
+
+'''
+本文件中实现了行情数据的二进制日志存储（Journal），可以替代MongoDB保存Tick和K线数据：
+
+1. 每个合约每个自然日一个只追加写入的文件，路径为：根目录/数据库名/集合名/YYYYMMDD.bin
+2. 每条数据为固定格式的记录（TICK_DTYPE或BAR_DTYPE），时间保存为1970年以来的微秒数，
+   字符串字段为定长的字节串
+3. 不压缩时直接追加记录，读取时使用只读内存映射；开启压缩时每次写入的记录压缩为
+   一个数据块（块头为记录数量和压缩后的长度），文件扩展名为.binz，读取时解压
+4. K线记录格式增加了K线内的成交量barVolume，新的K线文件扩展名为.bin2和.binz2，
+   之前写入的.bin和.binz文件按照LEGACY_BAR_DTYPE读取，barVolume为0
+5. query方法支持MongoDB风格的datetime范围查询，返回字典的列表，可以替代
+   MainEngine.dbQuery；readRecords返回结构化数组，用于回测直接生成列式数据
+
+Tick数据库（VnTrader_Tick_Db）使用Tick记录格式，K线数据库（VnTrader_1Min_Db、
+VnTrader_5Min_Db、VnTrader_1Hour_Db、VnTrader_1Day_Db、VnTrader_Daily_Db等）使用K线记录格式，
+其他数据库（如设置、持仓）不支持，仍然使用MongoDB。
+'''
+
+import os
+import re
+import zlib
+import struct
+from datetime import datetime, timedelta
+from itertools import izip
+from operator import itemgetter
+from threading import Lock
+
+import numpy as np
+
+
+# 存储后端
+STORAGE_MONGO = 'mongo'
+STORAGE_JOURNAL = 'journal'
+
+# 默认的Journal存储目录，VT_setting.json中没有设置journalPath时使用
+JOURNAL_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'journal')
+
+# 文件扩展名
+RAW_SUFFIX = '.bin'
+COMPRESS_SUFFIX = '.binz'
+BAR_RAW_SUFFIX = '.bin2'            # 包含barVolume的K线记录
+BAR_COMPRESS_SUFFIX = '.binz2'
+
+RAW_SUFFIX_SET = set([RAW_SUFFIX, BAR_RAW_SUFFIX])
+SUFFIX_SET = set([RAW_SUFFIX, COMPRESS_SUFFIX, BAR_RAW_SUFFIX, BAR_COMPRESS_SUFFIX])
+
+# 压缩数据块的块头：记录数量、压缩后的字节数
+BLOCK_HEADER = struct.Struct('<II')
+
+# 1970年1月1日的序数，用于datetime转换
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+DAY_MICROSECONDS = 86400 * 1000000
+
+# 字符串字段
+STRING_FIELD_LIST = [('vtSymbol', 'S32'),
+                     ('symbol', 'S32'),
+                     ('exchange', 'S16'),
+                     ('date', 'S8'),
+                     ('time', 'S16')]
+
+# Tick记录格式
+TICK_DTYPE = np.dtype([('datetime', '<i8')] + STRING_FIELD_LIST +
+                      [('lastPrice', '<f8'),
+                       ('volume', '<i8'),
+                       ('openInterest', '<i8'),
+                       ('upperLimit', '<f8'),
+                       ('lowerLimit', '<f8')] +
+                      [('bidPrice%d' %i, '<f8') for i in range(1, 6)] +
+                      [('askPrice%d' %i, '<f8') for i in range(1, 6)] +
+                      [('bidVolume%d' %i, '<i8') for i in range(1, 6)] +
+                      [('askVolume%d' %i, '<i8') for i in range(1, 6)])
+
+# K线记录格式
+BAR_DTYPE = np.dtype([('datetime', '<i8')] + STRING_FIELD_LIST +
+                     [('open', '<f8'),
+                      ('high', '<f8'),
+                      ('low', '<f8'),
+                      ('close', '<f8'),
+                      ('volume', '<i8'),
+                      ('openInterest', '<i8'),
+                      ('barVolume', '<i8')])
+
+# 没有barVolume的K线记录格式，用于读取.bin和.binz扩展名的K线文件
+LEGACY_BAR_DTYPE = np.dtype([(name, BAR_DTYPE[name]) for name in BAR_DTYPE.names
+                             if name != 'barVolume'])
+
+# 数据库名称对应的记录格式，K线数据库的名称规则见drBase.getBarDbName
+TICK_DB_PATTERN = re.compile(r'^VnTrader_Tick_Db$')
+BAR_DB_PATTERN = re.compile(r'^VnTrader_(\d+Min|\d+Hour|\d+Day|Daily)_Db$')
+
+
+#----------------------------------------------------------------------
+def getRecordDtype(dbName):
+    """获取数据库对应的记录格式，不支持的数据库返回None"""
+    if TICK_DB_PATTERN.match(dbName):
+        return TICK_DTYPE
+    elif BAR_DB_PATTERN.match(dbName):
+        return BAR_DTYPE
+    else:
+        return None
+
+#----------------------------------------------------------------------
+def getFileSuffix(dtype, compress):
+    """获取写入记录格式的文件扩展名"""
+    if dtype is BAR_DTYPE:
+        return BAR_COMPRESS_SUFFIX if compress else BAR_RAW_SUFFIX
+    return COMPRESS_SUFFIX if compress else RAW_SUFFIX
+
+#----------------------------------------------------------------------
+def getFileDtype(dtype, suffix):
+    """获取数据库记录格式为dtype、扩展名为suffix的文件中保存的记录格式"""
+    if dtype is BAR_DTYPE and suffix in (RAW_SUFFIX, COMPRESS_SUFFIX):
+        return LEGACY_BAR_DTYPE
+    return dtype
+
+#----------------------------------------------------------------------
+def datetimeToMicrosecond(dt):
+    """datetime对象转换为1970年以来的微秒数"""
+    return (((dt.toordinal()-EPOCH_ORDINAL)*86400 + dt.hour*3600 + dt.minute*60 + dt.second)*1000000
+            + dt.microsecond)
+
+#----------------------------------------------------------------------
+def parseDatetimeFilter(flt):
+    """
+    将MongoDB风格的查询条件转换为微秒数的范围[start, end)，None表示不限制
+    只支持{'datetime': {'$gte'/'$gt'/'$lte'/'$lt': datetime}}格式的条件
+    """
+    start = None
+    end = None
+
+    for key, value in (flt or {}).items():
+        if key != 'datetime':
+            raise ValueError(u'Journal存储不支持的查询条件：%s' %key)
+
+        if isinstance(value, datetime):
+            value = {'$gte': value, '$lte': value}
+
+        for op, dt in value.items():
+            t = datetimeToMicrosecond(dt)
+            if op == '$gte':
+                start = t
+            elif op == '$gt':
+                start = t + 1
+            elif op == '$lte':
+                end = t + 1
+            elif op == '$lt':
+                end = t
+            else:
+                raise ValueError(u'Journal存储不支持的查询条件：%s' %op)
+
+    return start, end
+
+
+########################################################################
+class JournalStorage(object):
+    """行情数据的二进制日志存储"""
+
+    #----------------------------------------------------------------------
+    def __init__(self, path, compress=False, compressLevel=1):
+        """Constructor"""
+        self.path = path                    # 存储根目录
+        self.compress = compress            # 写入时是否压缩
+        self.compressLevel = compressLevel  # zlib压缩级别
+
+        self.lock = Lock()                  # 写入锁，数据记录引擎和CTA引擎可能在不同线程中写入
+        self.getterDict = {}                # key为记录格式，value为(字段名列表, itemgetter, 字符串字段列表)
+        self.checkedSet = set()             # 本进程中已经检查过末尾不完整数据的文件
+
+    #----------------------------------------------------------------------
+    def isSupported(self, dbName):
+        """数据库是否可以使用Journal存储"""
+        return getRecordDtype(dbName) is not None
+
+    #----------------------------------------------------------------------
+    def getFolder(self, dbName, collectionName):
+        """获取集合的存储目录"""
+        return os.path.join(self.path, dbName, collectionName)
+
+    #----------------------------------------------------------------------
+    def toRecords(self, dtype, l):
+        """
+        将字典列表转换为结构化数组，缺少的字段使用0或者空字符串，
+        字符串超出字段长度的数据被跳过（numpy会直接截断），不影响同一批的其他数据
+        """
+        if dtype not in self.getterDict:
+            nameList = list(dtype.names)
+            stringList = [(i, name, dtype[name].itemsize) for i, name in enumerate(nameList)
+                          if dtype[name].kind == 'S']
+            self.getterDict[dtype] = (nameList, itemgetter(*nameList), stringList)
+        nameList, getter, stringList = self.getterDict[dtype]
+
+        rowList = []
+        for d in l:
+            try:
+                row = getter(d)
+            except KeyError:
+                row = tuple([d.get(name) for name in nameList])
+
+            # datetime在第一列，转换为微秒数，字符串和数值字段中的None替换为默认值
+            row = list(row)
+            row[0] = datetimeToMicrosecond(row[0])
+            if None in row:
+                row = [value if value is not None else dtype[i].type()
+                       for i, value in enumerate(row)]
+
+            for i, name, size in stringList:
+                if len(row[i]) > size:
+                    break
+            else:
+                rowList.append(tuple(row))
+
+        return np.array(rowList, dtype=dtype)
+
+    #----------------------------------------------------------------------
+    def insertMany(self, dbName, collectionName, l):
+        """
+        追加写入数据，l为字典列表（如CtaTickData.__dict__），按照自然日写入不同的文件，
+        返回写入的数据量，字符串字段超出长度的数据不写入
+        """
+        dtype = getRecordDtype(dbName)
+        if dtype is None:
+            raise ValueError(u'Journal存储不支持的数据库：%s' %dbName)
+
+        records = self.toRecords(dtype, l)
+        if not len(records):
+            return 0
+
+        # 按照自然日分组，通常一批数据都属于同一天
+        dayArray = records['datetime'] // DAY_MICROSECONDS
+        dayList = np.unique(dayArray)
+
+        folder = self.getFolder(dbName, collectionName)
+
+        with self.lock:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+            for day in dayList:
+                if len(dayList) == 1:
+                    dayRecords = records
+                else:
+                    dayRecords = records[dayArray == day]
+
+                date = datetime.fromordinal(int(day) + EPOCH_ORDINAL).strftime('%Y%m%d')
+
+                fileName = os.path.join(folder, date + getFileSuffix(dtype, self.compress))
+                self.truncateFile(fileName, dtype)
+                if self.compress:
+                    data = zlib.compress(dayRecords.tostring(), self.compressLevel)
+                    with open(fileName, 'ab') as f:
+                        f.write(BLOCK_HEADER.pack(len(dayRecords), len(data)))
+                        f.write(data)
+                else:
+                    with open(fileName, 'ab') as f:
+                        f.write(dayRecords.tostring())
+
+        return len(records)
+
+    #----------------------------------------------------------------------
+    def getValidSize(self, fileName, dtype):
+        """获取文件中完整数据的字节数，不包括末尾中断写入的不完整记录或者数据块"""
+        size = os.path.getsize(fileName)
+        if os.path.splitext(fileName)[1] in RAW_SUFFIX_SET:
+            return size - size % dtype.itemsize
+
+        # 压缩文件按照块头逐个跳过数据块，不需要解压
+        validSize = 0
+        with open(fileName, 'rb') as f:
+            while True:
+                header = f.read(BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    break
+                length = BLOCK_HEADER.unpack(header)[1]
+                if validSize + BLOCK_HEADER.size + length > size:
+                    break
+                validSize += BLOCK_HEADER.size + length
+                f.seek(validSize)
+        return validSize
+
+    #----------------------------------------------------------------------
+    def truncateFile(self, fileName, dtype):
+        """
+        追加写入前截掉文件末尾中断写入的不完整数据，否则之后追加的记录位置错位无法读取，
+        每个文件在本进程中只检查一次（之后的写入都在写入锁中完整完成）
+        """
+        if fileName in self.checkedSet:
+            return
+        self.checkedSet.add(fileName)
+
+        if not os.path.exists(fileName):
+            return
+
+        validSize = self.getValidSize(fileName, dtype)
+        if validSize < os.path.getsize(fileName):
+            with open(fileName, 'r+b') as f:
+                f.truncate(validSize)
+
+    #----------------------------------------------------------------------
+    def insert(self, dbName, collectionName, d):
+        """写入一条数据，字符串字段超出长度时抛出ValueError"""
+        if not self.insertMany(dbName, collectionName, [d]):
+            raise ValueError(u'Journal存储的字符串字段超出长度：%s' %d)
+
+    #----------------------------------------------------------------------
+    def readFile(self, fileName, dtype):
+        """读取一个文件中的记录，dtype为文件中保存的记录格式，未压缩的文件使用只读内存映射"""
+        if os.path.splitext(fileName)[1] in RAW_SUFFIX_SET:
+            # 忽略正在写入的不完整记录
+            count = self.getValidSize(fileName, dtype) // dtype.itemsize
+            if not count:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(fileName, dtype=dtype, mode='r', shape=(count,))
+
+        blockList = []
+        with open(fileName, 'rb') as f:
+            while True:
+                header = f.read(BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    break
+                count, length = BLOCK_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                blockList.append(np.frombuffer(zlib.decompress(data), dtype=dtype, count=count))
+
+        if not blockList:
+            return np.zeros(0, dtype=dtype)
+        elif len(blockList) == 1:
+            return blockList[0]
+        else:
+            return np.concatenate(blockList)
+
+    #----------------------------------------------------------------------
+    def readRecords(self, dbName, collectionName, start=None, end=None):
+        """
+        读取时间范围[start, end)内的记录，start和end为微秒数（None表示不限制），
+        返回按时间排序的结构化数组，只涉及一个文件时为内存映射的视图
+        """
+        dtype = getRecordDtype(dbName)
+        if dtype is None:
+            raise ValueError(u'Journal存储不支持的数据库：%s' %dbName)
+
+        folder = self.getFolder(dbName, collectionName)
+        if not os.path.isdir(folder):
+            return np.zeros(0, dtype=dtype)
+
+        # 根据文件名中的日期筛选文件
+        startDate = ''
+        endDate = ''
+        if start is not None:
+            startDate = datetime.fromordinal(start // DAY_MICROSECONDS + EPOCH_ORDINAL).strftime('%Y%m%d')
+        if end is not None:
+            endDate = datetime.fromordinal((end - 1) // DAY_MICROSECONDS + EPOCH_ORDINAL).strftime('%Y%m%d')
+
+        recordsList = []
+        for name in sorted(os.listdir(folder)):
+            date, suffix = os.path.splitext(name)
+            if suffix not in SUFFIX_SET:
+                continue
+            if (startDate and date < startDate) or (endDate and date > endDate):
+                continue
+
+            fileDtype = getFileDtype(dtype, suffix)
+            records = self.readFile(os.path.join(folder, name), fileDtype)
+
+            # 旧格式的记录转换为当前格式，缺少的字段为0
+            if fileDtype is not dtype:
+                newRecords = np.zeros(len(records), dtype=dtype)
+                for fieldName in fileDtype.names:
+                    newRecords[fieldName] = records[fieldName]
+                records = newRecords
+
+            # 同一天的数据通常按时间顺序写入，否则稳定排序
+            dt = records['datetime']
+            if len(dt) > 1 and (dt[1:] < dt[:-1]).any():
+                records = records[dt.argsort(kind='mergesort')]
+                dt = records['datetime']
+
+            startIndex = 0
+            endIndex = len(records)
+            if start is not None:
+                startIndex = dt.searchsorted(start, 'left')
+            if end is not None:
+                endIndex = dt.searchsorted(end, 'left')
+
+            if endIndex > startIndex:
+                recordsList.append(records[startIndex:endIndex])
+
+        if not recordsList:
+            return np.zeros(0, dtype=dtype)
+        elif len(recordsList) == 1:
+            return recordsList[0]
+
+        # 同一天存在多个文件时（修改过压缩设置或者K线记录格式）需要重新排序
+        records = np.concatenate(recordsList)
+        dt = records['datetime']
+        if (dt[1:] < dt[:-1]).any():
+            records = records[dt.argsort(kind='mergesort')]
+        return records
+
+    #----------------------------------------------------------------------
+    def query(self, dbName, collectionName, flt=None):
+        """
+        按照MongoDB风格的datetime条件查询数据，返回按时间排序的字典列表，
+        字典的内容和MongoDB中读取的数据一致（不包括_id）
+        """
+        start, end = parseDatetimeFilter(flt)
+        records = self.readRecords(dbName, collectionName, start, end)
+
+        nameList = list(records.dtype.names)
+        columnList = []
+        for name in nameList:
+            column = records[name]
+            if name == 'datetime':
+                column = column.view('datetime64[us]')
+            columnList.append(column.tolist())
+
+        return [dict(izip(nameList, row)) for row in izip(*columnList)]
+
+    #----------------------------------------------------------------------
+    def getDateList(self, dbName, collectionName):
+        """获取集合中已有数据的日期列表"""
+        folder = self.getFolder(dbName, collectionName)
+        if not os.path.isdir(folder):
+            return []
+
+        dateSet = set()
+        for name in os.listdir(folder):
+            date, suffix = os.path.splitext(name)
+            if suffix in SUFFIX_SET:
+                dateSet.add(date)
+        return sorted(dateSet)
@@ -156,6 +156,7 @@ class WindGateway(VtGateway):
         dt = data.Times[0]
         tick.time = dt.strftime('%H:%M:%S')
         tick.date = dt.strftime('%Y%m%d')
+        tick.datetime = dt
         
         # 采用遍历的形式读取数值
         fields = data.Fields
@@ -13,6 +13,7 @@ from vnxspeedmd import MdApi
 from vnxspeedtd import TdApi
 from xspeedDataType import *
 from vtGateway import *
+from vtFunction import TickTimeParser
 
 # 以下为一些VT类型和XSPEED类型的映射字典
 # 价格类型映射
@@ -197,6 +198,7 @@ class XspeedMdApi(MdApi):
         self.gatewayName = gateway.gatewayName  # gateway对象名称
         
         self.reqID = EMPTY_INT              # 操作请求编号
+        self.timeParser = TickTimeParser()   # Tick时间戳解析器
         
         self.connectionStatus = False       # 连接状态
         self.loginStatus = False            # 登录状态
@@ -366,7 +368,7 @@ class XspeedMdApi(MdApi):
         tick.volume = data['Volume']
         tick.openInterest = data['openInterest']
         tick.time = '.'.join([data['UpdateTime'], str(data['UpdateMillisec']/100)])
-        tick.date = data['tradingDay']
+        tick.date, tick.datetime = self.timeParser.parseTradingDay(data['tradingDay'], tick.time)
     
         tick.openPrice = data['openPrice']
         tick.highPrice = data['highestPrice']